@@ -1,6 +1,8 @@
 #
 # pip install requests
+# pip install aiohttp
 # pip install ngrok
+# pip install pillow  (only for --split-grid)
 #
 # Create an example.sh file with the following content and execute it from the command line using ./example.sh:
 # USEAPI_TOKEN="…" NGROK_AUTHTOKEN="…" python3 ./example.py
@@ -11,25 +13,66 @@
 #                     auto-selects a configured channel with available capacity.
 #   PIXVERSE_EMAIL  - pin PixVerse requests to a specific configured account.
 #                     When omitted the API randomly selects an available account.
+#   MJ_CHANNELS     - spread Midjourney jobs over several configured channels, least loaded first:
+#                     channel[:jobs],… where jobs defaults to channelCapacity.
+#   PIXVERSE_EMAILS - the same for PixVerse accounts: email[:jobs],… (accountCapacity by default).
+#   USEAPI_URL      - API host to call instead of https://api.useapi.net, e.g. the local mock server in ../benchmark.
+#   WEBHOOK_URL     - url that already reaches port 8081, used as replyUrl instead of an ngrok tunnel.
+#   PROMPTS_FILE    - prompts to read instead of ./prompts.json: a .jsonl file with one prompt per line, as a JSON
+#                     string or {"prompt": …} object, or a .csv file with a prompt column.
+#   MJ_BUTTONS      - upscales to run for every imagine job, "U1,U2,U3,U4" by default, e.g. "U1,U3".
+#   MJ_SCORER       - module:function that picks the upscales worth running from the downloaded imagine grid. It is
+#                     called with the grid's file name and the MJ_BUTTONS, and returns the buttons to keep, e.g.
+#                     "scorer:pick" for def pick(gridFileName, buttons) in ./scorer.py.
 #
 # Pipeline: Midjourney imagine -> U1-U4 upscales -> PixVerse image-to-video (create-v4).
 #
+# python3 ./example.py --stream follows Midjourney jobs over server-sent events instead of webhooks, and polls
+# PixVerse videos, so no ngrok tunnel is needed.
+#
+# python3 ./example.py --sqlite keeps the job state in a SQLite database, result.db, instead of result.json and
+# result.jsonl; python3 ./example.py --progress reports on it from another terminal while the run goes on.
+#
+# python3 ./example.py --resume continues a run that stopped midway: finished prompts are skipped, jobs that were
+# still running are polled until they finish, and every prompt continues from the last stage it reached.
+#
+# python3 ./example.py --split-grid cuts the four images out of the imagine grid with Pillow instead of running the
+# U1-U4 upscale jobs, for when the grid's resolution is enough.
+#
 
 import requests
+import aiohttp
 import ngrok
 
 import datetime
 import os
+import hashlib
+import shutil
 import time
+import random
+import email.utils
 import json
+import sqlite3
+import importlib
 import sys
+import threading
 import asyncio
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import bisect
+import contextlib
+import csv
+from collections import deque
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # Global variables
-prompts = []
 data = {}
+jobs = {}  # jobid → data node, see indexJob()
+polled = {}  # jobid / replyRef → (status url, known fields) of jobs polled instead of reported by webhook, see pollJobs()
+webhooks = asyncio.Queue()  # webhook payloads acknowledged by handle_post(), see processWebhooks()
 submitted = 0
+streams = set()  # tasks following --stream jobs, see followStream()
+stream_session = None
 
 # Load all required parameters from the environment variables
 #
@@ -41,6 +84,13 @@ submitted = 0
 token = os.getenv("USEAPI_TOKEN")
 channel = os.getenv("MJ_CHANNEL")          # optional in v3
 pixverse_email = os.getenv("PIXVERSE_EMAIL")  # optional
+channels = os.getenv("MJ_CHANNELS") or channel or ""  # optional, channel[:jobs],…
+pixverse_emails = os.getenv("PIXVERSE_EMAILS") or pixverse_email or ""  # optional, email[:jobs],…
+apiUrl = os.getenv("USEAPI_URL") or "https://api.useapi.net"  # optional
+webhookUrl = os.getenv("WEBHOOK_URL")  # optional
+promptsFile = os.getenv("PROMPTS_FILE") or "./prompts.json"  # optional
+upscaleButtons = (os.getenv("MJ_BUTTONS") or "U1,U2,U3,U4").split(",")  # optional
+gridScorer = os.getenv("MJ_SCORER")  # optional, module:function
 
 # Optional params to add at the end of the Midjourney prompt
 promptParams = " --v 7 --s 250"
@@ -54,61 +104,410 @@ pixverse_duration = 5
 pixverse_quality = "720p"
 
 # API root urls
-rootMidjourneyUrl = "https://api.useapi.net/v3/midjourney"
-rootPixVerseUrl = "https://api.useapi.net/v2/pixverse"
+rootMidjourneyUrl = f"{apiUrl}/v3/midjourney"
+rootPixVerseUrl = f"{apiUrl}/v2/pixverse"
+
+# Maximum number of pooled keep-alive connections per host (api.useapi.net, CDN)
+maxConnectionsPerHost = 10
+# Number of journal records written between result.json snapshots
+compactEvery = 1000
+# Number of prompts in memory at a time; the next prompt is read from promptsFile once an earlier one finished
+maxActivePrompts = 1000
+# Time between status checks of polled jobs (resumed with --resume, or PixVerse jobs with --stream), in seconds
+pollSecs = 10
+# Number of webhooks processed concurrently
+webhookWorkers = 4
+# Workers of every pool of the pipeline, see pools
+# Number of Midjourney requests (imagine / button) submitted concurrently
+midjourneyConcurrency = 3
+# Number of PixVerse videos/create requests submitted concurrently
+pixverseConcurrency = 2
+# Number of image uploads streamed at the same time; each keeps its file open only while it is sent
+maxUploads = 4
+# Number of generated files downloaded in parallel, and the chunk size they are streamed to disk in
+maxDownloads = 4
+downloadChunkSize = 1024 * 1024
+# Attempts of a stage function that raises before onError gives up on its item, see AsyncFunctionQueue
+stageAttempts = 3
+stageRetrySecs = 2
+# Time an image uploaded to PixVerse is reused for new videos before it is uploaded again, in seconds, see UploadCache
+uploadTtlSecs = 24 * 60 * 60
+# Jobs a Midjourney channel / PixVerse account runs at the same time, unless set per entry in MJ_CHANNELS / PIXVERSE_EMAILS
+channelCapacity = 3
+accountCapacity = 3
+# Time between checks whether a channel taken out of rotation by a 596 was reset, in seconds
+channelCheckSecs = 60
+# Follow Midjourney jobs over server-sent events instead of webhooks, see postStream()
+streaming = "--stream" in sys.argv
+# Cut the images out of the imagine grid locally instead of upscaling them, see cropGrid()
+splitGrid = "--split-grid" in sys.argv
+# Keep the job state in the SQLite database result.db instead of result.json / result.jsonl, see JobStore
+useJobStore = "--sqlite" in sys.argv
+# Initial pause after a 429 without Retry-After, doubled on every consecutive 429 up to maxBackoffSecs
+backoffSecs = 10
+maxBackoffSecs = 120
+# Upper bound of requests in flight per API that the rate controllers may learn
+maxConcurrency = {"midjourney": midjourneyConcurrency, "pixverse": pixverseConcurrency}
+
+authHeaders = {"Authorization": f"Bearer {token}"}
+jsonHeaders = {**authHeaders, "Content-Type": "application/json"}
+
+# One pooled session is shared by every API call and download, so connections are kept alive
+# and reused instead of paying a TLS handshake per request.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxConnectionsPerHost, pool_block=True)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+# Time spent in every stage of the pipeline (submit round trip, queue wait, job until its terminal state, download,
+# upload, journal / result.json writes) as Prometheus-style histograms, see render() and summary()
+class StageMetrics:
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.histograms = {}  # (stage, api) → {"counts": per bucket and +Inf, "sum": seconds, "max": seconds}
+        self.begun = {}  # jobid / video_id → time the job was accepted, see begin()
+        self.lock = threading.Lock()  # downloads and result.json writes are timed on worker threads
+        self.started = time.time()
+
+    def observe(self, stage, secs, api=""):
+        with self.lock:
+            histogram = self.histograms.get((stage, api))
+            if histogram is None:
+                histogram = self.histograms[(stage, api)] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "max": 0.0}
+            histogram["counts"][bisect.bisect_left(self.buckets, secs)] += 1
+            histogram["sum"] += secs
+            histogram["max"] = max(histogram["max"], secs)
+
+    # with metrics.timer("upload", "pixverse"): …
+    @contextlib.contextmanager
+    def timer(self, stage, api=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, api)
+
+    # The job was accepted: end() records how long it took until its terminal state was reported
+    def begin(self, ref):
+        self.begun[ref] = time.time()
+
+    def end(self, ref, api):
+        start = self.begun.pop(ref, None)
+        if start is not None:
+            self.observe("job", time.time() - start, api)
+
+    # Upper bound of the bucket holding the share-th observation, capped by the longest one
+    def quantile(self, histogram, share):
+        rank = share * sum(histogram["counts"])
+        seen = 0
+        for bound, count in zip(self.buckets, histogram["counts"]):
+            seen += count
+            if seen >= rank:
+                return min(bound, histogram["max"])
+        return histogram["max"]
+
+    # Prometheus text exposition format, served on GET /metrics
+    def render(self):
+        lines = ["# HELP useapi_stage_seconds Time spent in each pipeline stage", "# TYPE useapi_stage_seconds histogram"]
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",api="{api}"'
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram["counts"]):
+                    total += count
+                    lines.append(f'useapi_stage_seconds_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f"useapi_stage_seconds_sum{{{labels}}} {histogram['sum']:.6f}")
+                lines.append(f"useapi_stage_seconds_count{{{labels}}} {total}")
+        lines.append("# HELP useapi_elapsed_seconds Time since the run started")
+        lines.append("# TYPE useapi_elapsed_seconds gauge")
+        lines.append(f"useapi_elapsed_seconds {time.time() - self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    # End-of-run summary: per stage how often it ran, the time it took in total, p50 / p99 / max
+    def summary(self):
+        lines = [f"{'stage':<10} {'api':<12} {'count':>8} {'total':>10} {'p50':>8} {'p99':>8} {'max':>8}"]
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                lines.append(
+                    f"{stage:<10} {api:<12} {sum(histogram['counts']):>8} {histogram['sum']:>9.1f}s"
+                    f" {self.quantile(histogram, 0.5):>7.2f}s {self.quantile(histogram, 0.99):>7.2f}s {histogram['max']:>7.2f}s"
+                )
+        elapsed = datetime.datetime.utcfromtimestamp(time.time() - self.started).strftime("%H:%M:%S")
+        lines.append(f"total elapsed time {elapsed}")
+        return lines
 
-# https://github.com/ngrok/ngrok-python
-listener = ngrok.forward(8081, authtoken_from_env=True)
 
-print(f"Webhook {listener.url()}")
+metrics = StageMetrics()
 
 
-# Simple async query management
+# Long-lived scheduler on the event loop: up to concurrency queued functions run at the same time.
+# Waiting functions are kept in one deque per priority (lower runs first), and enqueue() waits while
+# maxPending functions are already waiting, so producers slow down instead of piling up work.
+# A function that raises runs again after a pause, at most stageAttempts times; then onError(error, *args) is
+# awaited, like a Downloader callback receives None for a failed download.
 class AsyncFunctionQueue:
-    def __init__(self):
-        self.queue = []
-        self.is_function_running = False
+    def __init__(self, name, concurrency=1, maxPending=1000):
+        self.name = name
+        self.concurrency = concurrency
+        self.queues = {}  # priority → deque of (fn, args, onError, attempts, time queued)
+        self.items = asyncio.Semaphore(0)
+        self.space = asyncio.Semaphore(maxPending)
+        self.workers = []
+
+    async def enqueue(self, fn, *args, priority=0, onError=None):
+        await self.space.acquire()
+        self.queues.setdefault(priority, deque()).append((fn, args, onError, 0, time.time()))
+        self.items.release()
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    async def work(self):
+        while True:
+            await self.items.acquire()
+            priority = min(priority for priority, queue in self.queues.items() if queue)
+            item = self.queues[priority].popleft()
+            self.space.release()
+
+            fn, args, onError, attempts, queued = item
+            metrics.observe("queue", time.time() - queued, self.name)
+            try:
+                await fn(*args)
+            except Exception as error:
+                print("An error occurred:", error)
+                if attempts + 1 < stageAttempts:
+                    retry = (fn, args, onError, attempts + 1, time.time())
+                    asyncio.get_running_loop().call_later(stageRetrySecs * 2 ** attempts, self.retry, priority, retry)
+                elif onError:
+                    try:
+                        await onError(error, *args)
+                    except Exception as error:
+                        print("An error occurred:", error)
+
+    # Back at the head of its queue once the pause after a failed attempt is over
+    def retry(self, priority, item):
+        self.queues[priority].appendleft(item)
+        self.items.release()
+
+
+# Bounds the open files and upload bandwidth of concurrent uploads, see maxUploads
+uploadSlots = asyncio.Semaphore(maxUploads)
+
+
+# Spreads jobs over the configured Midjourney channels / PixVerse accounts: every job goes to the least loaded one
+# with free capacity and holds a slot there until its terminal webhook. A channel that answers 596 (pending
+# moderation / CAPTCHA) is out of rotation until it is reset. With nothing configured the API selects the channel.
+class ChannelPool:
+    def __init__(self, kind, spec, capacity):
+        self.kind = kind
+        self.capacity = {}  # name → jobs it runs at the same time, from "name:jobs,…"
+        for entry in spec.split(","):
+            name, _, size = entry.strip().partition(":")
+            if name:
+                self.capacity[name] = int(size or capacity)
+        self.inFlight = dict.fromkeys(self.capacity, 0)
+        self.disabled = set()
+        self.jobs = {}  # jobid / video_id → name, see started()
+        self.changed = asyncio.Condition()
+
+    # Wait for a slot on the least loaded channel in rotation, or on name when the job must run there (e.g. an
+    # upscale of a job on that channel). Returns None when every channel is out of rotation: the API selects one.
+    async def acquire(self, name=None):
+        if not self.capacity or (name and name not in self.capacity):
+            return name
+        async with self.changed:
+            while True:
+                names = [name] if name else [n for n in self.capacity if n not in self.disabled]
+                if not names:
+                    return None
+                best = min(names, key=lambda n: self.inFlight[n] / self.capacity[n])
+                if self.inFlight[best] < self.capacity[best] or best in self.disabled:
+                    self.inFlight[best] += 1
+                    return best
+                await self.changed.wait()
+
+    # Give the slot back: the job was not accepted, or it reached a terminal state
+    async def release(self, name):
+        if name in self.inFlight:
+            async with self.changed:
+                self.inFlight[name] -= 1
+                self.changed.notify_all()
+
+    # The job was accepted: it holds its slot until finished() sees its terminal state
+    def started(self, ref, name):
+        if name in self.inFlight:
+            self.jobs[ref] = name
+
+    async def finished(self, ref):
+        await self.release(self.jobs.pop(ref, None))
+
+    # 596 — pending moderation / CAPTCHA: resolve it in Discord, then POST /accounts/{channel}/reset
+    async def disable(self, name):
+        if name in self.capacity and name not in self.disabled:
+            self.disabled.add(name)
+            print(f"{dateAsString()} ⁝ {self.kind} {name} out of rotation until it is reset")
+        await self.release(name)
+
+    async def enable(self, name):
+        async with self.changed:
+            self.disabled.discard(name)
+            self.changed.notify_all()
+        print(f"{dateAsString()} ⁝ {self.kind} {name} back in rotation")
+
+    def __str__(self):
+        return f"{self.kind} " + ", ".join(
+            f"{n} {self.inFlight[n]}/{self.capacity[n]}" + (" out of rotation" if n in self.disabled else "") for n in self.capacity
+        )
 
-    def enqueue(self, fn, *args):
-        self.queue.append((fn, args))
-        asyncio.run(self.process_queue())
 
-    async def process_queue(self):
-        if self.is_function_running or len(self.queue) == 0:
+midjourneyChannels = ChannelPool("midjourney", channels, channelCapacity)
+pixverseAccounts = ChannelPool("pixverse", pixverse_emails, accountCapacity)
+
+
+# AIMD rate controller for one API (per channel / account when one is pinned). It learns how many requests
+# can be in flight: every accepted request raises limit by 1/limit, every 429 halves it and pauses new requests
+# for Retry-After, or a jittered exponential backoff when the header is missing.
+class RateController:
+    def __init__(self, name, maxLimit):
+        self.name = name
+        self.limit = 1.0
+        self.maxLimit = maxLimit
+        self.inFlight = 0
+        self.failures = 0  # consecutive 429s
+        self.resumeAt = 0  # no request starts before this time while backing off
+        self.changed = asyncio.Condition()
+
+    # Wait for a free slot, then count the request in flight
+    async def acquire(self):
+        async with self.changed:
+            while True:
+                wait = self.resumeAt - time.time()
+                if wait <= 0 and self.inFlight < int(self.limit):
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout=wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            self.inFlight += 1
+
+    # Learn from the outcome of a request: statusCode is None when it never got a response
+    async def release(self, statusCode, retryAfter=None):
+        async with self.changed:
+            self.inFlight -= 1
+            if statusCode == 429:
+                self.failures += 1
+                self.limit = max(1.0, self.limit / 2)
+                delay = retryAfterSecs(retryAfter) or min(backoffSecs * 2 ** (self.failures - 1), maxBackoffSecs)
+                delay *= random.uniform(1, 1.5)  # spread out workers that hit 429 together
+                self.resumeAt = max(self.resumeAt, time.time() + delay)
+                print(f"{dateAsString()} ⁝ {self}, backing off {delay:.1f}s")
+            elif statusCode is not None and statusCode < 400:
+                self.failures = 0
+                self.limit = min(float(self.maxLimit), self.limit + 1 / self.limit)
+            self.changed.notify_all()
+
+    def __str__(self):
+        return f"{self.name} limit {self.limit:.1f}, in flight {self.inFlight}"
+
+
+# Retry-After is either seconds or an HTTP date
+def retryAfterSecs(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+rateControllers = {}  # (api, channel / account) → RateController
+
+
+# The rate controller shared by every request to api, per channel / account when one is pinned
+def rateController(api, account=None):
+    key = (api, account)
+    if key not in rateControllers:
+        rateControllers[key] = RateController(f"{api} {account}" if account else api, maxConcurrency[api])
+    return rateControllers[key]
+
+
+# Counts pending jobs per pipeline stage. Updated on every state transition, so checking
+# progress or completion is O(1); done is set as soon as the last job completes after close().
+class JobTracker:
+    def __init__(self):
+        self.pending = 0
+        self.stages = {}
+        self.entries = {}  # data key → pending jobs of that entry
+        self.finished = deque()  # keys of entries whose last pending job completed, see retireFinished()
+        self.freed = asyncio.Event()  # set whenever an entry finishes
+        self.closed = False
+        self.done = asyncio.Event()
+
+    # Register a new pending job at its first stage
+    def add(self, node, stage):
+        node["stage"] = stage
+        self.stages[stage] = self.stages.get(stage, 0) + 1
+        self.entries[node["key"]] = self.entries.get(node["key"], 0) + 1
+        self.pending += 1
+        self.done.clear()
+
+    # Move a pending job on to the next stage
+    def advance(self, node, stage):
+        if node.get("completed") is not False:
             return
+        self.stages[node["stage"]] -= 1
+        node["stage"] = stage
+        self.stages[stage] = self.stages.get(stage, 0) + 1
 
-        self.is_function_running = True
-        try:
-            item = self.queue[0]
-            fn, args = item
-            result = await fn(*args)
-            if result == "retry":
-                print("Will retry:", fn, args)
-            else:
-                self.queue.remove(item)
-        except Exception as error:
-            print("An error occurred:", error)
-        finally:
-            self.is_function_running = False
+    # Mark a pending job completed, whatever stage it reached
+    def complete(self, node):
+        if node.get("completed") is not False:
+            return
+        node["completed"] = True
+        self.stages[node["stage"]] -= 1
+        self.entries[node["key"]] -= 1
+        if not self.entries[node["key"]]:
+            del self.entries[node["key"]]
+            self.finished.append(node["key"])
+            self.freed.set()
+        self.pending -= 1
+        print(f"{dateAsString()} ⁝ {self}")
+        if self.pending == 0 and self.closed:
+            self.done.set()
 
-        await self.process_queue()
+    # No more jobs will be added: every prompt was read
+    def close(self):
+        self.closed = True
+        if self.pending == 0:
+            self.done.set()
 
+    def __str__(self):
+        stages = ", ".join(f"{stage}: {count}" for stage, count in self.stages.items())
+        return f"pending {self.pending} ({stages})"
 
-# Create async queries
-queueMidjourney = AsyncFunctionQueue()
-queuePixVerse = AsyncFunctionQueue()
+
+# Pending U1-U4 leaves per stage: imagine → upscale → pixverse
+tracker = JobTracker()
 
 
 def dateAsString():
     return datetime.datetime.now().isoformat()
 
 
+# Write JSON to a temp file and atomically rename it, so filePath is never left half-written
 def saveToFile(filePath, data):
     try:
-        with open(filePath, "w") as file:
+        tmpPath = f"{filePath}.tmp"
+        with metrics.timer("save"), open(tmpPath, "w") as file:
             json.dump(data, file, indent=2)
+        os.replace(tmpPath, filePath)
+        return True
     except Exception as error:
         print(f"Error writing to file: {error}")
+        return False
 
 
 def loadFromFile(filePath):
@@ -121,6 +520,200 @@ def loadFromFile(filePath):
     sys.exit(1)
 
 
+# Append-only journal of state changes. Each change appends the changed entry as one JSON line
+# to result.jsonl instead of rewriting the whole result.json. Every compactEvery records the
+# journal is compacted into a fresh result.json snapshot (temp file + atomic rename) and truncated.
+# Finished entries are retired to result.done.jsonl, so snapshots only hold the entries still in memory.
+class Journal:
+    def __init__(self, filePath, data):
+        self.filePath = filePath
+        self.journalPath = journalPathFor(filePath)
+        self.donePath = donePathFor(filePath)
+        self.data = data
+        self.records = 0
+        self.retired = 0
+        self.file = open(self.journalPath, "a")
+        self.doneFile = open(self.donePath, "a")
+
+    # Journal the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer("journal"):
+            self.file.write(json.dumps({"key": key, "value": self.data[key]}) + "\n")
+            self.file.flush()
+        self.records += 1
+        if self.records >= compactEvery:
+            self.compact()
+
+    # Move the finished data[key] out of memory: its final state is appended to result.done.jsonl
+    def retire(self, key):
+        with metrics.timer("journal"):
+            self.doneFile.write(json.dumps({"key": key, "value": self.data.pop(key)}) + "\n")
+            self.doneFile.flush()
+        self.retired += 1
+
+    # Snapshot data to result.json, then start a fresh journal
+    def compact(self):
+        if saveToFile(self.filePath, self.data):
+            self.file.close()
+            self.file = open(self.journalPath, "w")
+            self.records = 0
+            # Until the first retire() the snapshot holds every entry, result.done.jsonl ones included
+            if not self.retired:
+                self.doneFile.close()
+                self.doneFile = open(self.donePath, "w")
+
+    # Final result.json of the run: every entry, the ones retired to result.done.jsonl included, like --compact
+    def finish(self):
+        self.data.update({**loadJournal(self.filePath), **self.data})
+        self.retired = 0  # the snapshot holds the retired entries again
+        self.compact()
+
+
+def journalPathFor(filePath):
+    return os.path.splitext(filePath)[0] + ".jsonl"
+
+
+def donePathFor(filePath):
+    return os.path.splitext(filePath)[0] + ".done.jsonl"
+
+
+# Rebuild state from the last result.json snapshot replayed with every change journaled after it,
+# then with the final state of every entry retired since
+def loadJournal(filePath):
+    data = {}
+    if os.path.exists(filePath):
+        data = loadFromFile(filePath)
+    for path in (journalPathFor(filePath), donePathFor(filePath)):
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+                    data[record["key"]] = record["value"]
+    return data
+
+
+# SQLite job store in WAL mode, kept in result.db instead of result.json / result.jsonl with --sqlite. It has the
+# interface of Journal: save() upserts the entry into the jobs table and its nodes into stages / artefacts, indexed
+# by jobid, replyRef and status, so another process can query a run while it goes on, see printProgress().
+# retire() marks a finished entry done and drops it from memory. Nothing is ever rewritten whole.
+class JobStore:
+    def __init__(self, filePath, data, resume):
+        self.data = data
+        self.db = openJobStore(filePath)
+        if resume:
+            # Entries finished in an earlier run are already stored with their final state
+            self.done = {key for key, in self.db.execute("SELECT key FROM jobs WHERE done = 1")}
+        else:
+            self.done = set()
+            with self.db:
+                for table in ("jobs", "stages", "artefacts"):
+                    self.db.execute(f"DELETE FROM {table}")
+
+    # Store the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer("journal"):
+            self.write(key, self.data[key], False)
+
+    # Move the finished data[key] out of memory: it stays in the store, marked done
+    def retire(self, key):
+        value = self.data.pop(key)
+        if key in self.done:
+            return
+        with metrics.timer("journal"):
+            self.write(key, value, True)
+
+    # One transaction per entry: the entry itself, then every node of it (stage, status, files)
+    def write(self, key, value, done):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO jobs (key, value, done, updated) VALUES (?, ?, ?, ?)", (key, json.dumps(value), int(done), time.time()))
+            for node, jobid, replyRef, stage, status, files in nodesOf(value):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO stages (key, node, jobid, replyRef, stage, status) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, node, jobid, replyRef, stage, status),
+                )
+                for kind, path in files.items():
+                    if path:
+                        self.db.execute("INSERT OR REPLACE INTO artefacts (path, key, node, kind) VALUES (?, ?, ?, ?)", (path, key, node, kind))
+
+    # The store is never snapshotted, only the WAL is folded back into result.db
+    def compact(self):
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # result.db already holds every entry, finished ones included
+    def finish(self):
+        self.compact()
+
+
+def openJobStore(filePath):
+    db = sqlite3.connect(filePath, check_same_thread=False)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")  # a commit is durable once the WAL is checkpointed, never corrupt
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (key PRIMARY KEY, value TEXT NOT NULL, done INTEGER NOT NULL, updated REAL);
+        CREATE TABLE IF NOT EXISTS stages (key, node TEXT, jobid TEXT, replyRef TEXT, stage TEXT, status TEXT, PRIMARY KEY (key, node));
+        CREATE TABLE IF NOT EXISTS artefacts (path TEXT PRIMARY KEY, key, node TEXT, kind TEXT);
+        CREATE INDEX IF NOT EXISTS jobs_done ON jobs (done);
+        CREATE INDEX IF NOT EXISTS stages_jobid ON stages (jobid);
+        CREATE INDEX IF NOT EXISTS stages_replyRef ON stages (replyRef);
+        CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status);
+        CREATE INDEX IF NOT EXISTS artefacts_key ON artefacts (key);
+        """
+    )
+    return db
+
+
+# Every entry in result.db, like loadJournal()
+def loadJobStore(filePath):
+    return {key: json.loads(value) for key, value in openJobStore(filePath).execute("SELECT key, value FROM jobs")}
+
+
+# python3 ./example.py --progress prints how far the run stored in result.db got, also while it is still running
+def printProgress(filePath):
+    if not os.path.exists(filePath):
+        print(f"{dateAsString()} ⁝ {filePath} not found, start the run with --sqlite")
+        return
+    db = sqlite3.connect(f"file:{filePath}?mode=ro", uri=True)
+    total, done = db.execute("SELECT COUNT(*), COALESCE(SUM(done), 0) FROM jobs").fetchone()
+    print(f"{dateAsString()} ⁝ prompts: {total}, finished: {done}")
+    for stage, status, count in db.execute("SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status ORDER BY stage, status"):
+        print(f"{dateAsString()} ⁝ {stage} {status}: {count}")
+    for kind, count in db.execute("SELECT kind, COUNT(*) FROM artefacts GROUP BY kind ORDER BY kind"):
+        print(f"{dateAsString()} ⁝ {kind} files: {count}")
+
+
+# Read prompts one at a time instead of loading the whole file: .jsonl holds one JSON string or {"prompt": …}
+# object per line, .csv a prompt column; a .json array is still loaded at once
+def readPrompts(filePath):
+    if filePath.endswith(".json"):
+        return iter(loadFromFile(filePath))
+    try:
+        file = open(filePath, "r", newline="")
+    except OSError as error:
+        print(f"Unable to load file: {filePath}. Error: {error}")
+        sys.exit(1)
+
+    def lines():
+        with file:
+            if filePath.endswith(".csv"):
+                for row in csv.DictReader(file):
+                    yield row["prompt"]
+            else:
+                for line in file:
+                    if line.strip():
+                        prompt = json.loads(line)
+                        yield prompt["prompt"] if isinstance(prompt, dict) else prompt
+
+    return lines()
+
+
 # Extract filename.png from https://cdn.discordapp.com/attachments/server_id/channel_id/filename.png?ex=
 def getFilenameFromUrl(url):
     return url.split("/")[-1].split("?")[0]
@@ -131,76 +724,300 @@ def contentTypeForFile(fileName):
     return {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "gif": "image/gif", "webp": "image/webp"}.get(ext, "image/png")
 
 
-def downloadFile(url, prefix):
-    localPath = f"./{prefix}-{getFilenameFromUrl(url)}"
-    response = requests.get(url)
-    with open(localPath, "wb") as file:
-        file.write(response.content)
-    return localPath
-
-
-# Recursively traverses the job data structure to find a job by its jobid.
-def findByJobid(jobid, json_object):
-    if isinstance(json_object, dict):
-        for key, value in json_object.items():
-            if key == "jobid" and value == jobid:
-                return json_object
-            elif isinstance(value, dict):
-                result = findByJobid(jobid, value)
-                if result is not None:
-                    return result
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        result = findByJobid(jobid, item)
-                        if result is not None:
-                            return result
-    return None
-
-
-# Checks whether there are more jobs to run by looking for a job with 'completed' = False.
-def hasMoreJobsToRun(json_object):
-    if isinstance(json_object, dict):
-        for key, value in json_object.items():
-            if key == "completed" and not value:
-                return True
-            elif isinstance(value, dict) or isinstance(value, list):
-                if hasMoreJobsToRun(value):
-                    return True
-    elif isinstance(json_object, list):
-        for item in json_object:
-            if isinstance(item, dict) or isinstance(item, list):
-                if hasMoreJobsToRun(item):
-                    return True
-    return False
+# Stream url to localPath in chunks through a temp file and atomic rename. Returns bytes fetched and seconds taken.
+# Files already downloaded are skipped, an interrupted download resumes from its .part file with a Range request,
+# and content identical to a file already on disk is stored once, see Manifest.
+def downloadFile(url, localPath):
+    key = url.split("?")[0]  # CDN urls carry expiring signatures in the query string
+
+    # The same url downloaded before, possibly under another name
+    existingPath = manifest.findUrl(key)
+    if existingPath:
+        linkFile(existingPath, localPath)
+        print(f"{dateAsString()} ⁝ {localPath} already downloaded, skipping")
+        return 0, 0
+
+    started = time.time()
+    tmpPath = f"{localPath}.part"
+    offset = os.path.getsize(tmpPath) if os.path.exists(tmpPath) else 0
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    record = manifest.get(localPath)
+    if record and record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+
+    sha256 = hashlib.sha256()
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:  # Not Modified — localPath matches the ETag we recorded for it
+            print(f"{dateAsString()} ⁝ {localPath} not modified, skipping")
+            return 0, 0
+        if response.status_code == 416:  # Range Not Satisfiable — the partial file is stale, start over
+            os.remove(tmpPath)
+            return downloadFile(url, localPath)
+        response.raise_for_status()
+
+        if response.status_code == 206 and response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            # Resume the partial file of an interrupted download; hash what is already on disk first
+            with open(tmpPath, "rb") as file:
+                for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+                    sha256.update(chunk)
+            mode = "ab"
+        else:
+            offset = 0
+            mode = "wb"
+
+        size = offset
+        with open(tmpPath, mode) as file:
+            for chunk in response.iter_content(chunk_size=downloadChunkSize):
+                file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        etag = response.headers.get("ETag")
+
+    digest = sha256.hexdigest()
+    existingPath = manifest.findHash(digest)
+    if existingPath and existingPath != localPath:
+        # Identical media is already on disk under another name
+        os.remove(tmpPath)
+        linkFile(existingPath, localPath)
+    else:
+        os.replace(tmpPath, localPath)
+    manifest.add({"path": localPath, "url": key, "size": size, "etag": etag, "sha256": digest})
+
+    fetched = size - offset
+    secs = max(time.time() - started, 0.001)
+    resumedFrom = f", resumed at {offset / 1048576:.1f} MB" if offset else ""
+    print(f"{dateAsString()} ⁝ downloaded {localPath} {fetched / 1048576:.1f} MB in {secs:.1f}s, {fetched / secs / 1048576:.1f} MB/s{resumedFrom}")
+    return fetched, secs
+
+
+# Store identical media once: localPath becomes a hard link to the copy already on disk
+def linkFile(existingPath, localPath):
+    if os.path.exists(localPath):
+        if os.path.samefile(existingPath, localPath):
+            return
+        os.remove(localPath)
+    try:
+        os.link(existingPath, localPath)
+    except OSError:
+        shutil.copyfile(existingPath, localPath)  # file system without hard links
+
+
+# Content-hash manifest of downloaded media, appended to downloads.jsonl as one JSON line per file.
+# Lets reruns skip files already on disk and finds identical media by url or sha256.
+class Manifest:
+    def __init__(self, filePath):
+        self.paths = {}  # localPath → record
+        self.urls = {}  # url without query string → localPath
+        self.hashes = {}  # sha256 → localPath
+        self.lock = threading.Lock()
+        if os.path.exists(filePath):
+            with open(filePath, "r") as file:
+                for line in file:
+                    try:
+                        self.index(json.loads(line))
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+        self.file = open(filePath, "a")
+
+    def index(self, record):
+        self.paths[record["path"]] = record
+        self.urls[record["url"]] = record["path"]
+        self.hashes[record["sha256"]] = record["path"]
+
+    # Path of the file downloaded from url, if still intact on disk
+    def findUrl(self, url):
+        return self.intact(self.urls.get(url))
+
+    # Path of a file with this content, if still intact on disk
+    def findHash(self, sha256):
+        return self.intact(self.hashes.get(sha256))
+
+    # Record of localPath, if the file on disk still matches it
+    def get(self, localPath):
+        return self.paths[localPath] if self.intact(localPath) else None
+
+    def intact(self, path):
+        record = self.paths.get(path)
+        if record and os.path.exists(path) and os.path.getsize(path) == record["size"]:
+            return path
+        return None
+
+    def add(self, record):
+        with self.lock:
+            self.index(record)
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+
+# Paths of images already uploaded with PixVerse POST /files, by account and sha256 of their content, so identical
+# images are uploaded once and the path is reused by every videos/create until it expires. Persisted to uploads.jsonl.
+class UploadCache:
+    def __init__(self, filePath):
+        self.paths = {}  # (account, sha256) → record
+        self.uploading = {}  # (account, sha256) → event set once the upload in progress finished
+        self.hashes = {}  # (localPath, size, mtime) → sha256 of files not in the downloads manifest
+        if os.path.exists(filePath):
+            with open(filePath, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+                    self.paths[(record["account"], record["sha256"])] = record
+        self.file = open(filePath, "a")
+
+    # Path of this content uploaded to account, unless it expired
+    def get(self, account, sha256):
+        record = self.paths.get((account, sha256))
+        if record and record["expires"] > time.time():
+            return record["path"]
+        return None
+
+    def add(self, account, sha256, path):
+        record = {"account": account, "sha256": sha256, "path": path, "expires": time.time() + uploadTtlSecs}
+        self.paths[(account, sha256)] = record
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    # sha256 of a local file: taken from the downloads manifest when it was downloaded, otherwise hashed once
+    def hash(self, localPath):
+        record = manifest.get(localPath)
+        if record:
+            return record["sha256"]
+        stat = os.stat(localPath)
+        key = (localPath, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            sha256 = hashlib.sha256()
+            with open(localPath, "rb") as file:
+                for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+                    sha256.update(chunk)
+            self.hashes[key] = sha256.hexdigest()
+        return self.hashes[key]
+
+
+# Bounded pool of download threads, so webhook handling never waits on a large file. Once a file is in place
+# fn(localPath, *args) is awaited on the event loop, which owns data and the journal (localPath is None on failure).
+class Downloader:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.active = {}  # localPath → download task
+        self.files = 0
+        self.bytes = 0
+        self.secs = 0
+
+    def submit(self, url, localPath, fn, *args):
+        # A duplicate webhook for a file that is already downloading is ignored
+        if localPath in self.active:
+            return
+        self.active[localPath] = asyncio.create_task(self.fetch(url, localPath, fn, args))
+
+    async def fetch(self, url, localPath, fn, args):
+        try:
+            size, secs = await asyncio.get_running_loop().run_in_executor(self.pool, downloadFile, url, localPath)
+        except Exception as error:
+            print(f"{dateAsString()} ⁝ download {url} failed: {error}")
+            size, secs = None, 0
+        del self.active[localPath]
+        if size is not None:
+            self.files += 1
+            self.bytes += size
+            self.secs += secs
+            metrics.observe("download", secs)
+        try:
+            await fn(localPath if size is not None else None, *args)
+        except Exception as error:
+            print("An error occurred:", error)
+
+    def __str__(self):
+        rate = self.bytes / max(self.secs, 0.001) / 1048576
+        return f"downloaded {self.files} files, {self.bytes / 1048576:.1f} MB, {rate:.1f} MB/s per download"
+
+
+# Register a data node under its jobid so webhook callbacks (Midjourney jobid, FaceSwap / PixVerse replyRef)
+# can be dispatched to it in constant time.
+def indexJob(jobid, node):
+    if jobid:
+        jobs[jobid] = node
+
+
+# Separate session for --stream: a followed job holds its connection until the job ends, so streams must not
+# count against the pooled connections shared by the other API calls and downloads
+def getStreamSession():
+    global stream_session
+    if stream_session is None or stream_session.closed:
+        stream_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=None))
+    return stream_session
+
+
+# POST a Midjourney job with stream: true. Returns the HTTP status, Retry-After, the first job state and the rest of
+# the server-sent events, or None in their place when the API answered with plain JSON (e.g. 429 / 596)
+async def postStream(url, body):
+    response = await getStreamSession().post(url, headers=jsonHeaders, json=body)
+    if response.content_type != "text/event-stream":
+        async with response:
+            return response.status, response.headers.get("Retry-After"), await response.json(), None
+    events = readEvents(response)
+    # An event stream means the job was created, reported as 201 like the JSON response
+    return 201, None, await events.__anext__(), events
+
+
+# Server-sent events of a streamed job: every "data:" line carries the job state as JSON
+async def readEvents(response):
+    async with response:
+        async for line in response.content:
+            line = line.decode().strip()
+            if line.startswith("data:"):
+                yield json.loads(line[5:])
+
+
+# Handle every further event of a streamed job like its webhook. A job whose stream ends early is polled instead
+async def followStream(jobid, events):
+    job = {}
+    try:
+        async for job in events:
+            await processJob(job)
+    except Exception as error:
+        print(f"{dateAsString()} ⁝ stream {jobid} failed:", error)
+    if job.get("status") not in ("completed", "moderated", "failed", "cancelled"):
+        polled[jobid] = (f"{rootMidjourneyUrl}/jobs/{jobid}", {"jobid": jobid})
 
 
 # POST a JSON payload to Midjourney v3 or PixVerse v2. Retries on 429 (busy/at capacity).
-async def submit_payload(url, params, body, is_pixverse=False):
+async def submit_payload(url, params, body, is_pixverse=False, account=None):
     global submitted
 
     while True:
-        response = None
+        status_code = retryAfter = job = events = None
         retry_count = 0
-        # On a slow connection the POST may fail, so retry up to 3 times
-        while retry_count < 3:
-            try:
-                response = requests.post(
-                    url,
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Content-Type": "application/json",
-                    },
-                    json=body,
-                )
-                break
-            except requests.RequestException as ex:
-                print(f"fetch {url} failed #{retry_count}", ex)
-                if retry_count > 1:
-                    raise
-                retry_count += 1
-
-        job = response.json()
+        pool = pixverseAccounts if is_pixverse else midjourneyChannels
+        controller = rateController("pixverse" if is_pixverse else "midjourney", account)
+        await controller.acquire()
+        try:
+            # On a slow connection the POST may fail, so retry up to 3 times
+            while retry_count < 3:
+                try:
+                    with metrics.timer("submit", "pixverse" if is_pixverse else "midjourney"):
+                        if body.get("stream"):
+                            status_code, retryAfter, job, events = await postStream(url, body)
+                        else:
+                            # requests is blocking, so the call runs on a thread to keep the webhook receiver responsive
+                            response = await asyncio.to_thread(session.post, url, headers=jsonHeaders, json=body)
+                            status_code, retryAfter, job = response.status_code, response.headers.get("Retry-After"), response.json()
+                    break
+                except (requests.RequestException, aiohttp.ClientError) as ex:
+                    print(f"fetch {url} failed #{retry_count}", ex)
+                    if retry_count > 1:
+                        raise
+                    retry_count += 1
+        except Exception:
+            await controller.release(None)
+            # A failed create runs again on the account slot its upload took, see failCreate()
+            if not is_pixverse:
+                await pool.release(account)
+            raise
+        await controller.release(status_code, retryAfter)
 
         jobid = job.get("jobid")
         video_id = job.get("video_id")
@@ -210,13 +1027,13 @@ async def submit_payload(url, params, body, is_pixverse=False):
         verb = job.get("verb")
 
         print(
-            f"{dateAsString()} ⁝ #{submitted} {verb or url} HTTP {response.status_code}",
+            f"{dateAsString()} ⁝ #{submitted} {verb or url} HTTP {status_code}",
             {jobid, video_id, status, error, errorDetails},
         )
 
         # 429 — Midjourney channel busy / all PixVerse accounts at capacity: wait and retry
-        if response.status_code == 429:
-            await asyncio.sleep(10)
+        if status_code == 429:
+            # the rate controller already backs off before the retry
             continue
 
         if is_pixverse:
@@ -224,31 +1041,49 @@ async def submit_payload(url, params, body, is_pixverse=False):
                 **params.get("pixverse", {}),
                 "video_id": video_id,
                 "status": status,
-                "code": response.status_code,
+                "code": status_code,
                 "error": error or errorDetails,
             }
             # If PixVerse failed to accept the job, no webhook will arrive
-            if response.status_code != 200 and params.get("completed") is False:
-                params["completed"] = True
+            if status_code != 200:
+                tracker.complete(params)
+            elif not webhookUrl:
+                # No webhook with --stream, so the video is polled
+                polled[params["jobid"]] = (f"{rootPixVerseUrl}/videos/{video_id}", {"video_id": video_id, "replyRef": params["jobid"]})
         else:
             params["jobid"] = jobid
+            indexJob(jobid, params)
             params["status"] = status
-            params["code"] = response.status_code
+            params["code"] = status_code
             if error:
                 params["error"] = error
             if errorDetails:
                 params["errorDetails"] = errorDetails
             # Midjourney rejected the job (596 moderation / 4xx) — mark downstream done so we don't hang
-            if response.status_code != 201:
+            if status_code != 201:
                 if "buttons" in params:
                     for _b, v in params["buttons"].items():
                         if not _b.startswith("_"):
-                            v["completed"] = True
-                elif params.get("completed") is False:
-                    params["completed"] = True
+                            tracker.complete(v)
+                else:
+                    tracker.complete(params)
+
+        # An accepted job holds its channel / account slot until its terminal webhook, see processJob()
+        if status_code == (200 if is_pixverse else 201):
+            pool.started(video_id if is_pixverse else jobid, account)
+            metrics.begin(video_id if is_pixverse else jobid)
+        elif status_code == 596:
+            await pool.disable(account)
+        else:
+            await pool.release(account)
 
-        saveToFile("./result.json", data)
+        journal.save(params["key"])
         submitted += 1
+
+        if events:
+            task = asyncio.create_task(followStream(jobid, events))
+            streams.add(task)
+            task.add_done_callback(streams.discard)
         return job
 
 
@@ -256,9 +1091,17 @@ async def submit_payload(url, params, body, is_pixverse=False):
 async def post_midjourney_button(button, parent_jobid, params):
     button = button.split("-")[0]
 
-    body = {"jobId": parent_jobid, "button": button, "stream": False, "replyUrl": listener.url()}
+    body = {"jobId": parent_jobid, "button": button, "stream": streaming}
+    if webhookUrl:
+        body["replyUrl"] = webhookUrl
+
+    # Upscales run on the channel of the imagine job
+    account = data[params["key"]].get("channel")
+    if account:
+        account = await midjourneyChannels.acquire(account)
+        params["channel"] = account
 
-    return await submit_payload(f"{rootMidjourneyUrl}/jobs/button", params, body)
+    return await submit_payload(f"{rootMidjourneyUrl}/jobs/button", params, body, account=account)
 
 
 # Execute a Midjourney API v3 jobs/imagine, see https://useapi.net/docs/api-midjourney-v3/post-midjourney-jobs-imagine
@@ -267,194 +1110,623 @@ async def post_midjourney(verb, params):
 
     verb = verb.split("-")[0]
 
-    body = {"stream": False, "replyUrl": listener.url()}
+    body = {"stream": streaming}
+    if webhookUrl:
+        body["replyUrl"] = webhookUrl
 
-    if channel:  # optional in v3
-        body["channel"] = channel
+    # channel is optional in v3, the API selects one when omitted
+    account = await midjourneyChannels.acquire()
+    if account:
+        body["channel"] = account
+        params["channel"] = account
 
     if prompt:
         body["prompt"] = f"{prompt} {promptParams}".strip()
 
-    return await submit_payload(f"{rootMidjourneyUrl}/jobs/{verb}", params, body)
+    return await submit_payload(f"{rootMidjourneyUrl}/jobs/{verb}", params, body, account=account)
 
 
-# Animate an image with PixVerse image-to-video (create-v4):
-#   1. Upload the local image via POST /files            -> returns result[0]["path"]
-#   2. POST /videos/create with first_frame_path + prompt (i2v) + replyUrl
-# See https://useapi.net/docs/api-pixverse-v2/post-pixverse-videos-create-v4
-# params["jobid"] (the upscale job id) is passed as replyRef so the PixVerse
-# callback can be mapped back to this node via findByJobid().
-async def post_pixverse(params):
+# Upload a local image with PixVerse POST /files, or reuse the path of the same content already uploaded to account,
+# see UploadCache. Returns (path, response, HTTP status); path is None when the upload failed.
+async def uploadImage(fileName, account):
+    sha256 = await asyncio.to_thread(uploads.hash, fileName)
+    key = (account, sha256)
+
+    # Concurrent uploads of the same content wait for the first one and reuse its path
+    while key in uploads.uploading:
+        await uploads.uploading[key].wait()
+
+    path = uploads.get(account, sha256)
+    if path:
+        print(f"{dateAsString()} ⁝ pixverse upload cached", {path})
+        return path, {"result": [{"path": path}]}, 200
+
+    uploads.uploading[key] = asyncio.Event()
+    try:
+        upload_url = f"{rootPixVerseUrl}/files/"
+        if account:
+            upload_url += f"?email={account}"
+
+        # The file object is streamed in chunks as it is sent, never read into memory whole
+        async with uploadSlots:
+            with open(fileName, "rb") as image_file, metrics.timer("upload", "pixverse"):
+                upload_response = await asyncio.to_thread(
+                    session.post,
+                    upload_url,
+                    headers={**authHeaders, "Content-Type": contentTypeForFile(fileName)},
+                    data=image_file,
+                )
+        uploaded = upload_response.json()
+        result = uploaded.get("result") or []
+        path = result[0].get("path") if result else None
+
+        print(f"{dateAsString()} ⁝ pixverse upload HTTP {upload_response.status_code}", {path})
+
+        if path:
+            uploads.add(account, sha256, path)
+        return path, uploaded, upload_response.status_code
+    finally:
+        uploads.uploading.pop(key).set()
+
+
+# Animate an image with PixVerse image-to-video (create-v4), step 1: upload the local image via POST /files,
+# unless identical content was uploaded to this account before, and hand result[0]["path"] on to post_pixverse().
+async def upload_pixverse(params):
     imageFileName = params.get("imageFileName")
-    jobid = params.get("jobid")
 
     if not imageFileName:
-        params["completed"] = True
+        tracker.complete(params)
         return
 
-    # 1. Upload the image (raw bytes)
-    upload_url = f"{rootPixVerseUrl}/files/"
-    if pixverse_email:
-        upload_url += f"?email={pixverse_email}"
-
-    with open(imageFileName, "rb") as image_file:
-        upload_response = requests.post(
-            upload_url,
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": contentTypeForFile(imageFileName),
-            },
-            data=image_file.read(),
-        )
-    uploaded = upload_response.json()
-    result = uploaded.get("result") or []
-    path = result[0].get("path") if result else None
+    # The upload and the video it starts have to use the same account
+    account = await pixverseAccounts.acquire()
 
-    print(f"{dateAsString()} ⁝ pixverse upload HTTP {upload_response.status_code}", {path})
+    try:
+        path, uploaded, upload_status = await uploadImage(imageFileName, account)
+    except Exception:
+        await pixverseAccounts.release(account)
+        raise
 
     if not path:
         print("pixverse upload failed", uploaded)
-        params["completed"] = True
-        params["pixverse"] = {**params.get("pixverse", {}), "upload": uploaded, "code": upload_response.status_code}
-        saveToFile("./result.json", data)
+        await pixverseAccounts.release(account)
+        tracker.complete(params)
+        params["pixverse"] = {**params.get("pixverse", {}), "upload": uploaded, "code": upload_status}
+        journal.save(params["key"])
         return
 
-    # 2. Create the image-to-video job
+    await toStage("create", params, account, path)
+
+
+# Step 2: POST /videos/create with first_frame_path + prompt (i2v) + replyUrl on the account the image was uploaded to.
+# See https://useapi.net/docs/api-pixverse-v2/post-pixverse-videos-create-v4
+# params["jobid"] (the upscale job id) is passed as replyRef so the PixVerse
+# callback can be mapped back to this node via the jobs index.
+async def post_pixverse(params, account, path):
+    jobid = params.get("jobid")
+
     body = {
         "model": pixverse_model,
         "prompt": pixverse_prompt,
         "first_frame_path": path,
         "duration": pixverse_duration,
         "quality": pixverse_quality,
-        "replyUrl": listener.url(),
         "replyRef": jobid,  # map the PixVerse callback back to this node
     }
-    if pixverse_email:
-        body["email"] = pixverse_email
-
-    return await submit_payload(f"{rootPixVerseUrl}/videos/create", params, body, is_pixverse=True)
-
-
-# Webhook callback
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Hello from ngrok server")
-
-    def do_POST(self):
-        global data
-
-        content_length = int(self.headers["Content-Length"])
-        post_data = self.rfile.read(content_length)
-
-        job = json.loads(post_data.decode("utf-8"))
-
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(b"ok")
-
-        # PixVerse callbacks carry a video_id (and no Midjourney verb)
-        if job.get("video_id"):
-            replyRef = job.get("replyRef") or (job.get("response") or {}).get("replyRef")
-            completed = job.get("video_status_final") is True or job.get("video_status_name") == "COMPLETED"
-            failed = job.get("video_status_name") == "FAILED" or job.get("errCode")
-            url = job.get("url")
-
-            print(f"{dateAsString()} ⁝ webhook pixverse {job.get('video_id')} {job.get('video_status_name')}")
-
-            node = findByJobid(jobid=replyRef, json_object=data)
-            if node:
-                node["pixverse"] = {
-                    **node.get("pixverse", {}),
-                    "video_id": job.get("video_id"),
-                    "status": job.get("video_status_name"),
-                    "url": url,
-                }
-                if completed and url:
-                    node["pixverse"]["videoFileName"] = downloadFile(url, f"{replyRef}-pixverse")
-                if completed or failed:
-                    node["completed"] = True
-                saveToFile("./result.json", data)
-            return
+    if webhookUrl:
+        body["replyUrl"] = webhookUrl
+    if account:
+        body["email"] = account
 
-        # Midjourney callbacks — generated media is nested under job["response"]
-        jobid = job.get("jobid")
-        verb = job.get("verb")
-        status = job.get("status")
-        response = job.get("response") or {}
-        content = response.get("content") or ""
-        attachments = response.get("attachments")
-        url = attachments[0].get("url") if attachments else None
+    return await submit_payload(f"{rootPixVerseUrl}/videos/create", params, body, is_pixverse=True, account=account)
 
-        print(f"{dateAsString()} ⁝ webhook #{jobid} {verb} {status} {content[:20]}…{content[-20:] if content else ''}")
 
-        if status in ("completed", "moderated", "failed", "cancelled"):
-            node = findByJobid(jobid=jobid, json_object=data)
+# Pools of workers, one per API / resource, so a slow one (e.g. PixVerse at capacity) never holds up the others.
+# Downloads run in the thread pool of the downloader, see Downloader.
+pools = {
+    "midjourney": AsyncFunctionQueue("midjourney", concurrency=midjourneyConcurrency),
+    "upload": AsyncFunctionQueue("upload", concurrency=maxUploads),
+    "pixverse": AsyncFunctionQueue("pixverse", concurrency=pixverseConcurrency),
+}
 
-            if not node:
-                return
+# Give up on a node: record the error and complete it, or every leaf of an entry whose imagine job never finished
+def failNode(node, error):
+    node["error"] = str(error)
+    for leaf in leavesOf(node) if "buttons" in node else [node]:
+        tracker.complete(leaf)
+    journal.save(node["key"])
 
-            node["status"] = status
-            node["content"] = content
 
-            if status == "completed":
-                if "buttons" in node:
-                    # This is an imagine job — kick off the U1-U4 upscales
-                    for _button, value in node["buttons"].items():
-                        if not _button.startswith("_"):
-                            queueMidjourney.enqueue(post_midjourney_button, _button, jobid, value)
-                elif url:
-                    # This is an upscale (U1-U4) leaf — download it and animate via PixVerse
-                    node["imageFileName"] = downloadFile(url, jobid)
-                    queuePixVerse.enqueue(post_pixverse, node)
+# onError of the stage pools: the stage function kept raising for the node among its arguments
+async def failStage(error, *args):
+    failNode(next(arg for arg in args if isinstance(arg, dict)), error)
+
+
+# onError of the create stage: every attempt ran on the account slot the upload took, which is given back only now
+async def failCreate(error, params, account, path):
+    await pixverseAccounts.release(account)
+    failNode(params, error)
+
+
+# The pipeline as a graph of stages: stage → (function run for every item, pool, priority, onError once the function
+# kept raising). An item moves on to its next stage with toStage() as soon as it is ready:
+#   imagine → button (U1-U4) → download, see imageDownloaded() → upload → create → download, see videoDownloaded()
+# imagine and button share the Midjourney channels, new prompts wait behind the upscales of prompts already started.
+pipeline = {
+    "imagine": (post_midjourney, "midjourney", 1, failStage),
+    "button": (post_midjourney_button, "midjourney", 0, failStage),
+    "upload": (upload_pixverse, "upload", 0, failStage),
+    "create": (post_pixverse, "pixverse", 0, failCreate),
+}
+
+
+async def toStage(stage, *args):
+    fn, pool, priority, onError = pipeline[stage]
+    await pools[pool].enqueue(fn, *args, priority=priority, onError=onError)
+
+
+async def handle_get(request):
+    return web.Response(text="Hello from ngrok server")
+
+
+# Prometheus scrape target: GET /metrics on the webhook server
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+# Webhook callback: acknowledged right away, so a slow download never delays the response, and queued
+async def handle_post(request):
+    webhooks.put_nowait(await request.json())
+    return web.Response(text="ok")
+
+
+# Webhook worker, webhookWorkers of them process queued webhooks concurrently
+async def processWebhooks():
+    while True:
+        job = await webhooks.get()
+        try:
+            await processJob(job)
+        except Exception as error:
+            print("An error occurred:", error)
+
+
+# Handle a job state, delivered by webhook or polled with GET /jobs/{jobid} (Midjourney) / GET /videos/{video_id} (PixVerse)
+async def processJob(job):
+    # PixVerse callbacks carry a video_id (and no Midjourney verb)
+    if job.get("video_id"):
+        replyRef = job.get("replyRef") or (job.get("response") or {}).get("replyRef")
+        completed = job.get("video_status_final") is True or job.get("video_status_name") == "COMPLETED"
+        failed = job.get("video_status_name") == "FAILED" or job.get("errCode")
+        url = job.get("url")
+
+        print(f"{dateAsString()} ⁝ webhook pixverse {job.get('video_id')} {job.get('video_status_name')}")
+
+        if completed or failed:
+            await pixverseAccounts.finished(job.get("video_id"))
+            metrics.end(job.get("video_id"), "pixverse")
+
+        node = jobs.get(replyRef)
+        # Skip duplicate deliveries for a node that already completed
+        if node and not node["completed"]:
+            node["pixverse"] = {
+                **node.get("pixverse", {}),
+                "video_id": job.get("video_id"),
+                "status": job.get("video_status_name"),
+                "url": url,
+            }
+            if completed or failed:
+                polled.pop(replyRef, None)
+            if completed and url:
+                # Completed once the video is on disk, see videoDownloaded()
+                downloader.submit(url, f"./{replyRef}-pixverse-{getFilenameFromUrl(url)}", videoDownloaded, node)
+            elif completed or failed:
+                tracker.complete(node)
+            journal.save(node["key"])
+        return
+
+    # Midjourney callbacks — generated media is nested under job["response"]
+    jobid = job.get("jobid")
+    verb = job.get("verb")
+    status = job.get("status")
+    response = job.get("response") or {}
+    content = response.get("content") or ""
+    attachments = response.get("attachments")
+    url = attachments[0].get("url") if attachments else None
+
+    print(f"{dateAsString()} ⁝ webhook #{jobid} {verb} {status} {content[:20]}…{content[-20:] if content else ''}")
+
+    if status in ("completed", "moderated", "failed", "cancelled"):
+        await midjourneyChannels.finished(jobid)
+        metrics.end(jobid, "midjourney")
+
+        node = jobs.get(jobid)
+
+        if not node:
+            return
+
+        # Skip duplicate deliveries, unless the job was resumed midway (e.g. stopped before its download)
+        if node.get("status") in ("completed", "moderated", "failed", "cancelled") and jobid not in polled:
+            return
+        polled.pop(jobid, None)
+
+        node["status"] = status
+        node["content"] = content
+
+        if status == "completed":
+            if "buttons" in node:
+                if (scoreGrid or splitGrid) and url:
+                    # This is an imagine job — score / split its grid first, see gridDownloaded()
+                    downloader.submit(url, f"./{jobid}-{getFilenameFromUrl(url)}", gridDownloaded, node)
                 else:
-                    # Completed leaf with no image — nothing to animate
-                    node["completed"] = True
+                    # This is an imagine job — kick off the U1-U4 upscales
+                    await upscale(node)
+            elif url:
+                # This is an upscale (U1-U4) leaf — download it and animate via PixVerse, see imageDownloaded()
+                downloader.submit(url, f"./{jobid}-{getFilenameFromUrl(url)}", imageDownloaded, node)
             else:
-                # Moderated / failed / cancelled — nothing downstream to run
-                if "buttons" in node:
-                    for _button, value in node["buttons"].items():
-                        if not _button.startswith("_"):
-                            value["completed"] = True
-                else:
-                    node["completed"] = True
+                # Completed leaf with no image — nothing to animate
+                tracker.complete(node)
+        else:
+            # Moderated / failed / cancelled — nothing downstream to run
+            if "buttons" in node:
+                for _button, value in node["buttons"].items():
+                    if not _button.startswith("_"):
+                        tracker.complete(value)
+            else:
+                tracker.complete(node)
+
+        journal.save(node["key"])
+    else:
+        # A running job reported progress — record it, nothing downstream to start yet
+        node = jobs.get(jobid)
+        if node and node.get("status") not in ("completed", "moderated", "failed", "cancelled"):
+            node["status"] = status
+
+
+# Kick off the upscales of a completed imagine job; leaves not selected are completed without running
+async def upscale(entry, selected=None):
+    for button, value in entry["buttons"].items():
+        if button.startswith("_"):
+            continue
+        if selected is None or button in selected:
+            tracker.advance(value, "upscale")
+            await toStage("button", button, entry["jobid"], value)
+        else:
+            value["skipped"] = True
+            tracker.complete(value)
+
+
+# The imagine grid finished downloading — keep only the buttons the scorer picks from it, and split it
+# instead of upscaling with --split-grid
+async def gridDownloaded(localPath, entry):
+    entry["gridFileName"] = localPath
+    entry["selected"] = await selectButtons(localPath, entry) if localPath and scoreGrid else None
+    if localPath and splitGrid:
+        await splitUpscales(entry, entry["selected"])
+    else:
+        await upscale(entry, entry["selected"])
+    journal.save(entry["key"])
+
+
+# Cut an imagine grid into its four images, U1 top left to U4 bottom right, and save them next to it with Pillow.
+# Returns button → file name.
+def cropGrid(gridFileName, buttons, prefix):
+    from PIL import Image  # only needed with --split-grid
+
+    files = {}
+    with Image.open(gridFileName) as grid:
+        width, height = grid.width // 2, grid.height // 2
+        for button in buttons:
+            ind = "U1 U2 U3 U4".split().index(button)
+            left, top = ind % 2 * width, ind // 2 * height
+            files[button] = f"./{prefix}_{button}.png"
+            grid.crop((left, top, left + width, top + height)).save(files[button])
+    return files
+
+
+# --split-grid: the images cut from the imagine grid stand in for the upscales and move on to the next stage right
+# away. Each leaf gets {imagine jobid}_{button} as its jobid. Falls back to the upscale jobs when the grid can't be split.
+async def splitUpscales(entry, selected=None):
+    buttons = [button for button in entry["buttons"] if not button.startswith("_") and (selected is None or button in selected)]
+    prefix = str(entry["jobid"]).split("-")[0]
+    try:
+        files = await asyncio.to_thread(cropGrid, entry["gridFileName"], buttons, prefix)
+    except Exception as error:
+        print(f"{dateAsString()} ⁝ unable to split {entry['gridFileName']}, upscaling instead:", error)
+        await upscale(entry, selected)
+        return
 
-            saveToFile("./result.json", data)
+    for button, value in entry["buttons"].items():
+        if button.startswith("_"):
+            continue
+        if button not in files:
+            value["skipped"] = True
+            tracker.complete(value)
+            continue
+        value["jobid"] = f"{prefix}_{button}"
+        value["status"] = "completed"
+        value["split"] = True
+        indexJob(value["jobid"], value)
+        value["imageFileName"] = files[button]
+        tracker.advance(value, "pixverse")
+        await toStage("upload", value)
+
+
+# An upscale (U1-U4) image finished downloading — animate it via PixVerse
+async def imageDownloaded(localPath, node):
+    if not localPath:
+        tracker.complete(node)
+        journal.save(node["key"])
+        return
+
+    node["imageFileName"] = localPath
+    tracker.advance(node, "pixverse")
+    journal.save(node["key"])
+    await toStage("upload", node)
+
+
+# A PixVerse video finished downloading
+async def videoDownloaded(localPath, node):
+    node["pixverse"]["videoFileName"] = localPath
+    tracker.complete(node)
+    journal.save(node["key"])
+
+
+# GET /accounts/{channel}, see https://useapi.net/docs/api-midjourney-v3/get-midjourney-accounts-channel
+async def getAccount(name):
+    response = await asyncio.to_thread(session.get, f"{rootMidjourneyUrl}/accounts/{name}", headers=authHeaders)
+    return response.json() if response.status_code == 200 else None
+
+
+# Channels taken out of rotation by a 596 rejoin it once POST /accounts/{channel}/reset cleared their error
+async def watchChannels():
+    while True:
+        await asyncio.sleep(channelCheckSecs)
+
+        for name in list(midjourneyChannels.disabled):
+            # A failed check leaves the channel out of rotation until the next pass
+            try:
+                account = await getAccount(name)
+                if account is not None and not account.get("error"):
+                    await midjourneyChannels.enable(name)
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ checking channel {name} failed: {error}")
+
+
+# Jobs still running when a previous run stopped report to its webhook url, and --stream jobs other than
+# Midjourney have no webhook, so they are polled instead
+async def pollJobs():
+    while True:
+        await asyncio.sleep(pollSecs)
 
+        for ref, (url, fields) in list(polled.items()):
+            # A network error, a 429 or a 5xx answer is logged and the job polled again on the next pass
+            try:
+                response = await asyncio.to_thread(session.get, url, headers=authHeaders)
+
+                if response.status_code == 429 or response.status_code >= 500:
+                    print(f"{dateAsString()} ⁝ polled {ref} HTTP {response.status_code}, polling again")
+                    continue
+                if response.status_code != 200:
+                    print(f"{dateAsString()} ⁝ polled {ref} HTTP {response.status_code}, giving up", response.text)
+                    job = {**fields, "status": "failed", "video_status_name": "FAILED"}
+                else:
+                    job = {**response.json(), **fields}
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ polled {ref} failed, polling again: {error}")
+                continue
 
-start_time = time.time()
+            try:
+                await processJob(job)
+            except Exception as error:
+                print("An error occurred:", error)
 
-prompts = loadFromFile("./prompts.json")
 
-print(f"{dateAsString()} ⁝ prompts to process: {len(prompts)}")
+# MJ_SCORER "module:function" → the function, see selectButtons()
+def loadScorer(spec):
+    moduleName, _, functionName = spec.partition(":")
+    return getattr(importlib.import_module(moduleName), functionName or "score")
 
-httpd = HTTPServer(("", 8081), SimpleHTTPRequestHandler)
 
-# data holds every job to execute and tracks progress via the completed field (on the U1-U4 leaves).
-for ind in range(len(prompts)):
-    data[f"imagine-{ind}"] = {
+# Buttons of an imagine job worth upscaling, as picked by the scorer from its grid; all of them when it fails
+async def selectButtons(gridFileName, entry):
+    buttons = [button for button in entry["buttons"] if not button.startswith("_")]
+    try:
+        selected = await asyncio.to_thread(scoreGrid, gridFileName, buttons)
+    except Exception as error:
+        print(f"{dateAsString()} ⁝ scorer failed on {gridFileName}, upscaling all:", error)
+        return buttons
+    selected = [button for button in buttons if button in selected]
+    print(f"{dateAsString()} ⁝ scorer picked {', '.join(selected) or 'nothing'} for {entry['key']}")
+    return selected
+
+
+# data entry of a prompt: the imagine job and its MJ_BUTTONS (U1-U4) leaves. Every node carries the key
+# of its data entry, so a change can be journaled by entry.
+def newEntry(key, prompt):
+    return {
+        "key": key,
         "jobid": None,
-        "prompt": prompts[ind],
-        "buttons": {
-            "U1": {"jobid": None, "completed": False},
-            "U2": {"jobid": None, "completed": False},
-            "U3": {"jobid": None, "completed": False},
-            "U4": {"jobid": None, "completed": False},
-        },
+        "prompt": prompt,
+        "buttons": {button: {"key": key, "jobid": None, "completed": False} for button in upscaleButtons},
     }
 
-saveToFile("./result.json", data)
 
-for key in data:
-    queueMidjourney.enqueue(post_midjourney, key, data[key])
+# Rows of the stages / artefacts tables for a data entry, see JobStore: (node, jobid, replyRef, stage, status,
+# files) of its imagine job and of every leaf
+def nodesOf(entry):
+    yield "imagine", entry["jobid"], None, "imagine", entry.get("status") or "pending", {"grid": entry.get("gridFileName")}
+    for button, value in entry["buttons"].items():
+        if button.startswith("_"):
+            continue
+        pixverse = value.get("pixverse") or {}
+        stage = value.get("stage", "imagine")
+        # State of the job of the stage it is in; PixVerse reports COMPLETED / FAILED, Midjourney completed / failed
+        status = {"pixverse": pixverse.get("status")}.get(stage, value.get("status"))
+        status = "skipped" if value.get("skipped") else (status or "pending").lower()
+        files = {"image": value.get("imageFileName"), "video": pixverse.get("videoFileName")}
+        yield button, value["jobid"], value["jobid"], stage, status, files
+
+
+def leavesOf(entry):
+    return [value for button, value in entry["buttons"].items() if not button.startswith("_")]
+
+
+# Index an entry's jobs for the webhooks and register its pending leaves with the tracker
+def trackEntry(entry):
+    indexJob(entry["jobid"], entry)
+    for value in leavesOf(entry):
+        indexJob(value["jobid"], value)
+        if not value["completed"]:
+            tracker.add(value, value.get("stage", "imagine"))
+
+
+# Drop entries whose last leaf completed from memory, see Journal.retire(); late webhooks for their jobs are ignored
+def retireFinished():
+    while tracker.finished:
+        key = tracker.finished.popleft()
+        if key not in data:
+            continue
+        jobs.pop(data[key]["jobid"], None)
+        for value in leavesOf(data[key]):
+            jobs.pop(value["jobid"], None)
+        journal.retire(key)
+
+
+# Continue a data entry from the stage it reached: skip it once every leaf completed, poll jobs that were
+# still running, and submit whatever never started
+async def scheduleEntry(entry):
+    buttons = {button: value for button, value in entry["buttons"].items() if not button.startswith("_")}
+
+    if all(value["completed"] for value in buttons.values()):
+        return
+
+    if not entry["jobid"]:
+        await toStage("imagine", entry["key"], entry)
+    elif entry.get("status") != "completed":
+        polled[entry["jobid"]] = (f"{rootMidjourneyUrl}/jobs/{entry['jobid']}", {"jobid": entry["jobid"]})
+    elif (scoreGrid or splitGrid) and "selected" not in entry and not any(value["jobid"] or value["completed"] for value in buttons.values()):
+        # Stopped before the grid was scored / split: fetch the imagine job again to download it
+        polled[entry["jobid"]] = (f"{rootMidjourneyUrl}/jobs/{entry['jobid']}", {"jobid": entry["jobid"]})
+    else:
+        for button, value in buttons.items():
+            video_id = (value.get("pixverse") or {}).get("video_id")
+
+            if value["completed"]:
+                continue
+            elif video_id:
+                polled[value["jobid"]] = (f"{rootPixVerseUrl}/videos/{video_id}", {"video_id": video_id, "replyRef": value["jobid"]})
+            elif value.get("imageFileName"):
+                await toStage("upload", value)
+            elif value["jobid"]:
+                polled[value["jobid"]] = (f"{rootMidjourneyUrl}/jobs/{value['jobid']}", {"jobid": value["jobid"]})
+            else:
+                tracker.advance(value, "upscale")
+                await toStage("button", button, entry["jobid"], value)
+
+
+# python3 ./example.py --compact rebuilds result.json from result.json + result.jsonl + result.done.jsonl and exits;
+# with --sqlite it exports result.db to result.json instead
+if "--compact" in sys.argv:
+    Journal("./result.json", loadJobStore("./result.db") if useJobStore else loadJournal("./result.json")).compact()
+    sys.exit(0)
+
+if "--progress" in sys.argv:
+    printProgress("./result.db")
+    sys.exit(0)
+
+# https://github.com/ngrok/ngrok-python — not needed with --stream, job states are streamed or polled instead
+listener = None
+if streaming:
+    webhookUrl = None
+elif not webhookUrl:
+    listener = ngrok.forward(8081, authtoken_from_env=True)
+    webhookUrl = listener.url()
+
+if webhookUrl:
+    print(f"Webhook {webhookUrl}")
+
+prompts = readPrompts(promptsFile)
+scoreGrid = loadScorer(gridScorer) if gridScorer else None
+
+if "--resume" in sys.argv:
+    # Continue the previous run instead of submitting every prompt again
+    data.update(loadJobStore("./result.db") if useJobStore else loadJournal("./result.json"))
+
+# data holds the entries of the prompts in flight and tracks progress via the completed field (on the U1-U4 leaves)
+journal = JobStore("./result.db", data, "--resume" in sys.argv) if useJobStore else Journal("./result.json", data)
+journal.compact()
+
+# Entries finished in the previous run are retired right away, their prompts are skipped
+finished = [key for key in data if all(value["completed"] for value in leavesOf(data[key]))]
+for key in finished:
+    journal.retire(key)
+finished = set(finished)
+
+downloader = Downloader(maxDownloads)
+manifest = Manifest("./downloads.jsonl")
+uploads = UploadCache("./uploads.jsonl")
+
+
+# Feed prompts to the pipeline as they are read, keeping at most maxActivePrompts of them in memory
+async def run():
+    count = 0
+    for ind, prompt in enumerate(prompts):
+        count = ind + 1
+        key = f"imagine-{ind}"
+        if key in finished:
+            continue
+
+        while len(tracker.entries) >= maxActivePrompts:
+            tracker.freed.clear()
+            await tracker.freed.wait()
+        retireFinished()
+
+        data.setdefault(key, newEntry(key, prompt))
+        trackEntry(data[key])
+        await scheduleEntry(data[key])
+
+    print(f"{dateAsString()} ⁝ prompts read: {count}")
+    tracker.close()
+
+
+async def main():
+    app = web.Application()
+    app.router.add_get("/", handle_get)
+    app.router.add_post("/", handle_post)
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=8081).start()
+
+    tasks = [asyncio.create_task(processWebhooks()) for _ in range(webhookWorkers)]
+    tasks.append(asyncio.create_task(run()))
+    tasks.append(asyncio.create_task(pollJobs()))
+    tasks.append(asyncio.create_task(watchChannels()))
+
+    # Shut down the moment the last job completes
+    await tracker.done.wait()
+
+    for task in tasks:
+        task.cancel()
+    await runner.cleanup()
+    if stream_session:
+        await stream_session.close()
+
+    print(f"{dateAsString()} ⁝ {downloader}")
+    for controller in rateControllers.values():
+        print(f"{dateAsString()} ⁝ {controller}")
+    for pool in (midjourneyChannels, pixverseAccounts):
+        if pool.capacity:
+            print(f"{dateAsString()} ⁝ {pool}")
+
+    # Entries that finished with the last jobs are stored as finished too
+    retireFinished()
+    journal.finish()
 
-while hasMoreJobsToRun(data):
-    httpd.handle_request()
 
-execution_time = time.time() - start_time
+asyncio.run(main())
 
-print(
-    f"{dateAsString()}  ⁝  total elapsed time {datetime.datetime.utcfromtimestamp(execution_time).strftime('%H:%M:%S')}"
-)
+for line in metrics.summary():
+    print(f"{dateAsString()} ⁝ {line}")
@@ -0,0 +1,195 @@
+#
+# pip install requests
+# pip install aiohttp
+#
+# Runs every example.py against the local mock server (mock_server.py) at growing prompt counts and reports
+# throughput, end-to-end latency, peak memory and CPU time, so a change that slows a pipeline down shows up before
+# it reaches production. No useapi.net token or ngrok account is needed:
+# python3 ./benchmark.py
+#
+# Optional environment variables:
+#   BENCHMARK_EXAMPLES - examples to run, e.g. "generate-assets,pixverse-demo" (all five by default).
+#   BENCHMARK_SIZES    - prompt counts every example runs with, "10,100,1000,10000" by default.
+#   BENCHMARK_ARGS     - extra arguments passed to every example.py, e.g. "--stream".
+#   BENCHMARK_TIMEOUT  - seconds a single run may take before it is stopped, 3600 by default.
+#   BENCHMARK_BASELINE - results file of an earlier run; a run slower than it by more than regressionShare fails.
+#   MOCK_LATENCY, MOCK_429, MOCK_596, MOCK_MEDIA_SIZE are passed on to mock_server.py.
+#
+# Results are printed as a table and saved to benchmark-results.json, ready to be used as the next baseline.
+#
+
+import datetime
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+allExamples = ['generate-assets', 'generate-assets-with-webhook', 'pixverse-demo', 'animate-midjourney-images-with-pixverse', 'imagine-faceswap-animate']
+examples = (os.getenv('BENCHMARK_EXAMPLES') or ','.join(allExamples)).split(',')
+sizes = [int(size) for size in (os.getenv('BENCHMARK_SIZES') or '10,100,1000,10000').split(',')]
+exampleArgs = (os.getenv('BENCHMARK_ARGS') or '').split()
+timeoutSecs = int(os.getenv('BENCHMARK_TIMEOUT') or 3600)
+baselinePath = os.getenv('BENCHMARK_BASELINE')
+
+# Port of the mock server; the examples receive their webhooks on 8081
+mockPort = 9000
+mockUrl = f"http://127.0.0.1:{mockPort}"
+webhookUrl = 'http://127.0.0.1:8081/'
+# Share by which jobs/sec may drop, or p99 latency grow, against the baseline before the run counts as a regression
+regressionShare = 0.1
+resultsPath = './benchmark-results.json'
+
+def dateAsString():
+    return datetime.datetime.now().isoformat()
+
+def getJson(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+# Start a fresh mock server for every run, so the stats it reports belong to that run alone
+def startMock():
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py')],
+        env={**os.environ, 'MOCK_PORT': str(mockPort)},
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            getJson(f"{mockUrl}/stats")
+            return mock
+        except OSError:
+            time.sleep(0.1)
+    mock.kill()
+    raise RuntimeError('mock server did not start')
+
+# Copy the example into an empty folder with size unique prompts, cycled from the example's own prompts.json
+def prepare(example, size):
+    workDir = tempfile.mkdtemp(prefix=f"{example}-{size}-")
+    sourceDir = os.path.join(root, example)
+    for name in os.listdir(sourceDir):
+        if name == 'example.py' or name.endswith('.jpg'):
+            shutil.copy(os.path.join(sourceDir, name), workDir)
+
+    with open(os.path.join(sourceDir, 'prompts.json'), 'r') as file:
+        samples = json.load(file)
+    prompts = []
+    for ind in range(size):
+        sample = samples[ind % len(samples)]
+        if isinstance(sample, dict):
+            prompts.append({**sample, 'prompt': f"{sample['prompt']} #{ind}"})
+        else:
+            prompts.append(f"{sample} #{ind}")
+    with open(os.path.join(workDir, 'prompts.json'), 'w') as file:
+        json.dump(prompts, file)
+
+    return workDir
+
+# Run example.py to completion; os.wait4 gives the peak RSS and CPU time of that process alone
+def runExample(workDir):
+    env = {**os.environ, 'USEAPI_TOKEN': 'mock', 'USEAPI_URL': mockUrl, 'WEBHOOK_URL': webhookUrl}
+    with open(os.path.join(workDir, 'output.log'), 'w') as log:
+        process = subprocess.Popen([sys.executable, 'example.py', *exampleArgs], cwd=workDir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        timer = threading.Timer(timeoutSecs, process.send_signal, [signal.SIGKILL])
+        timer.start()
+        start = time.time()
+        _, status, usage = os.wait4(process.pid, 0)
+        secs = time.time() - start
+        timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = usage.ru_maxrss / (1048576 if sys.platform == 'darwin' else 1024)
+    return process.returncode, secs, rss, usage.ru_utime + usage.ru_stime
+
+# Nearest-rank percentile of sorted values
+def percentile(values, share):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+def benchmark(example, size):
+    workDir = prepare(example, size)
+    mock = startMock()
+    try:
+        code, secs, rss, cpu = runExample(workDir)
+        stats = getJson(f"{mockUrl}/stats")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    latencies = stats['latencies']
+    result = {
+        'example': example,
+        'prompts': size,
+        'code': code,
+        'secs': secs,
+        'jobs': stats['jobs'],
+        'jobsPerSec': stats['jobs'] / secs,
+        'finished': len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'rssMB': rss,
+        'cpuSecs': cpu,
+    }
+
+    if code == 0:
+        shutil.rmtree(workDir)
+    else:
+        print(f"{dateAsString()} ⁝ {example} exited with {code}, see {workDir}/output.log")
+    return result
+
+def formatSecs(value):
+    return '-' if value is None else f"{value:.1f}s"
+
+def printResult(result):
+    print(
+        f"{result['example']:<42} {result['prompts']:>6} {result['finished']:>6} {result['jobs']:>7} {result['jobsPerSec']:>8.2f}"
+        f" {formatSecs(result['p50']):>8} {formatSecs(result['p99']):>8} {result['rssMB']:>8.1f} {result['cpuSecs']:>8.1f}s"
+    )
+
+# Runs slower than the baseline by more than regressionShare: fewer jobs/sec or a longer p99 latency
+def regressions(results, baseline):
+    previous = {(result['example'], result['prompts']): result for result in baseline}
+    found = []
+    for result in results:
+        before = previous.get((result['example'], result['prompts']))
+        if not before:
+            continue
+        if result['jobsPerSec'] < before['jobsPerSec'] * (1 - regressionShare):
+            found.append(f"{result['example']} × {result['prompts']}: {before['jobsPerSec']:.2f} → {result['jobsPerSec']:.2f} jobs/sec")
+        if result['p99'] and before['p99'] and result['p99'] > before['p99'] * (1 + regressionShare):
+            found.append(f"{result['example']} × {result['prompts']}: p99 {before['p99']:.1f}s → {result['p99']:.1f}s")
+    return found
+
+print(f"{'example':<42} {'prompts':>6} {'done':>6} {'jobs':>7} {'jobs/s':>8} {'p50':>8} {'p99':>8} {'RSS MB':>8} {'CPU':>9}")
+
+results = []
+for example in examples:
+    for size in sizes:
+        result = benchmark(example, size)
+        results.append(result)
+        printResult(result)
+
+with open(resultsPath, 'w') as file:
+    json.dump(results, file, indent=2)
+
+print(f"{dateAsString()} ⁝ results saved to {resultsPath}")
+
+if baselinePath:
+    with open(baselinePath, 'r') as file:
+        found = regressions(results, json.load(file))
+    for line in found:
+        print(f"{dateAsString()} ⁝ regression {line}")
+    if found:
+        sys.exit(1)
+
+if any(result['code'] != 0 for result in results):
+    sys.exit(1)
@@ -0,0 +1,284 @@
+#
+# pip install aiohttp
+#
+# Local stand-in for the useapi.net endpoints the examples call, so their pipelines can be measured without a token:
+# USEAPI_URL="http://127.0.0.1:9000" WEBHOOK_URL="http://127.0.0.1:8081/" USEAPI_TOKEN="mock" python3 ./example.py
+#
+# Optional environment variables:
+#   MOCK_PORT       - port to listen on, 9000 by default.
+#   MOCK_LATENCY    - seconds a job spends in each of its stages (created → started → completed), 1 by default.
+#   MOCK_429        - share of submissions answered with 429 (busy), e.g. 0.1.
+#   MOCK_596        - share of Midjourney submissions answered with 596 (pending moderation / CAPTCHA).
+#   MOCK_MEDIA_SIZE - size of every generated image / video served by the fake CDN, in bytes.
+#
+# GET /stats returns request counts and the end-to-end latency of every prompt: from its first submission to the
+# last media download of the jobs it led to (upscales, face swaps, videos).
+#
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+from aiohttp import web, ClientSession
+
+port = int(os.getenv('MOCK_PORT') or 9000)
+latency = float(os.getenv('MOCK_LATENCY') or 1)
+share429 = float(os.getenv('MOCK_429') or 0)
+share596 = float(os.getenv('MOCK_596') or 0)
+mediaSize = int(os.getenv('MOCK_MEDIA_SIZE') or 512 * 1024)
+
+baseUrl = f"http://127.0.0.1:{port}"
+terminal = ('completed', 'moderated', 'failed', 'cancelled')
+
+midjourneyJobs = {}  # jobid → Midjourney job
+faceswapJobs = {}  # jobid → FaceSwap job
+videos = {}  # video_id → PixVerse video
+prompts = {}  # jobid / video_id / replyRef → prompt the job descends from
+started = {}  # prompt → time of its first submission
+finished = {}  # prompt → time of its last media download
+counts = {}  # route → number of requests
+session = None
+tasks = set()
+
+def count(name):
+    counts[name] = counts.get(name, 0) + 1
+
+def spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+# Remember which prompt a job belongs to; the first submission of a prompt starts its end-to-end clock
+def trace(key, prompt):
+    prompts[str(key)] = prompt
+    prompts.setdefault(str(key).split('-')[0], prompt)
+    started.setdefault(prompt, time.time())
+
+# Prompt of a job by jobid / replyRef; images cut locally from a grid (--split-grid) go by {jobid prefix}_U1…
+def promptOf(ref):
+    return prompts.get(str(ref)) or prompts.get(str(ref).split('_')[0])
+
+def busy():
+    return random.random() < share429
+
+def throttled():
+    return web.json_response({'error': 'Too many requests, retry later'}, status=429, headers={'Retry-After': '1'})
+
+# POST the job state to replyUrl, like useapi.net webhooks do
+async def callback(replyUrl, payload):
+    if not replyUrl:
+        return
+    try:
+        async with session.post(replyUrl, json=payload) as response:
+            await response.read()
+    except Exception as error:
+        print('callback failed:', replyUrl, error)
+
+def mediaUrl(name):
+    return f"{baseUrl}/cdn/{name}?ex={int(time.time()) + 86400:x}"
+
+# Midjourney job through created → started → progress → completed; every state goes to the SSE queue if any
+async def runMidjourney(job, events=None):
+    for status in ('started', 'progress'):
+        await asyncio.sleep(latency * random.uniform(0.5, 1))
+        job['status'] = status
+        if events:
+            await events.put(dict(job))
+    await asyncio.sleep(latency)
+
+    job['status'] = 'completed'
+    job['response'] = {
+        'content': f"**{job['request'].get('prompt', job['verb'])}** - <@mock> (fast)",
+        'attachments': [{'url': mediaUrl(f"{job['jobid']}.png"), 'content_type': 'image/png'}],
+        'buttons': ['U1', 'U2', 'U3', 'U4', '🔄', 'V1', 'V2', 'V3', 'V4'] if job['verb'] == 'imagine' else ['Vary (Strong)'],
+    }
+    if events:
+        await events.put(dict(job))
+        await events.put(None)
+    await callback(job['request'].get('replyUrl'), job)
+
+# POST /v3/midjourney/jobs/imagine and /jobs/button, JSON or server-sent events depending on stream
+async def submitMidjourney(request):
+    verb = request.match_info['verb']
+    count(f"midjourney/{verb}")
+    body = await request.json()
+
+    if verb == 'button':
+        prompt = promptOf(body.get('jobId')) or body.get('jobId')
+    else:
+        prompt = body.get('replyRef') or body.get('prompt')
+    started.setdefault(prompt, time.time())
+
+    if busy():
+        return throttled()
+    if random.random() < share596:
+        return web.json_response({'error': 'Pending moderation / CAPTCHA', 'code': 596}, status=596)
+
+    jobid = f"j{uuid.uuid4().int % 10 ** 19}-u1-c1-bot:midjourney"
+    job = {'jobid': jobid, 'verb': verb, 'status': 'created', 'created': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'request': body}
+    if body.get('channel'):
+        job['channel'] = body['channel']
+    midjourneyJobs[jobid] = job
+    trace(jobid, prompt)
+
+    if not body.get('stream', True):
+        spawn(runMidjourney(job))
+        return web.json_response(job, status=201)
+
+    response = web.StreamResponse(status=201, headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    await response.write(f"data: {json.dumps(job)}\n\n".encode())
+    events = asyncio.Queue()
+    spawn(runMidjourney(job, events))
+    while (event := await events.get()) is not None:
+        await response.write(f"data: {json.dumps(event)}\n\n".encode())
+    await response.write_eof()
+    return response
+
+async def getMidjourneyJob(request):
+    count('midjourney/get')
+    job = midjourneyJobs.get(request.match_info['jobid'])
+    if not job:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    return web.json_response(job)
+
+async def listMidjourneyJobs(request):
+    count('midjourney/list')
+    return web.json_response([{'jobid': job['jobid'], 'status': job['status']} for job in midjourneyJobs.values() if job['status'] not in terminal])
+
+async def getAccount(request):
+    count('midjourney/account')
+    return web.json_response({'channel': request.match_info['channel'], 'maxJobs': 3})
+
+# POST /v1/faceswap/swap, multipart form with saveid_image / swapid_image
+async def swapFace(request):
+    count('faceswap/swap')
+    form = await request.post()
+    replyRef = form.get('replyRef')
+    started.setdefault(promptOf(replyRef) or replyRef, time.time())
+
+    if busy():
+        return throttled()
+
+    jobid = f"f{uuid.uuid4().int % 10 ** 19}-u1-c1-bot:faceswap"
+    job = {'jobid': jobid, 'verb': 'faceswap-swap', 'status': 'started', 'replyRef': replyRef}
+    faceswapJobs[jobid] = job
+    trace(jobid, promptOf(replyRef) or replyRef)
+
+    async def run():
+        await asyncio.sleep(latency)
+        job.update(status='completed', content='swapped', attachments=[{'url': mediaUrl(f"{jobid}.png")}])
+        await callback(form.get('replyUrl'), job)
+
+    spawn(run())
+    return web.json_response(job, status=201)
+
+async def getFaceswapJob(request):
+    count('faceswap/get')
+    job = faceswapJobs.get(request.query.get('jobid'))
+    if not job:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    return web.json_response(job)
+
+# POST /v2/pixverse/files, raw image bytes
+async def uploadFile(request):
+    count('pixverse/files')
+    data = await request.read()
+    counts['uploadedBytes'] = counts.get('uploadedBytes', 0) + len(data)
+    return web.json_response({'result': [{'path': f"upload/{uuid.uuid4().hex}.jpg", 'size': len(data)}]})
+
+# POST /v2/pixverse/videos/create
+async def createVideo(request):
+    count('pixverse/create')
+    body = await request.json()
+    replyRef = body.get('replyRef')
+    prompt = promptOf(replyRef) or replyRef or body.get('prompt')
+    started.setdefault(prompt, time.time())
+
+    if busy():
+        return throttled()
+
+    video_id = random.randint(10 ** 8, 10 ** 9)
+    video = {'video_id': video_id, 'status': 'created', 'video_status_name': 'GENERATING', 'video_status_final': False, 'replyRef': replyRef}
+    videos[video_id] = video
+    trace(video_id, prompt)
+
+    async def run():
+        await asyncio.sleep(latency)
+        video.update(video_status_name='COMPLETED', video_status_final=True, url=mediaUrl(f"{video_id}.mp4"))
+        await callback(body.get('replyUrl'), video)
+
+    spawn(run())
+    return web.json_response({'video_id': video_id, 'status': 'created'})
+
+async def getVideo(request):
+    count('pixverse/get')
+    video = videos.get(int(request.match_info['video_id']))
+    if not video:
+        return web.json_response({'error': 'Video not found'}, status=404)
+    return web.json_response(video)
+
+# 64×64 PNG with a differently coloured quadrant each, so grids can be split (--split-grid) into distinct images
+def pngImage(name):
+    colors = [hashlib.sha256(f"{name}{ind}".encode()).digest()[:3] for ind in range(4)]
+    rows = b''.join(b'\0' + b''.join(colors[(y >= 32) * 2 + (x >= 32)] for x in range(64)) for y in range(64))
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 64, 64, 8, 2, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+# Fake CDN: deterministic bytes for every media name, with ETag and Range support for resumed downloads.
+# Images start with a real PNG, padded to MOCK_MEDIA_SIZE after its end.
+async def getMedia(request):
+    count('cdn')
+    name = request.match_info['name']
+    prompt = prompts.get(name.rsplit('.', 1)[0])
+    if prompt is not None:
+        finished[prompt] = time.time()
+
+    payload = pngImage(name) if name.endswith('.png') else b''
+    payload = (payload + name.encode() * (mediaSize // len(name) + 1))[:mediaSize]
+    headers = {'ETag': f'"{name}"', 'Accept-Ranges': 'bytes'}
+    range = request.headers.get('Range', '')
+    if range.startswith('bytes='):
+        start = int(range[6:].split('-')[0] or 0)
+        headers['Content-Range'] = f"bytes {start}-{mediaSize - 1}/{mediaSize}"
+        return web.Response(body=payload[start:], status=206, headers=headers)
+    return web.Response(body=payload, headers=headers)
+
+async def getStats(request):
+    latencies = sorted(finished[prompt] - started[prompt] for prompt in finished if prompt in started)
+    jobs = len(midjourneyJobs) + len(faceswapJobs) + len(videos)
+    return web.json_response({'requests': counts, 'jobs': jobs, 'prompts': len(started), 'latencies': latencies})
+
+async def startup(app):
+    global session
+    session = ClientSession()
+
+async def cleanup(app):
+    await session.close()
+
+app = web.Application(client_max_size=1024 ** 3)
+app.on_startup.append(startup)
+app.on_cleanup.append(cleanup)
+app.router.add_post('/v3/midjourney/jobs/{verb:imagine|button}', submitMidjourney)
+app.router.add_get('/v3/midjourney/jobs/{jobid}', getMidjourneyJob)
+app.router.add_get('/v3/midjourney/jobs', listMidjourneyJobs)
+app.router.add_get('/v3/midjourney/accounts/{channel}', getAccount)
+app.router.add_post('/v1/faceswap/swap', swapFace)
+app.router.add_get('/v1/faceswap/jobs/', getFaceswapJob)
+app.router.add_post('/v2/pixverse/files', uploadFile)
+app.router.add_post('/v2/pixverse/files/', uploadFile)
+app.router.add_post('/v2/pixverse/videos/create', createVideo)
+app.router.add_get('/v2/pixverse/videos/{video_id}', getVideo)
+app.router.add_get('/cdn/{name}', getMedia)
+app.router.add_get('/stats', getStats)
+
+print(f"Mock useapi.net listening on {baseUrl}")
+web.run_app(app, port=port, print=None)
@@ -1,5 +1,6 @@
 #
 # pip install requests
+# pip install aiohttp
 # pip install ngrok
 #
 # Create an example.sh file with the following content and execute it from the command line using ./example.sh:
@@ -7,6 +8,21 @@
 #
 # USEAPI_CHANNEL is optional with the Midjourney API v3 — when omitted the API
 # automatically selects a configured channel with available capacity.
+# USEAPI_CHANNELS="channel[:jobs],…" spreads the prompts over several configured channels instead, least loaded first.
+#
+# USEAPI_URL points the example at another API host, e.g. the local mock server in ../benchmark, and WEBHOOK_URL
+# replaces the ngrok tunnel with a url that already reaches port 8081.
+#
+# PROMPTS_FILE reads the prompts from a .jsonl file (one JSON string per line) or a .csv file with a prompt column
+# instead of ./prompts.json, one prompt at a time as it is submitted.
+#
+# python3 ./example.py --resume continues a run that stopped midway: prompts recorded in result.json / result.jsonl
+# are not submitted again, and jobs that were still running are polled until they finish.
+#
+# python3 ./example.py --sqlite keeps the job state in a SQLite database, result.db, instead of result.json and
+# result.jsonl; python3 ./example.py --progress reports on it from another terminal while the run goes on.
+#
+# python3 ./example.py --stream follows every job over server-sent events instead of webhooks, so no ngrok tunnel is needed.
 #
 
 import requests
@@ -14,105 +30,512 @@ import ngrok
 
 import datetime
 import os
+import hashlib
+import shutil
 import time
+import random
+import email.utils
 import json
+import sqlite3
 import sys
+import threading
 import asyncio
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import bisect
+import contextlib
+import csv
+import aiohttp
+from collections import deque
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-prompts = []
-prompt_ind = 0
-webhook_ind = 0
+prompts = None  # (index, prompt) pairs read from promptsFile, see nextPrompt()
+prompt = None  # next (index, prompt) to submit
+prompts_read = 0
+exhausted = False  # every prompt was read
+started = 0  # prompts submitted
+webhook_ind = 0  # prompts finished
+known = set()  # replyRefs of prompts submitted by a previous run, see --resume
+resumed = []  # jobids still running when a previous run stopped or whose --stream ended early, see pollResumed()
+streams = set()  # tasks following --stream jobs, see followStream()
+stream_session = None
+webhooks = asyncio.Queue()  # webhook payloads acknowledged by handle_post(), see processWebhooks()
+jobFinished = asyncio.Event()  # set whenever a prompt finished, wakes submit() waiting for a busy channel
+allDone = asyncio.Event()  # set once every prompt was read and none is left in flight, see main()
 results = {}
 
 # Load all required parameters from the environment variables
 token = os.getenv('USEAPI_TOKEN')
 channel = os.getenv('USEAPI_CHANNEL')  # optional in v3
+channels = os.getenv('USEAPI_CHANNELS') or channel or ''  # optional, channel[:jobs],…
+apiUrl = os.getenv('USEAPI_URL') or 'https://api.useapi.net'  # optional, see ../benchmark
+webhookUrl = os.getenv('WEBHOOK_URL')  # optional, url of port 8081 used instead of an ngrok tunnel
+promptsFile = os.getenv('PROMPTS_FILE') or './prompts.json'  # optional, .json, .jsonl or .csv
 
 # Provide additional prompt params
 withParams = ' --relax' # --fast, --relax, --s all goes here
-# Time to pause between 429 (channel busy) retries
+# Follow jobs over server-sent events instead of webhooks, see postStream()
+streaming = '--stream' in sys.argv
+# Keep the job state in the SQLite database result.db instead of result.json / result.jsonl, see JobStore
+useJobStore = '--sqlite' in sys.argv
+# Time to pause between 429 (channel busy) retries without Retry-After, doubled on every consecutive 429 up to maxBackoffSecs
 sleepSecs = 5
+maxBackoffSecs = 60
 # Midjourney API v3 root url
-rootUrl = 'https://api.useapi.net/v3/midjourney'
+rootUrl = f"{apiUrl}/v3/midjourney"
 
-# https://github.com/ngrok/ngrok-python
-listener = ngrok.forward(8081, authtoken_from_env=True)
+# Maximum number of pooled keep-alive connections per host (api.useapi.net, CDN)
+maxConnectionsPerHost = 10
+# Number of journal records written between result.json snapshots
+compactEvery = 1000
+# Number of webhooks processed concurrently
+webhookWorkers = 4
+# Number of generated images downloaded in parallel, and the chunk size they are streamed to disk in
+maxDownloads = 4
+downloadChunkSize = 1024 * 1024
+# Jobs a channel runs at the same time, unless set per channel in USEAPI_CHANNELS
+channelCapacity = 3
+# Time between checks whether a channel taken out of rotation by a 596 was reset, in seconds
+channelCheckSecs = 60
+# Upper bound of requests in flight that the rate controller may learn; submit() sends one at a time
+maxConcurrency = {'midjourney': 1}
 
-print(f"Webhook {listener.url()}")
+authHeaders = {'Authorization': f"Bearer {token}"}
+jsonHeaders = {**authHeaders, 'Content-Type': 'application/json'}
+
+# One pooled session is shared by every API call and download, so connections are kept alive
+# and reused instead of paying a TLS handshake per request.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxConnectionsPerHost, pool_block=True)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+# Time spent in every stage of the pipeline (submit round trip, queue wait, job until its terminal state, download,
+# upload, journal / result.json writes) as Prometheus-style histograms, see render() and summary()
+class StageMetrics:
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
 
-# Simple async query management
-class AsyncFunctionQueue:
     def __init__(self):
-        self.queue = []
-        self.is_function_running = False
+        self.histograms = {}  # (stage, api) → {'counts': per bucket and +Inf, 'sum': seconds, 'max': seconds}
+        self.begun = {}  # jobid / video_id → time the job was accepted, see begin()
+        self.lock = threading.Lock()  # downloads and result.json writes are timed on worker threads
+        self.started = time.time()
 
-    def enqueue(self, fn, *args):
-        self.queue.append((fn, args))
-        asyncio.run(self.process_queue())
+    def observe(self, stage, secs, api=''):
+        with self.lock:
+            histogram = self.histograms.get((stage, api))
+            if histogram is None:
+                histogram = self.histograms[(stage, api)] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'max': 0.0}
+            histogram['counts'][bisect.bisect_left(self.buckets, secs)] += 1
+            histogram['sum'] += secs
+            histogram['max'] = max(histogram['max'], secs)
 
-    async def process_queue(self):
-        if self.is_function_running or len(self.queue) == 0:
-            return
+    # with metrics.timer('upload', 'pixverse'): …
+    @contextlib.contextmanager
+    def timer(self, stage, api=''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, api)
+
+    # The job was accepted: end() records how long it took until its terminal state was reported
+    def begin(self, ref):
+        self.begun[ref] = time.time()
+
+    def end(self, ref, api):
+        start = self.begun.pop(ref, None)
+        if start is not None:
+            self.observe('job', time.time() - start, api)
+
+    # Upper bound of the bucket holding the share-th observation, capped by the longest one
+    def quantile(self, histogram, share):
+        rank = share * sum(histogram['counts'])
+        seen = 0
+        for bound, count in zip(self.buckets, histogram['counts']):
+            seen += count
+            if seen >= rank:
+                return min(bound, histogram['max'])
+        return histogram['max']
+
+    # Prometheus text exposition format, served on GET /metrics
+    def render(self):
+        lines = ['# HELP useapi_stage_seconds Time spent in each pipeline stage', '# TYPE useapi_stage_seconds histogram']
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",api="{api}"'
+                total = 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram['counts']):
+                    total += count
+                    lines.append(f'useapi_stage_seconds_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f"useapi_stage_seconds_sum{{{labels}}} {histogram['sum']:.6f}")
+                lines.append(f"useapi_stage_seconds_count{{{labels}}} {total}")
+        lines.append('# HELP useapi_elapsed_seconds Time since the run started')
+        lines.append('# TYPE useapi_elapsed_seconds gauge')
+        lines.append(f"useapi_elapsed_seconds {time.time() - self.started:.3f}")
+        return '\n'.join(lines) + '\n'
+
+    # End-of-run summary: per stage how often it ran, the time it took in total, p50 / p99 / max
+    def summary(self):
+        lines = [f"{'stage':<10} {'api':<12} {'count':>8} {'total':>10} {'p50':>8} {'p99':>8} {'max':>8}"]
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                lines.append(
+                    f"{stage:<10} {api:<12} {sum(histogram['counts']):>8} {histogram['sum']:>9.1f}s"
+                    f" {self.quantile(histogram, 0.5):>7.2f}s {self.quantile(histogram, 0.99):>7.2f}s {histogram['max']:>7.2f}s"
+                )
+        elapsed = datetime.datetime.utcfromtimestamp(time.time() - self.started).strftime('%H:%M:%S')
+        lines.append(f"total elapsed time {elapsed}")
+        return lines
+
+metrics = StageMetrics()
+
+# Long-lived scheduler on the event loop: up to concurrency queued functions run at the same time.
+# Waiting functions are kept in one deque per priority (lower runs first), and enqueue() waits while
+# maxPending functions are already waiting, so producers slow down instead of piling up work.
+class AsyncFunctionQueue:
+    def __init__(self, name, concurrency=1, maxPending=1000):
+        self.name = name
+        self.concurrency = concurrency
+        self.queues = {}  # priority → deque of (fn, args, time queued)
+        self.items = asyncio.Semaphore(0)
+        self.space = asyncio.Semaphore(maxPending)
+        self.workers = []
+
+    async def enqueue(self, fn, *args, priority=0):
+        await self.space.acquire()
+        self.queues.setdefault(priority, deque()).append((fn, args, time.time()))
+        self.items.release()
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    async def work(self):
+        while True:
+            await self.items.acquire()
+            priority = min(priority for priority, queue in self.queues.items() if queue)
+            item = self.queues[priority].popleft()
+            self.space.release()
+
+            fn, args, queued = item
+            metrics.observe('queue', time.time() - queued, self.name)
+            try:
+                await fn(*args)
+            except Exception as error:
+                print('An error occurred:', error)
+
+# Create async query; submit() walks the prompts itself and waits for jobs to finish, so it is queued once
+queue = AsyncFunctionQueue('midjourney')
+
+# AIMD rate controller for one API (per channel / account when one is pinned). It learns how many requests
+# can be in flight: every accepted request raises limit by 1/limit, every 429 halves it and pauses new requests
+# for Retry-After, or a jittered exponential backoff when the header is missing.
+class RateController:
+    def __init__(self, name, maxLimit):
+        self.name = name
+        self.limit = 1.0
+        self.maxLimit = maxLimit
+        self.inFlight = 0
+        self.failures = 0  # consecutive 429s
+        self.resumeAt = 0  # no request starts before this time while backing off
+        self.changed = asyncio.Condition()
+
+    # Wait for a free slot, then count the request in flight
+    async def acquire(self):
+        async with self.changed:
+            while True:
+                wait = self.resumeAt - time.time()
+                if wait <= 0 and self.inFlight < int(self.limit):
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout=wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            self.inFlight += 1
+
+    # Learn from the outcome of a request: statusCode is None when it never got a response
+    async def release(self, statusCode, retryAfter=None):
+        async with self.changed:
+            self.inFlight -= 1
+            if statusCode == 429:
+                self.failures += 1
+                self.limit = max(1.0, self.limit / 2)
+                delay = retryAfterSecs(retryAfter) or min(sleepSecs * 2 ** (self.failures - 1), maxBackoffSecs)
+                delay *= random.uniform(1, 1.5)  # spread out workers that hit 429 together
+                self.resumeAt = max(self.resumeAt, time.time() + delay)
+                print(f"{dateAsString()} ⁝ {self}, backing off {delay:.1f}s")
+            elif statusCode is not None and statusCode < 400:
+                self.failures = 0
+                self.limit = min(float(self.maxLimit), self.limit + 1 / self.limit)
+            self.changed.notify_all()
+
+    def __str__(self):
+        return f"{self.name} limit {self.limit:.1f}, in flight {self.inFlight}"
+
+# Retry-After is either seconds or an HTTP date
+def retryAfterSecs(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+rateControllers = {}  # (api, channel / account) → RateController
+
+# The rate controller shared by every request to api, per channel / account when one is pinned
+def rateController(api, account=None):
+    key = (api, account)
+    if key not in rateControllers:
+        rateControllers[key] = RateController(f"{api} {account}" if account else api, maxConcurrency[api])
+    return rateControllers[key]
+
+# Spreads jobs over the configured Midjourney channels: every job goes to the least loaded one with free capacity
+# and holds a slot there until its terminal webhook. A channel that answers 596 (pending moderation / CAPTCHA)
+# is out of rotation until it is reset. With nothing configured the API selects the channel.
+class ChannelPool:
+    def __init__(self, kind, spec, capacity):
+        self.kind = kind
+        self.capacity = {}  # name → jobs it runs at the same time, from "name:jobs,…"
+        for entry in spec.split(','):
+            name, _, size = entry.strip().partition(':')
+            if name:
+                self.capacity[name] = int(size or capacity)
+        self.inFlight = dict.fromkeys(self.capacity, 0)
+        self.disabled = set()
+        self.jobs = {}  # jobid → name, see started()
+        self.changed = asyncio.Condition()
 
-        fn, args = self.queue.pop(0)
+    # Wait for a slot on the least loaded channel in rotation. Returns None when no channel is configured or every
+    # channel is out of rotation: the API selects one.
+    async def acquire(self):
+        if not self.capacity:
+            return None
+        async with self.changed:
+            while True:
+                names = [n for n in self.capacity if n not in self.disabled]
+                if not names:
+                    return None
+                best = min(names, key=lambda n: self.inFlight[n] / self.capacity[n])
+                if self.inFlight[best] < self.capacity[best]:
+                    self.inFlight[best] += 1
+                    return best
+                await self.changed.wait()
 
+    # Give the slot back: the job was not accepted, or it reached a terminal state
+    async def release(self, name):
+        if name in self.inFlight:
+            async with self.changed:
+                self.inFlight[name] -= 1
+                self.changed.notify_all()
+
+    # The job was accepted: it holds its slot until finished() sees its terminal state
+    def started(self, ref, name):
+        if name in self.inFlight:
+            self.jobs[ref] = name
+
+    async def finished(self, ref):
+        await self.release(self.jobs.pop(ref, None))
+
+    # 596 — pending moderation / CAPTCHA: resolve it in Discord, then POST /accounts/{channel}/reset
+    async def disable(self, name):
+        if name in self.capacity and name not in self.disabled:
+            self.disabled.add(name)
+            print(f"{dateAsString()} ⁝ {self.kind} {name} out of rotation until it is reset")
+        await self.release(name)
+
+    async def enable(self, name):
+        async with self.changed:
+            self.disabled.discard(name)
+            self.changed.notify_all()
+        print(f"{dateAsString()} ⁝ {self.kind} {name} back in rotation")
+
+    def __str__(self):
+        return f"{self.kind} " + ', '.join(
+            f"{n} {self.inFlight[n]}/{self.capacity[n]}" + (' out of rotation' if n in self.disabled else '') for n in self.capacity
+        )
+
+midjourneyChannels = ChannelPool('midjourney', channels, channelCapacity)
+
+async def handle_get(request):
+    return web.Response(text='Hello from ngrok server')
+
+# Prometheus scrape target: GET /metrics on the webhook server
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+# Webhook callback: acknowledged right away, so a slow download never delays the response, and queued
+async def handle_post(request):
+    # v3 callback body has the same JSON shape as GET /jobs/{jobid}
+    webhooks.put_nowait(await request.json())
+    return web.Response(text='ok')
+
+# Webhook worker, webhookWorkers of them process queued webhooks concurrently
+async def processWebhooks():
+    while True:
+        job = await webhooks.get()
         try:
-            self.is_function_running = True
-            await fn(*args)
+            await processJob(job)
         except Exception as error:
             print('An error occurred:', error)
-        finally:
-            self.is_function_running = False
-            await self.process_queue()
 
-# Create async query
-queue = AsyncFunctionQueue()
+# Handle a job state, delivered by webhook or polled with GET /jobs/{jobid}
+async def processJob(job):
+    status = job.get('status')
+    jobid = job.get('jobid')
+    replyRef = (job.get('request') or {}).get('replyRef') or (job.get('response') or {}).get('replyRef') or job.get('replyRef')
+    # In v3 generated media and content are nested under job['response']
+    response = job.get('response') or {}
+    content = response.get('content') or ''
+    attachments = response.get('attachments')
+    url = attachments[0]['url'] if attachments else None
+
+    print(f"{dateAsString()} ⁝ webhook #{replyRef} {jobid} {status} {content[:20]}…{content[-20:]}")
+
+    # On a terminal state we can download (if any) and start another prompt
+    if status in ('completed', 'moderated', 'failed', 'cancelled'):
+        await midjourneyChannels.finished(jobid)
+        metrics.end(jobid, 'midjourney')
+        if replyRef not in results or results[replyRef].get('status') in ('completed', 'moderated', 'failed', 'cancelled'):
+            return  # duplicate delivery of a job we already finished, see finishJob()
+        if jobid in resumed:
+            resumed.remove(jobid)  # a resumed job reported back before it was polled
 
-# Webhook callback
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+        if url:
+            downloader.submit(url, f"./{int(replyRef)}-{getFilenameFromUrl(url)}", finishJob, replyRef, job)
+        else:
+            await finishJob(None, replyRef, job)
+    elif replyRef in results:
+        results[replyRef] = job
+        journal.save(replyRef)
 
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b'Hello from ngrok server')
+# Record a finished job and start another prompt, once its image (if any) is on disk
+async def finishJob(localPath, replyRef, job):
+    # Recorded once the download is done, so --resume fetches it again if we stop midway.
+    # Its final state leaves memory for result.done.jsonl, see Journal.retire()
+    if localPath:
+        job['file'] = localPath
+    results[replyRef] = job
+    journal.retire(replyRef)
 
-    def do_POST(self):
-        global results
-        global webhook_ind
+    promptFinished()
 
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
+# Row of the stages / artefacts tables for a result, see JobStore: (node, jobid, replyRef, stage, status, files)
+# of its imagine job; a submission rejected with 596 has no jobid
+def nodesOf(result):
+    replyRef = (result.get('request') or {}).get('replyRef')
+    yield 'imagine', result.get('jobid'), replyRef, 'imagine', result.get('status') or 'rejected', {'image': result.get('file')}
 
-        # v3 callback body has the same JSON shape as GET /jobs/{jobid}
-        job = json.loads(post_data.decode('utf-8'))
+# Number of prompts submitted and still waiting for their terminal webhook
+def inFlight():
+    return started - webhook_ind
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b"ok")
+# Next prompt not yet submitted, read from promptsFile only when it is about to be submitted
+def nextPrompt():
+    global prompts_read
+    for ind, text in prompts:
+        prompts_read = ind + 1
+        if f"{ind}" not in known:
+            return ind, text
+    return None
 
-        status = job.get('status')
-        jobid = job.get('jobid')
-        replyRef = (job.get('request') or {}).get('replyRef') or (job.get('response') or {}).get('replyRef') or job.get('replyRef')
-        # In v3 generated media and content are nested under job['response']
-        response = job.get('response') or {}
-        content = response.get('content') or ''
-        attachments = response.get('attachments')
-        url = attachments[0]['url'] if attachments else None
+# A prompt finished: wake submit() if a busy channel made it wait, and main() if it was the last one
+def promptFinished():
+    global webhook_ind
+    webhook_ind += 1
+    jobFinished.set()
+    checkDone()
 
-        print(f"{dateAsString()} ⁝ webhook #{replyRef} {jobid} {status} {content[:20]}…{content[-20:]}")
+# Set allDone once every prompt was read and none is left in flight
+def checkDone():
+    if exhausted and inFlight() == 0:
+        allDone.set()
 
-        results[replyRef] = job
+# Jobs still running when a previous run stopped report to its webhook url, and --stream jobs whose stream ended
+# early report nowhere, so both are polled instead
+async def pollResumed():
+    while True:
+        await asyncio.sleep(sleepSecs)
 
-        # On a terminal state we can download (if any) and start another prompt
-        if status in ('completed', 'moderated', 'failed', 'cancelled'):
-            if url:
-                downloadFile(url, int(replyRef))
+        for jobid in list(resumed):
+            # A network error, a 429 or a 5xx answer is logged and the job polled again on the next pass
+            try:
+                response = await asyncio.to_thread(session.get, f"{rootUrl}/jobs/{jobid}", headers=authHeaders)
 
-            queue.enqueue(submit)
+                if jobid not in resumed:
+                    continue  # reported back by webhook meanwhile
+                if response.status_code == 429 or response.status_code >= 500:
+                    print(f"{dateAsString()} ⁝ resumed {jobid} HTTP {response.status_code}, polling again")
+                elif response.status_code != 200:
+                    print(f"Unexpected response.status: {response.status_code}, result: {response.text}")
+                    resumed.remove(jobid)
+                    promptFinished()
+                else:
+                    job = response.json()
+                    if job.get('status') in ('completed', 'moderated', 'failed', 'cancelled'):
+                        resumed.remove(jobid)
+                        await processJob(job)
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ resumed {jobid} poll failed, polling again: {error}")
 
-            webhook_ind += 1
+# Separate session for --stream: a followed job holds its connection until the job ends, so streams must not
+# count against the pooled connections used by the other API calls and downloads
+def getStreamSession():
+    global stream_session
+    if stream_session is None or stream_session.closed:
+        stream_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=None))
+    return stream_session
+
+# POST a job with stream: true. Returns the HTTP status, Retry-After, the first job state and the rest of the
+# server-sent events, or None in their place when the API answered with plain JSON (e.g. 429 / 596)
+async def postStream(url, body):
+    response = await getStreamSession().post(url, headers=jsonHeaders, json=body)
+    if response.content_type != 'text/event-stream':
+        async with response:
+            return response.status, response.headers.get('Retry-After'), await response.json(), None
+    events = readEvents(response)
+    # An event stream means the job was created, reported as 201 like the JSON response
+    return 201, None, await events.__anext__(), events
+
+# Server-sent events of a streamed job: every "data:" line carries the job state as JSON
+async def readEvents(response):
+    async with response:
+        async for line in response.content:
+            line = line.decode().strip()
+            if line.startswith('data:'):
+                yield json.loads(line[5:])
+
+# Handle every further event of a streamed job like its webhook. A job whose stream ends early is polled instead
+async def followStream(jobid, events):
+    job = {}
+    try:
+        async for job in events:
+            await processJob(job)
+    except Exception as error:
+        print(f"{dateAsString()} ⁝ stream {jobid} failed:", error)
+    if job.get('status') not in ('completed', 'moderated', 'failed', 'cancelled') and jobid not in resumed:
+        resumed.append(jobid)
+
+# GET /accounts/{channel}, see https://useapi.net/docs/api-midjourney-v3/get-midjourney-accounts-channel
+async def getAccount(name):
+    response = await asyncio.to_thread(session.get, f"{rootUrl}/accounts/{name}", headers=authHeaders)
+    return response.json() if response.status_code == 200 else None
+
+# Channels taken out of rotation by a 596 rejoin it once POST /accounts/{channel}/reset cleared their error
+async def watchChannels():
+    while True:
+        await asyncio.sleep(channelCheckSecs)
+
+        for name in list(midjourneyChannels.disabled):
+            # A failed check leaves the channel out of rotation until the next pass
+            try:
+                account = await getAccount(name)
+                if account is not None and not account.get('error'):
+                    await midjourneyChannels.enable(name)
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ checking channel {name} failed: {error}")
 
 def dateAsString():
     return datetime.datetime.now().isoformat()
@@ -126,92 +549,538 @@ def loadFromFile(filePath):
         print(f'Unable to load file: {filePath}. Error: {error}')
     sys.exit(1)
 
+# Write JSON to a temp file and atomically rename it, so filePath is never left half-written
 def saveToFile(filePath, data):
     try:
-        with open(filePath, 'w') as file:
+        tmpPath = f"{filePath}.tmp"
+        with metrics.timer('save'), open(tmpPath, 'w') as file:
             json.dump(data, file, indent=2)
+        os.replace(tmpPath, filePath)
+        return True
     except Exception as error:
         print(f'Error writing to file: {error}')
+        return False
+
+# Append-only journal of state changes. Each change appends the changed entry as one JSON line
+# to result.jsonl instead of rewriting the whole result.json. Every compactEvery records the
+# journal is compacted into a fresh result.json snapshot (temp file + atomic rename) and truncated.
+# Finished entries are retired to result.done.jsonl, so snapshots only hold the entries still in memory.
+class Journal:
+    def __init__(self, filePath, data):
+        self.filePath = filePath
+        self.journalPath = journalPathFor(filePath)
+        self.donePath = donePathFor(filePath)
+        self.data = data
+        self.records = 0
+        self.retired = 0
+        self.file = open(self.journalPath, 'a')
+        self.doneFile = open(self.donePath, 'a')
+
+    # Journal the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer('journal'):
+            self.file.write(json.dumps({'key': key, 'value': self.data[key]}) + '\n')
+            self.file.flush()
+        self.records += 1
+        if self.records >= compactEvery:
+            self.compact()
+
+    # Move the finished data[key] out of memory: its final state is appended to result.done.jsonl
+    def retire(self, key):
+        with metrics.timer('journal'):
+            self.doneFile.write(json.dumps({'key': key, 'value': self.data.pop(key)}) + '\n')
+            self.doneFile.flush()
+        self.retired += 1
+
+    # Snapshot data to result.json, then start a fresh journal
+    def compact(self):
+        if saveToFile(self.filePath, self.data):
+            self.file.close()
+            self.file = open(self.journalPath, 'w')
+            self.records = 0
+            # Until the first retire() the snapshot holds every entry, result.done.jsonl ones included
+            if not self.retired:
+                self.doneFile.close()
+                self.doneFile = open(self.donePath, 'w')
+
+    # Final result.json of the run: every entry, the ones retired to result.done.jsonl included, like --compact
+    def finish(self):
+        self.data.update({**loadJournal(self.filePath), **self.data})
+        self.retired = 0  # the snapshot holds the retired entries again
+        self.compact()
+
+def journalPathFor(filePath):
+    return os.path.splitext(filePath)[0] + '.jsonl'
+
+def donePathFor(filePath):
+    return os.path.splitext(filePath)[0] + '.done.jsonl'
+
+# Rebuild state from the last result.json snapshot replayed with every change journaled after it,
+# then with the final state of every entry retired since
+def loadJournal(filePath):
+    data = {}
+    if os.path.exists(filePath):
+        data = loadFromFile(filePath)
+    for path in (journalPathFor(filePath), donePathFor(filePath)):
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+                    data[record['key']] = record['value']
+    return data
+
+# SQLite job store in WAL mode, kept in result.db instead of result.json / result.jsonl with --sqlite. It has the
+# interface of Journal: save() upserts the entry into the jobs table and its nodes into stages / artefacts, indexed
+# by jobid, replyRef and status, so another process can query a run while it goes on, see printProgress().
+# retire() marks a finished entry done and drops it from memory. Nothing is ever rewritten whole.
+class JobStore:
+    def __init__(self, filePath, data, resume):
+        self.data = data
+        self.db = openJobStore(filePath)
+        if resume:
+            # Entries finished in an earlier run are already stored with their final state
+            self.done = {key for key, in self.db.execute('SELECT key FROM jobs WHERE done = 1')}
+        else:
+            self.done = set()
+            with self.db:
+                for table in ('jobs', 'stages', 'artefacts'):
+                    self.db.execute(f"DELETE FROM {table}")
+
+    # Store the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer('journal'):
+            self.write(key, self.data[key], False)
+
+    # Move the finished data[key] out of memory: it stays in the store, marked done
+    def retire(self, key):
+        value = self.data.pop(key)
+        if key in self.done:
+            return
+        with metrics.timer('journal'):
+            self.write(key, value, True)
+
+    # One transaction per entry: the entry itself, then every node of it (stage, status, files)
+    def write(self, key, value, done):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO jobs (key, value, done, updated) VALUES (?, ?, ?, ?)', (key, json.dumps(value), int(done), time.time()))
+            for node, jobid, replyRef, stage, status, files in nodesOf(value):
+                self.db.execute(
+                    'INSERT OR REPLACE INTO stages (key, node, jobid, replyRef, stage, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, node, jobid, replyRef, stage, status),
+                )
+                for kind, path in files.items():
+                    if path:
+                        self.db.execute('INSERT OR REPLACE INTO artefacts (path, key, node, kind) VALUES (?, ?, ?, ?)', (path, key, node, kind))
+
+    # The store is never snapshotted, only the WAL is folded back into result.db
+    def compact(self):
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # result.db already holds every entry, finished ones included
+    def finish(self):
+        self.compact()
+
+def openJobStore(filePath):
+    db = sqlite3.connect(filePath, check_same_thread=False)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')  # a commit is durable once the WAL is checkpointed, never corrupt
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (key PRIMARY KEY, value TEXT NOT NULL, done INTEGER NOT NULL, updated REAL);
+        CREATE TABLE IF NOT EXISTS stages (key, node TEXT, jobid TEXT, replyRef TEXT, stage TEXT, status TEXT, PRIMARY KEY (key, node));
+        CREATE TABLE IF NOT EXISTS artefacts (path TEXT PRIMARY KEY, key, node TEXT, kind TEXT);
+        CREATE INDEX IF NOT EXISTS jobs_done ON jobs (done);
+        CREATE INDEX IF NOT EXISTS stages_jobid ON stages (jobid);
+        CREATE INDEX IF NOT EXISTS stages_replyRef ON stages (replyRef);
+        CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status);
+        CREATE INDEX IF NOT EXISTS artefacts_key ON artefacts (key);
+        """
+    )
+    return db
+
+# Every entry in result.db, like loadJournal()
+def loadJobStore(filePath):
+    return {key: json.loads(value) for key, value in openJobStore(filePath).execute('SELECT key, value FROM jobs')}
+
+# python3 ./example.py --progress prints how far the run stored in result.db got, also while it is still running
+def printProgress(filePath):
+    if not os.path.exists(filePath):
+        print(f"{dateAsString()} ⁝ {filePath} not found, start the run with --sqlite")
+        return
+    db = sqlite3.connect(f"file:{filePath}?mode=ro", uri=True)
+    total, done = db.execute('SELECT COUNT(*), COALESCE(SUM(done), 0) FROM jobs').fetchone()
+    print(f"{dateAsString()} ⁝ prompts: {total}, finished: {done}")
+    for stage, status, count in db.execute('SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status ORDER BY stage, status'):
+        print(f"{dateAsString()} ⁝ {stage} {status}: {count}")
+    for kind, count in db.execute('SELECT kind, COUNT(*) FROM artefacts GROUP BY kind ORDER BY kind'):
+        print(f"{dateAsString()} ⁝ {kind} files: {count}")
+
+# Read prompts one at a time instead of loading the whole file: .jsonl holds one JSON string or {"prompt": …}
+# object per line, .csv a prompt column; a .json array is still loaded at once
+def readPrompts(filePath):
+    if filePath.endswith('.json'):
+        return iter(loadFromFile(filePath))
+    try:
+        file = open(filePath, 'r', newline='')
+    except OSError as error:
+        print(f'Unable to load file: {filePath}. Error: {error}')
+        sys.exit(1)
+
+    def lines():
+        with file:
+            if filePath.endswith('.csv'):
+                for row in csv.DictReader(file):
+                    yield row['prompt']
+            else:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        yield entry['prompt'] if isinstance(entry, dict) else entry
+
+    return lines()
 
 # Extract filename.png from https://cdn.discordapp.com/attachments/server_id/channel_id/filename.png?ex=
 def getFilenameFromUrl(url):
     return url.split("/")[-1].split("?")[0]
 
-def downloadFile(url, ind):
-    localPath = f"./{ind}-{getFilenameFromUrl(url)}"
-    response = requests.get(url)
-    with open(localPath, 'wb') as file:
-        file.write(response.content)
+# Stream url to localPath in chunks through a temp file and atomic rename. Returns bytes fetched and seconds taken.
+# Files already downloaded are skipped, an interrupted download resumes from its .part file with a Range request,
+# and content identical to a file already on disk is stored once, see Manifest.
+def downloadFile(url, localPath):
+    key = url.split('?')[0]  # CDN urls carry expiring signatures in the query string
+
+    # The same url downloaded before, possibly under another name
+    existingPath = manifest.findUrl(key)
+    if existingPath:
+        linkFile(existingPath, localPath)
+        print(f"{dateAsString()} ⁝ {localPath} already downloaded, skipping")
+        return 0, 0
+
+    started = time.time()
+    tmpPath = f"{localPath}.part"
+    offset = os.path.getsize(tmpPath) if os.path.exists(tmpPath) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = f"bytes={offset}-"
+    record = manifest.get(localPath)
+    if record and record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+
+    sha256 = hashlib.sha256()
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:  # Not Modified — localPath matches the ETag we recorded for it
+            print(f"{dateAsString()} ⁝ {localPath} not modified, skipping")
+            return 0, 0
+        if response.status_code == 416:  # Range Not Satisfiable — the partial file is stale, start over
+            os.remove(tmpPath)
+            return downloadFile(url, localPath)
+        response.raise_for_status()
+
+        if response.status_code == 206 and response.headers.get('Content-Range', '').startswith(f"bytes {offset}-"):
+            # Resume the partial file of an interrupted download; hash what is already on disk first
+            with open(tmpPath, 'rb') as file:
+                for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+                    sha256.update(chunk)
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+
+        size = offset
+        with open(tmpPath, mode) as file:
+            for chunk in response.iter_content(chunk_size=downloadChunkSize):
+                file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        etag = response.headers.get('ETag')
+
+    digest = sha256.hexdigest()
+    existingPath = manifest.findHash(digest)
+    if existingPath and existingPath != localPath:
+        # Identical media is already on disk under another name
+        os.remove(tmpPath)
+        linkFile(existingPath, localPath)
+    else:
+        os.replace(tmpPath, localPath)
+    manifest.add({'path': localPath, 'url': key, 'size': size, 'etag': etag, 'sha256': digest})
+
+    fetched = size - offset
+    secs = max(time.time() - started, 0.001)
+    resumedFrom = f", resumed at {offset / 1048576:.1f} MB" if offset else ''
+    print(f"{dateAsString()} ⁝ downloaded {localPath} {fetched / 1048576:.1f} MB in {secs:.1f}s, {fetched / secs / 1048576:.1f} MB/s{resumedFrom}")
+    return fetched, secs
+
+# Store identical media once: localPath becomes a hard link to the copy already on disk
+def linkFile(existingPath, localPath):
+    if os.path.exists(localPath):
+        if os.path.samefile(existingPath, localPath):
+            return
+        os.remove(localPath)
+    try:
+        os.link(existingPath, localPath)
+    except OSError:
+        shutil.copyfile(existingPath, localPath)  # file system without hard links
+
+# Content-hash manifest of downloaded media, appended to downloads.jsonl as one JSON line per file.
+# Lets reruns skip files already on disk and finds identical media by url or sha256.
+class Manifest:
+    def __init__(self, filePath):
+        self.paths = {}  # localPath → record
+        self.urls = {}  # url without query string → localPath
+        self.hashes = {}  # sha256 → localPath
+        self.lock = threading.Lock()
+        if os.path.exists(filePath):
+            with open(filePath, 'r') as file:
+                for line in file:
+                    try:
+                        self.index(json.loads(line))
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+        self.file = open(filePath, 'a')
+
+    def index(self, record):
+        self.paths[record['path']] = record
+        self.urls[record['url']] = record['path']
+        self.hashes[record['sha256']] = record['path']
+
+    # Path of the file downloaded from url, if still intact on disk
+    def findUrl(self, url):
+        return self.intact(self.urls.get(url))
+
+    # Path of a file with this content, if still intact on disk
+    def findHash(self, sha256):
+        return self.intact(self.hashes.get(sha256))
+
+    # Record of localPath, if the file on disk still matches it
+    def get(self, localPath):
+        return self.paths[localPath] if self.intact(localPath) else None
+
+    def intact(self, path):
+        record = self.paths.get(path)
+        if record and os.path.exists(path) and os.path.getsize(path) == record['size']:
+            return path
+        return None
+
+    def add(self, record):
+        with self.lock:
+            self.index(record)
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+# Bounded pool of download threads, so webhook handling never waits on a large file. Once a file is in place
+# fn(localPath, *args) is awaited on the event loop, which owns data and the journal (localPath is None on failure).
+class Downloader:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.active = {}  # localPath → download task
+        self.files = 0
+        self.bytes = 0
+        self.secs = 0
+
+    def submit(self, url, localPath, fn, *args):
+        # A duplicate webhook for a file that is already downloading is ignored
+        if localPath in self.active:
+            return
+        self.active[localPath] = asyncio.create_task(self.fetch(url, localPath, fn, args))
+
+    async def fetch(self, url, localPath, fn, args):
+        try:
+            size, secs = await asyncio.get_running_loop().run_in_executor(self.pool, downloadFile, url, localPath)
+        except Exception as error:
+            print(f"{dateAsString()} ⁝ download {url} failed: {error}")
+            size, secs = None, 0
+        del self.active[localPath]
+        if size is not None:
+            self.files += 1
+            self.bytes += size
+            self.secs += secs
+            metrics.observe('download', secs)
+        try:
+            await fn(localPath if size is not None else None, *args)
+        except Exception as error:
+            print('An error occurred:', error)
+
+    def __str__(self):
+        rate = self.bytes / max(self.secs, 0.001) / 1048576
+        return f"downloaded {self.files} files, {self.bytes / 1048576:.1f} MB, {rate:.1f} MB/s per download"
 
 async def submit():
-    global prompt_ind
-    global webhook_ind
-    global results
+    global prompt
+    global exhausted
+    global started
+
+    while not exhausted:
 
-    while prompt_ind < len(prompts):
+        if prompt is None:
+            prompt = nextPrompt()
+        if prompt is None:
+            exhausted = True
+            print(f"{dateAsString()} ⁝ prompts read: {prompts_read}")
+            checkDone()
+            return
 
-        replyRef = f"{prompt_ind}"
+        ind, text = prompt
+        replyRef = f"{ind}"
 
-        print(f"{dateAsString()} ⁝ prompt #{prompt_ind} {prompts[prompt_ind]}")
+        print(f"{dateAsString()} ⁝ prompt #{ind} {text}")
 
         # Detailed documentation at https://useapi.net/docs/api-midjourney-v3/post-midjourney-jobs-imagine
         body = {
-            'stream': False,  # stream defaults to true (SSE); set false to get the immediate JSON job state
-            'prompt': f"{prompts[prompt_ind]} {withParams}".strip(),
+            'stream': streaming,  # stream defaults to true (SSE); set false to get the immediate JSON job state
+            'prompt': f"{text} {withParams}".strip(),
             'replyRef': replyRef,
-            'replyUrl': f"{listener.url()}?ind={prompt_ind}"
         }
+        if webhookUrl:
+            body['replyUrl'] = f"{webhookUrl}?ind={ind}"
         # channel is optional — API auto-selects a channel with capacity when omitted
-        if channel:
-            body['channel'] = channel
-
-        headers = {
-            'Authorization': f"Bearer {token}",
-            'Content-Type': 'application/json'
-        }
-
-        response = requests.post(f"{rootUrl}/jobs/imagine", headers=headers, data=json.dumps(body))
+        account = await midjourneyChannels.acquire()
+        if account:
+            body['channel'] = account
 
-        result = response.json()
+        controller = rateController('midjourney', account)
+        await controller.acquire()
+        events = None
+        try:
+            with metrics.timer('submit', 'midjourney'):
+                if streaming:
+                    status_code, retryAfter, result, events = await postStream(f"{rootUrl}/jobs/imagine", body)
+                else:
+                    # requests is blocking, so the call runs on a thread to keep the webhook receiver responsive
+                    response = await asyncio.to_thread(session.post, f"{rootUrl}/jobs/imagine", headers=jsonHeaders, data=json.dumps(body))
+                    status_code, retryAfter, result = response.status_code, response.headers.get('Retry-After'), response.json()
+        except Exception as error:
+            # submit() is the only submitter, so it keeps the prompt and tries again instead of giving up
+            await controller.release(None)
+            await midjourneyChannels.release(account)
+            print(f"{dateAsString()} ⁝ #{ind} submit failed, retrying in {sleepSecs} secs: {error}")
+            await asyncio.sleep(sleepSecs)
+            continue
+        await controller.release(status_code, retryAfter)
 
-        print(f"{dateAsString()} ⁝ response #{prompt_ind} HTTP {response.status_code} {{ jobid: {result.get('jobid')}, status: {result.get('status')} }}")
+        print(f"{dateAsString()} ⁝ response #{ind} HTTP {status_code} {{ jobid: {result.get('jobid')}, status: {result.get('status')} }}")
 
-        if response.status_code == 201:  # Created — job accepted; its terminal state will arrive via webhook
+        if status_code == 201:  # Created — job accepted; its terminal state will arrive via webhook or its event stream
+            midjourneyChannels.started(result.get('jobid'), account)
+            metrics.begin(result.get('jobid'))
             results[replyRef] = result
-            prompt_ind += 1
-        elif response.status_code == 429:  # Channel at capacity or rate limited
-            if prompt_ind - webhook_ind > 0:
-                # Jobs in flight: stop submitting and let the webhook resume us on completion
-                return
-            else:
-                # Nothing in flight: wait and try again
-                time.sleep(sleepSecs)
-        elif response.status_code == 596:  # Channel pending moderation/CAPTCHA — resolve in Discord, then POST /accounts/{channel}/reset
-            print(f"{dateAsString()} ⁝ #{prompt_ind} channel pending moderation/CAPTCHA — resolve in Discord, then POST /accounts/{{channel}}/reset: {result}")
+            journal.save(replyRef)
+            started += 1
+            prompt = None
+            if events:
+                task = asyncio.create_task(followStream(result.get('jobid'), events))
+                streams.add(task)
+                task.add_done_callback(streams.discard)
+        elif status_code == 429:  # Channel at capacity or rate limited
+            await midjourneyChannels.release(account)
+            if inFlight() > 0:
+                # Jobs in flight: wait until one of them finished, see promptFinished()
+                jobFinished.clear()
+                await jobFinished.wait()
+            # Then try again once the rate controller's backoff is over
+            continue
+        elif status_code == 596:  # Channel pending moderation/CAPTCHA — resolve in Discord, then POST /accounts/{channel}/reset
+            print(f"{dateAsString()} ⁝ #{ind} channel pending moderation/CAPTCHA — resolve in Discord, then POST /accounts/{{channel}}/reset: {result}")
+            await midjourneyChannels.disable(account)
             results[replyRef] = result
-            webhook_ind += 1  # no webhook will arrive for this prompt
-            prompt_ind += 1
+            journal.retire(replyRef)
+            started += 1
+            promptFinished()  # no webhook will arrive for this prompt
+            prompt = None
         else:
-            print(f"Unexpected response.status: {response.status_code}, result: {result}")
-            webhook_ind += 1  # no webhook will arrive for this prompt
-            prompt_ind += 1
+            print(f"Unexpected response.status: {status_code}, result: {result}")
+            await midjourneyChannels.release(account)
+            started += 1
+            promptFinished()  # no webhook will arrive for this prompt
+            prompt = None
+
+# python3 ./example.py --compact rebuilds result.json from result.json + result.jsonl + result.done.jsonl and exits;
+# with --sqlite it exports result.db to result.json instead
+if '--compact' in sys.argv:
+    Journal('./result.json', loadJobStore('./result.db') if useJobStore else loadJournal('./result.json')).compact()
+    sys.exit(0)
+
+if '--progress' in sys.argv:
+    printProgress('./result.db')
+    sys.exit(0)
+
+# https://github.com/ngrok/ngrok-python — not needed with --stream, job states are streamed instead
+listener = None
+if streaming:
+    webhookUrl = None
+elif not webhookUrl:
+    listener = ngrok.forward(8081, authtoken_from_env=True)
+    webhookUrl = listener.url()
+
+if webhookUrl:
+    print(f"Webhook {webhookUrl}")
+
+prompts = enumerate(readPrompts(promptsFile))
+
+if '--resume' in sys.argv:
+    # Continue the previous run instead of submitting every prompt again
+    results.update(loadJobStore('./result.db') if useJobStore else loadJournal('./result.json'))
+    known.update(results)
+
+# Persist results to the file for debugging purposes; only prompts still running are kept in memory
+journal = JobStore('./result.db', results, '--resume' in sys.argv) if useJobStore else Journal('./result.json', results)
+journal.compact()
+
+finished = 0
+for replyRef in list(results):
+    result = results[replyRef]
+    if result.get('jobid') and result.get('status') not in ('completed', 'moderated', 'failed', 'cancelled'):
+        resumed.append(result['jobid'])
+        started += 1
+    else:
+        journal.retire(replyRef)  # finished, or rejected with no jobid (596)
+        finished += 1
+
+if resumed or finished:
+    print(f"{dateAsString()} ⁝ resuming, prompts finished: {finished}, running: {len(resumed)}")
+
+downloader = Downloader(maxDownloads)
+manifest = Manifest('./downloads.jsonl')
+
+async def main():
+    app = web.Application()
+    app.router.add_get('/', handle_get)
+    app.router.add_post('/', handle_post)
+    app.router.add_get('/metrics', handle_metrics)
 
-        # Persist results to the file for debugging purposes
-        saveToFile('./result.json', results)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=8081).start()
 
-prompts = loadFromFile('./prompts.json')
+    tasks = [asyncio.create_task(processWebhooks()) for _ in range(webhookWorkers)]
+    tasks.append(asyncio.create_task(pollResumed()))
+    tasks.append(asyncio.create_task(watchChannels()))
 
-print(f"{dateAsString()} ⁝ prompts to process: {len(prompts)}")
+    await queue.enqueue(submit)
 
-httpd = HTTPServer(('', 8081), SimpleHTTPRequestHandler)
+    await allDone.wait()
 
-start_time = time.time()
+    for task in tasks:
+        task.cancel()
+    await runner.cleanup()
+    if stream_session is not None:
+        await stream_session.close()
 
-queue.enqueue(submit)
+    print(f"{dateAsString()} ⁝ {downloader}")
+    for controller in rateControllers.values():
+        print(f"{dateAsString()} ⁝ {controller}")
+    if midjourneyChannels.capacity:
+        print(f"{dateAsString()} ⁝ {midjourneyChannels}")
 
-while webhook_ind < len(prompts):
-    httpd.handle_request()
+    journal.finish()
 
-execution_time = time.time() - start_time
+asyncio.run(main())
 
-print(f"{dateAsString()}  ⁝  total elapsed time {datetime.datetime.utcfromtimestamp(execution_time).strftime('%H:%M:%S')}")
+for line in metrics.summary():
+    print(f"{dateAsString()} ⁝ {line}")
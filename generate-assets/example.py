@@ -6,17 +6,95 @@
 #
 # USEAPI_CHANNEL is optional with the Midjourney API v3 — when omitted the API
 # automatically selects a configured channel with available capacity.
+# USEAPI_CHANNELS="channel[:jobs],…" spreads the prompts over several configured channels instead, least loaded first.
+#
+# Optional environment variables:
+#   MAX_JOBS  - number of prompts processed concurrently (submit → poll → download).
+#               When omitted (or 1) prompts are submitted one after another without waiting for their jobs.
+#   USEAPI_URL - API host to call instead of https://api.useapi.net, e.g. the local mock server in ../benchmark.
+#   PROMPTS_FILE - prompts to read instead of ./prompts.json, one at a time: a .jsonl file with one JSON string
+#                  per line or a .csv file with a prompt column.
+#
+# python3 ./example.py --resume continues a run that stopped midway: jobs recorded in result.json / result.jsonl
+# are polled (or skipped once finished) instead of being submitted again.
+#
+# python3 ./example.py --sqlite keeps the job state in a SQLite database, result.db, instead of result.json and
+# result.jsonl; python3 ./example.py --progress reports on it from another terminal while the run goes on.
 #
 
 import datetime
 import os
+import hashlib
+import shutil
 import time
+import random
+import email.utils
 import requests
 import json
+import sqlite3
 import sys
+import threading
+import heapq
+import bisect
+import contextlib
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
+# Load all required parameters from the environment variables
+token = os.getenv('USEAPI_TOKEN')
+apiUrl = os.getenv('USEAPI_URL') or 'https://api.useapi.net'  # optional, see ../benchmark
+promptsFile = os.getenv('PROMPTS_FILE') or './prompts.json'  # optional, .json, .jsonl or .csv
+channel = os.getenv('USEAPI_CHANNEL')  # optional in v3
+channels = os.getenv('USEAPI_CHANNELS') or channel or ''  # optional, channel[:jobs],…
 # Midjourney API v3 root url
-rootUrl = 'https://api.useapi.net/v3/midjourney'
+rootUrl = f"{apiUrl}/v3/midjourney"
+# Maximum number of jobs in flight at the same time
+maxJobs = int(os.getenv('MAX_JOBS') or 1)
+# You can use https://webhook.site if you want to receive results via callback.
+replyUrl = None
+# Time to pause after a 429 without Retry-After, in seconds; it doubles on every consecutive 429 up to maxBackoffSecs
+sleepSecs = 5
+maxBackoffSecs = 60
+# Seconds until the next status check of a job, by the status it last reported: a queued job takes a while to
+# start, a running one is checked more often so a finished image is noticed soon after it completes
+pollIntervals = {'created': 5, 'started': 3, 'progress': 2}
+# Seconds until a job whose status check failed (network error, non-JSON answer) is checked again
+pollRetrySecs = 5
+# Maximum number of GET /jobs/{jobid} calls per second, across all jobs
+maxPollsPerSec = 2
+# Running jobs are listed with one GET /jobs at most every listSecs; a job on that list needs no GET /jobs/{jobid}
+listSecs = 2
+# Maximum number of pooled keep-alive connections per host (api.useapi.net, CDN)
+maxConnectionsPerHost = max(maxJobs, 4)
+# Number of journal records written between result.json snapshots
+compactEvery = 1000
+# Keep the job state in the SQLite database result.db instead of result.json / result.jsonl, see JobStore
+useJobStore = '--sqlite' in sys.argv
+# Number of generated images downloaded in parallel, and the chunk size they are streamed to disk in
+maxDownloads = 4
+downloadChunkSize = 1024 * 1024
+# Jobs a channel runs at the same time, unless set per channel in USEAPI_CHANNELS
+channelCapacity = 3
+# Time between checks whether a channel taken out of rotation by a 596 was reset, in seconds
+channelCheckSecs = 60
+# Upper bound of requests in flight that the rate controller may learn; status lookups are sent by the poller
+# thread alone and learn their own limit, so they never queue behind submissions
+maxConcurrency = {'midjourney': maxJobs, 'midjourney status': 1}
+
+authHeaders = {'Authorization': f"Bearer {token}"}
+jsonHeaders = {**authHeaders, 'Content-Type': 'application/json'}
+
+# One pooled session is shared by every API call and download, so connections are kept alive
+# and reused instead of paying a TLS handshake per request.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxConnectionsPerHost, pool_block=True)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+results = {}  # prompt index → result
+# Guards results and the journal when jobs run concurrently
+resultsLock = threading.Lock()
 
 def dateAsString():
     return datetime.datetime.now().isoformat()
@@ -30,136 +108,910 @@ def loadFromFile(filePath):
         print(f'Unable to load file: {filePath}. Error: {error}')
     sys.exit(1)
 
+# Write JSON to a temp file and atomically rename it, so filePath is never left half-written
 def saveToFile(filePath, data):
     try:
-        with open(filePath, 'w') as file:
+        tmpPath = f"{filePath}.tmp"
+        with metrics.timer('save'), open(tmpPath, 'w') as file:
             json.dump(data, file, indent=2)
+        os.replace(tmpPath, filePath)
+        return True
     except Exception as error:
         print(f'Error writing to file: {error}')
+        return False
+
+# Append-only journal of state changes. Each change appends the changed entry as one JSON line
+# to result.jsonl instead of rewriting the whole result.json. Every compactEvery records the
+# journal is compacted into a fresh result.json snapshot (temp file + atomic rename) and truncated.
+# Finished entries are retired to result.done.jsonl, so snapshots only hold the entries still in memory.
+# Callers hold resultsLock.
+class Journal:
+    def __init__(self, filePath, data):
+        self.filePath = filePath
+        self.journalPath = journalPathFor(filePath)
+        self.donePath = donePathFor(filePath)
+        self.data = data
+        self.records = 0
+        self.retired = 0
+        self.file = open(self.journalPath, 'a')
+        self.doneFile = open(self.donePath, 'a')
+
+    # Journal the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer('journal'):
+            self.file.write(json.dumps({'key': key, 'value': self.data[key]}) + '\n')
+            self.file.flush()
+        self.records += 1
+        if self.records >= compactEvery:
+            self.compact()
+
+    # Move the finished data[key] out of memory: its final state is appended to result.done.jsonl
+    def retire(self, key):
+        with metrics.timer('journal'):
+            self.doneFile.write(json.dumps({'key': key, 'value': self.data.pop(key)}) + '\n')
+            self.doneFile.flush()
+        self.retired += 1
+
+    # Snapshot data to result.json, then start a fresh journal
+    def compact(self):
+        # result.json keeps its original shape: a list of results ordered by prompt index
+        if saveToFile(self.filePath, [self.data[key] for key in sorted(self.data)]):
+            self.file.close()
+            self.file = open(self.journalPath, 'w')
+            self.records = 0
+            # Until the first retire() the snapshot holds every entry, result.done.jsonl ones included
+            if not self.retired:
+                self.doneFile.close()
+                self.doneFile = open(self.donePath, 'w')
+
+    # Final result.json of the run: every entry, the ones retired to result.done.jsonl included, like --compact
+    def finish(self):
+        self.data.update({**loadJournal(self.filePath), **self.data})
+        self.retired = 0  # the snapshot holds the retired entries again
+        self.compact()
+
+def journalPathFor(filePath):
+    return os.path.splitext(filePath)[0] + '.jsonl'
+
+def donePathFor(filePath):
+    return os.path.splitext(filePath)[0] + '.done.jsonl'
+
+# Rebuild state from the last result.json snapshot replayed with every change journaled after it,
+# then with the final state of every entry retired since
+def loadJournal(filePath):
+    data = {}
+    if os.path.exists(filePath):
+        data = { item['ind']: item for item in loadFromFile(filePath) }
+    for path in (journalPathFor(filePath), donePathFor(filePath)):
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+                    data[record['key']] = record['value']
+    return data
+
+# SQLite job store in WAL mode, kept in result.db instead of result.json / result.jsonl with --sqlite. It has the
+# interface of Journal: save() upserts the entry into the jobs table and its nodes into stages / artefacts, indexed
+# by jobid, replyRef and status, so another process can query a run while it goes on, see printProgress().
+# retire() marks a finished entry done and drops it from memory. Nothing is ever rewritten whole.
+class JobStore:
+    def __init__(self, filePath, data, resume):
+        self.data = data
+        self.db = openJobStore(filePath)
+        if resume:
+            # Entries finished in an earlier run are already stored with their final state
+            self.done = {key for key, in self.db.execute('SELECT key FROM jobs WHERE done = 1')}
+        else:
+            self.done = set()
+            with self.db:
+                for table in ('jobs', 'stages', 'artefacts'):
+                    self.db.execute(f"DELETE FROM {table}")
+
+    # Store the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer('journal'):
+            self.write(key, self.data[key], False)
+
+    # Move the finished data[key] out of memory: it stays in the store, marked done
+    def retire(self, key):
+        value = self.data.pop(key)
+        if key in self.done:
+            return
+        with metrics.timer('journal'):
+            self.write(key, value, True)
+
+    # One transaction per entry: the entry itself, then every node of it (stage, status, files)
+    def write(self, key, value, done):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO jobs (key, value, done, updated) VALUES (?, ?, ?, ?)', (key, json.dumps(value), int(done), time.time()))
+            for node, jobid, replyRef, stage, status, files in nodesOf(value):
+                self.db.execute(
+                    'INSERT OR REPLACE INTO stages (key, node, jobid, replyRef, stage, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, node, jobid, replyRef, stage, status),
+                )
+                for kind, path in files.items():
+                    if path:
+                        self.db.execute('INSERT OR REPLACE INTO artefacts (path, key, node, kind) VALUES (?, ?, ?, ?)', (path, key, node, kind))
+
+    # The store is never snapshotted, only the WAL is folded back into result.db
+    def compact(self):
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # result.db already holds every entry, finished ones included
+    def finish(self):
+        self.compact()
+
+def openJobStore(filePath):
+    db = sqlite3.connect(filePath, check_same_thread=False)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')  # a commit is durable once the WAL is checkpointed, never corrupt
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (key PRIMARY KEY, value TEXT NOT NULL, done INTEGER NOT NULL, updated REAL);
+        CREATE TABLE IF NOT EXISTS stages (key, node TEXT, jobid TEXT, replyRef TEXT, stage TEXT, status TEXT, PRIMARY KEY (key, node));
+        CREATE TABLE IF NOT EXISTS artefacts (path TEXT PRIMARY KEY, key, node TEXT, kind TEXT);
+        CREATE INDEX IF NOT EXISTS jobs_done ON jobs (done);
+        CREATE INDEX IF NOT EXISTS stages_jobid ON stages (jobid);
+        CREATE INDEX IF NOT EXISTS stages_replyRef ON stages (replyRef);
+        CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status);
+        CREATE INDEX IF NOT EXISTS artefacts_key ON artefacts (key);
+        """
+    )
+    return db
+
+# Every entry in result.db, like loadJournal()
+def loadJobStore(filePath):
+    return {key: json.loads(value) for key, value in openJobStore(filePath).execute('SELECT key, value FROM jobs')}
+
+# python3 ./example.py --progress prints how far the run stored in result.db got, also while it is still running
+def printProgress(filePath):
+    if not os.path.exists(filePath):
+        print(f"{dateAsString()} ⁝ {filePath} not found, start the run with --sqlite")
+        return
+    db = sqlite3.connect(f"file:{filePath}?mode=ro", uri=True)
+    total, done = db.execute('SELECT COUNT(*), COALESCE(SUM(done), 0) FROM jobs').fetchone()
+    print(f"{dateAsString()} ⁝ prompts: {total}, finished: {done}")
+    for stage, status, count in db.execute('SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status ORDER BY stage, status'):
+        print(f"{dateAsString()} ⁝ {stage} {status}: {count}")
+    for kind, count in db.execute('SELECT kind, COUNT(*) FROM artefacts GROUP BY kind ORDER BY kind'):
+        print(f"{dateAsString()} ⁝ {kind} files: {count}")
+
+# Read prompts one at a time instead of loading the whole file: .jsonl holds one JSON string or {"prompt": …}
+# object per line, .csv a prompt column; a .json array is still loaded at once
+def readPrompts(filePath):
+    if filePath.endswith('.json'):
+        return iter(loadFromFile(filePath))
+    try:
+        file = open(filePath, 'r', newline='')
+    except OSError as error:
+        print(f'Unable to load file: {filePath}. Error: {error}')
+        sys.exit(1)
+
+    def lines():
+        with file:
+            if filePath.endswith('.csv'):
+                for row in csv.DictReader(file):
+                    yield row['prompt']
+            else:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        yield entry['prompt'] if isinstance(entry, dict) else entry
+
+    return lines()
 
 # Extract filename.png from https://cdn.discordapp.com/attachments/server_id/channel_id/filename.png?ex=
 def getFilenameFromUrl(url):
     return url.split("/")[-1].split("?")[0]
 
-def download_file(url, ind):
-    localPath = f"./{ind}-{getFilenameFromUrl(url)}"
-    response = requests.get(url)
-    with open(localPath, 'wb') as file:
-        file.write(response.content)
+# Stream url to localPath in chunks through a temp file and atomic rename. Returns bytes fetched and seconds taken.
+# Files already downloaded are skipped, an interrupted download resumes from its .part file with a Range request,
+# and content identical to a file already on disk is stored once, see Manifest.
+def download_file(url, localPath):
+    key = url.split('?')[0]  # CDN urls carry expiring signatures in the query string
 
-def main():
-    # Load all required parameters from the environment variables
-    token = os.getenv('USEAPI_TOKEN')
-    channel = os.getenv('USEAPI_CHANNEL')  # optional in v3
-    # You can use https://webhook.site if you want to receive results via callback.
-    replyUrl = None
-    # Time to pause between calls, in seconds
-    sleepSecs = 5
+    # The same url downloaded before, possibly under another name
+    existingPath = manifest.findUrl(key)
+    if existingPath:
+        linkFile(existingPath, localPath)
+        print(f"{dateAsString()} ⁝ {localPath} already downloaded, skipping")
+        return 0, 0
+
+    started = time.time()
+    tmpPath = f"{localPath}.part"
+    offset = os.path.getsize(tmpPath) if os.path.exists(tmpPath) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = f"bytes={offset}-"
+    record = manifest.get(localPath)
+    if record and record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+
+    sha256 = hashlib.sha256()
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:  # Not Modified — localPath matches the ETag we recorded for it
+            print(f"{dateAsString()} ⁝ {localPath} not modified, skipping")
+            return 0, 0
+        if response.status_code == 416:  # Range Not Satisfiable — the partial file is stale, start over
+            os.remove(tmpPath)
+            return download_file(url, localPath)
+        response.raise_for_status()
+
+        if response.status_code == 206 and response.headers.get('Content-Range', '').startswith(f"bytes {offset}-"):
+            # Resume the partial file of an interrupted download; hash what is already on disk first
+            with open(tmpPath, 'rb') as file:
+                for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+                    sha256.update(chunk)
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+
+        size = offset
+        with open(tmpPath, mode) as file:
+            for chunk in response.iter_content(chunk_size=downloadChunkSize):
+                file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        etag = response.headers.get('ETag')
+
+    digest = sha256.hexdigest()
+    existingPath = manifest.findHash(digest)
+    if existingPath and existingPath != localPath:
+        # Identical media is already on disk under another name
+        os.remove(tmpPath)
+        linkFile(existingPath, localPath)
+    else:
+        os.replace(tmpPath, localPath)
+    manifest.add({'path': localPath, 'url': key, 'size': size, 'etag': etag, 'sha256': digest})
+
+    fetched = size - offset
+    secs = max(time.time() - started, 0.001)
+    resumedFrom = f", resumed at {offset / 1048576:.1f} MB" if offset else ''
+    print(f"{dateAsString()} ⁝ downloaded {localPath} {fetched / 1048576:.1f} MB in {secs:.1f}s, {fetched / secs / 1048576:.1f} MB/s{resumedFrom}")
+    return fetched, secs
+
+# Store identical media once: localPath becomes a hard link to the copy already on disk
+def linkFile(existingPath, localPath):
+    if os.path.exists(localPath):
+        if os.path.samefile(existingPath, localPath):
+            return
+        os.remove(localPath)
+    try:
+        os.link(existingPath, localPath)
+    except OSError:
+        shutil.copyfile(existingPath, localPath)  # file system without hard links
+
+# Content-hash manifest of downloaded media, appended to downloads.jsonl as one JSON line per file.
+# Lets reruns skip files already on disk and finds identical media by url or sha256.
+class Manifest:
+    def __init__(self, filePath):
+        self.paths = {}  # localPath → record
+        self.urls = {}  # url without query string → localPath
+        self.hashes = {}  # sha256 → localPath
+        self.lock = threading.Lock()
+        if os.path.exists(filePath):
+            with open(filePath, 'r') as file:
+                for line in file:
+                    try:
+                        self.index(json.loads(line))
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+        self.file = open(filePath, 'a')
+
+    def index(self, record):
+        self.paths[record['path']] = record
+        self.urls[record['url']] = record['path']
+        self.hashes[record['sha256']] = record['path']
+
+    # Path of the file downloaded from url, if still intact on disk
+    def findUrl(self, url):
+        return self.intact(self.urls.get(url))
+
+    # Path of a file with this content, if still intact on disk
+    def findHash(self, sha256):
+        return self.intact(self.hashes.get(sha256))
+
+    # Record of localPath, if the file on disk still matches it
+    def get(self, localPath):
+        return self.paths[localPath] if self.intact(localPath) else None
+
+    def intact(self, path):
+        record = self.paths.get(path)
+        if record and os.path.exists(path) and os.path.getsize(path) == record['size']:
+            return path
+        return None
+
+    def add(self, record):
+        with self.lock:
+            self.index(record)
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+# Time spent in every stage of the pipeline (submit and poll round trips, poll delay, job until its terminal state,
+# download, journal / result.json writes) as histograms, summed up at the end of the run by summary()
+class StageMetrics:
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.histograms = {}  # (stage, api) → {'counts': per bucket and +Inf, 'sum': seconds, 'max': seconds}
+        self.begun = {}  # jobid / video_id → time the job was accepted, see begin()
+        self.lock = threading.Lock()  # downloads and result.json writes are timed on worker threads
+        self.started = time.time()
+
+    def observe(self, stage, secs, api=''):
+        with self.lock:
+            histogram = self.histograms.get((stage, api))
+            if histogram is None:
+                histogram = self.histograms[(stage, api)] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'max': 0.0}
+            histogram['counts'][bisect.bisect_left(self.buckets, secs)] += 1
+            histogram['sum'] += secs
+            histogram['max'] = max(histogram['max'], secs)
+
+    # with metrics.timer('download'): …
+    @contextlib.contextmanager
+    def timer(self, stage, api=''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, api)
+
+    # The job was accepted: end() records how long it took until its terminal state was reported
+    def begin(self, ref):
+        self.begun[ref] = time.time()
+
+    def end(self, ref, api):
+        start = self.begun.pop(ref, None)
+        if start is not None:
+            self.observe('job', time.time() - start, api)
+
+    # Upper bound of the bucket holding the share-th observation, capped by the longest one
+    def quantile(self, histogram, share):
+        rank = share * sum(histogram['counts'])
+        seen = 0
+        for bound, count in zip(self.buckets, histogram['counts']):
+            seen += count
+            if seen >= rank:
+                return min(bound, histogram['max'])
+        return histogram['max']
+
+    # End-of-run summary: per stage how often it ran, the time it took in total, p50 / p99 / max
+    def summary(self):
+        lines = [f"{'stage':<10} {'api':<12} {'count':>8} {'total':>10} {'p50':>8} {'p99':>8} {'max':>8}"]
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                lines.append(
+                    f"{stage:<10} {api:<12} {sum(histogram['counts']):>8} {histogram['sum']:>9.1f}s"
+                    f" {self.quantile(histogram, 0.5):>7.2f}s {self.quantile(histogram, 0.99):>7.2f}s {histogram['max']:>7.2f}s"
+                )
+        elapsed = datetime.datetime.utcfromtimestamp(time.time() - self.started).strftime('%H:%M:%S')
+        lines.append(f"total elapsed time {elapsed}")
+        return lines
+
+metrics = StageMetrics()
+
+# Bounded pool of download threads, so polling moves on to the next job while images are written to disk.
+# fn(localPath, *args) runs on the download thread once the file is in place (localPath is None on failure).
+class Downloader:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.secs = 0
+
+    def submit(self, url, localPath, fn, *args):
+        self.pool.submit(self.fetch, url, localPath, fn, args)
+
+    def fetch(self, url, localPath, fn, args):
+        try:
+            size, secs = download_file(url, localPath)
+            with self.lock:
+                self.files += 1
+                self.bytes += size
+                self.secs += secs
+            metrics.observe('download', secs)
+        except Exception as error:
+            print(f"{dateAsString()} ⁝ download {url} failed: {error}")
+            localPath = None
+        fn(localPath, *args)
+
+    # Wait for every queued download to finish
+    def wait(self):
+        self.pool.shutdown(wait=True)
+
+    def __str__(self):
+        rate = self.bytes / max(self.secs, 0.001) / 1048576
+        return f"downloaded {self.files} files, {self.bytes / 1048576:.1f} MB, {rate:.1f} MB/s per download"
+
+def addResult(item):
+    with resultsLock:
+        results[item['ind']] = item
+        journal.save(item['ind'])
+
+# Row of the stages / artefacts tables for a result, see JobStore: (node, jobid, replyRef, stage, status, files)
+# of its imagine job; jobs are polled, so there is no replyRef
+def nodesOf(item):
+    yield 'imagine', item.get('jobid'), None, 'imagine', item.get('job_status'), {'image': item.get('file')}
+
+# Record the final state of a job; it then leaves memory for result.done.jsonl, see Journal.retire()
+def updateResult(item, **fields):
+    with resultsLock:
+        item.update(fields)
+        if item['ind'] in results:
+            journal.retire(item['ind'])
 
-    prompts = loadFromFile('./prompts.json')
+# The generated image is on disk, so the job is recorded completed; until then --resume polls it again
+def downloaded(localPath, item):
+    if localPath:
+        updateResult(item, job_status='completed', file=localPath)
 
-    print(f"{dateAsString()} ⁝ prompts to process: {len(prompts)}")
+# AIMD rate controller for one API (per channel when one is pinned). It learns how many requests
+# can be in flight: every accepted request raises limit by 1/limit, every 429 halves it and pauses new requests
+# for Retry-After, or a jittered exponential backoff when the header is missing.
+class RateController:
+    def __init__(self, name, maxLimit):
+        self.name = name
+        self.limit = 1.0
+        self.maxLimit = maxLimit
+        self.inFlight = 0
+        self.failures = 0  # consecutive 429s
+        self.resumeAt = 0  # no request starts before this time while backing off
+        self.changed = threading.Condition()
 
-    results = []
-    ind = 0
+    # Wait for a free slot, then count the request in flight
+    def acquire(self):
+        with self.changed:
+            while True:
+                wait = self.resumeAt - time.time()
+                if wait <= 0 and self.inFlight < int(self.limit):
+                    break
+                self.changed.wait(timeout=wait if wait > 0 else None)
+            self.inFlight += 1
 
-    start_time = time.time()
+    # Learn from the outcome of a request: statusCode is None when it never got a response
+    def release(self, statusCode, retryAfter=None):
+        with self.changed:
+            self.inFlight -= 1
+            if statusCode == 429:
+                self.failures += 1
+                self.limit = max(1.0, self.limit / 2)
+                delay = retryAfterSecs(retryAfter) or min(sleepSecs * 2 ** (self.failures - 1), maxBackoffSecs)
+                delay *= random.uniform(1, 1.5)  # spread out workers that hit 429 together
+                self.resumeAt = max(self.resumeAt, time.time() + delay)
+                print(f"{dateAsString()} ⁝ {self}, backing off {delay:.1f}s")
+            elif statusCode is not None and statusCode < 400:
+                self.failures = 0
+                self.limit = min(float(self.maxLimit), self.limit + 1 / self.limit)
+            self.changed.notify_all()
 
-    headers = {
-        'Authorization': f"Bearer {token}",
-        'Content-Type': 'application/json'
+    def __str__(self):
+        return f"{self.name} limit {self.limit:.1f}, in flight {self.inFlight}"
+
+# Retry-After is either seconds or an HTTP date
+def retryAfterSecs(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+rateControllers = {}  # (api, channel / account) → RateController
+
+# The rate controller shared by every request to api, per channel / account when one is pinned
+def rateController(api, account=None):
+    key = (api, account)
+    if key not in rateControllers:
+        rateControllers[key] = RateController(f"{api} {account}" if account else api, maxConcurrency[api])
+    return rateControllers[key]
+
+# Spreads jobs over the configured Midjourney channels: every job goes to the least loaded one with free capacity
+# and holds a slot there until it is polled to a terminal state. A channel that answers 596 (pending moderation / CAPTCHA)
+# is out of rotation until it is reset. With nothing configured the API selects the channel.
+class ChannelPool:
+    def __init__(self, kind, spec, capacity):
+        self.kind = kind
+        self.capacity = {}  # name → jobs it runs at the same time, from "name:jobs,…"
+        for entry in spec.split(','):
+            name, _, size = entry.strip().partition(':')
+            if name:
+                self.capacity[name] = int(size or capacity)
+        self.inFlight = dict.fromkeys(self.capacity, 0)
+        self.disabled = set()
+        self.jobs = {}  # jobid → name, see started()
+        self.changed = threading.Condition()
+
+    # Take a slot on the least loaded channel in rotation, waiting for one to free up unless wait is False.
+    # Returns None when no channel is configured or every channel is out of rotation: the API selects one.
+    def acquire(self, wait=True):
+        if not self.capacity:
+            return None
+        with self.changed:
+            while True:
+                names = [n for n in self.capacity if n not in self.disabled]
+                if not names:
+                    return None
+                best = min(names, key=lambda n: self.inFlight[n] / self.capacity[n])
+                if self.inFlight[best] < self.capacity[best] or not wait:
+                    self.inFlight[best] += 1
+                    return best
+                self.changed.wait()
+
+    # Give the slot back: the job was not accepted, or it reached a terminal state
+    def release(self, name):
+        if name in self.inFlight:
+            with self.changed:
+                self.inFlight[name] -= 1
+                self.changed.notify_all()
+
+    # The job was accepted: it holds its slot until finished() sees its terminal state
+    def started(self, ref, name):
+        if name in self.inFlight:
+            self.jobs[ref] = name
+
+    def finished(self, ref):
+        self.release(self.jobs.pop(ref, None))
+
+    # 596 — pending moderation / CAPTCHA: resolve it in Discord, then POST /accounts/{channel}/reset
+    def disable(self, name):
+        if name in self.capacity and name not in self.disabled:
+            self.disabled.add(name)
+            print(f"{dateAsString()} ⁝ {self.kind} {name} out of rotation until it is reset")
+        self.release(name)
+
+    def enable(self, name):
+        with self.changed:
+            self.disabled.discard(name)
+            self.changed.notify_all()
+        print(f"{dateAsString()} ⁝ {self.kind} {name} back in rotation")
+
+    def __str__(self):
+        return f"{self.kind} " + ', '.join(
+            f"{n} {self.inFlight[n]}/{self.capacity[n]}" + (' out of rotation' if n in self.disabled else '') for n in self.capacity
+        )
+
+midjourneyChannels = ChannelPool('midjourney', channels, channelCapacity)
+
+# Channels taken out of rotation by a 596 rejoin it once POST /accounts/{channel}/reset cleared their error,
+# see https://useapi.net/docs/api-midjourney-v3/get-midjourney-accounts-channel
+def watchChannels():
+    while True:
+        time.sleep(channelCheckSecs)
+
+        for name in list(midjourneyChannels.disabled):
+            # A failed check leaves the channel out of rotation until the next pass
+            try:
+                response = session.get(f"{rootUrl}/accounts/{name}", headers=authHeaders)
+                if response.status_code == 200 and not response.json().get('error'):
+                    midjourneyChannels.enable(name)
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ checking channel {name} failed: {error}")
+
+# Submit the prompt, retrying while the channel is busy. Returns the results entry or None.
+def submit(ind, prompt):
+    # Detailed documentation at https://useapi.net/docs/api-midjourney-v3/post-midjourney-jobs-imagine
+    body = {
+        'prompt': prompt,
+        'stream': False  # stream defaults to true (SSE); set false to get the JSON job state we poll below
     }
+    if replyUrl is not None:
+        body['replyUrl'] = f"{replyUrl}?ind={ind}"
+
+    print(f"{dateAsString()} ⁝ #{ind} prompt: {prompt}")
+
+    attempt = 0
+
+    while True:
+        attempt += 1
+        # channel is optional — API auto-selects a channel with capacity when omitted. Sequential mode only picks the
+        # least loaded channel and leaves its capacity to the API, as it always did: a full channel answers 429 below.
+        account = midjourneyChannels.acquire(wait=maxJobs > 1)
+        if account:
+            body['channel'] = account
+        controller = rateController('midjourney', account)
+        controller.acquire()
+        try:
+            with metrics.timer('submit', 'midjourney'):
+                response = session.post(f"{rootUrl}/jobs/imagine", headers=jsonHeaders, data=json.dumps(body))
+        except Exception:
+            controller.release(None)
+            midjourneyChannels.release(account)
+            raise
+        controller.release(response.status_code, response.headers.get('Retry-After'))
+        result = response.json()
+
+        print(f"{dateAsString()} ⁝ #{ind} attempt #{attempt}, response: {{ status: {response.status_code}, jobid: {result.get('jobid')}, job_status: {result.get('status')} }}")
+
+        if response.status_code == 201:  # Created — job accepted
+            midjourneyChannels.started(result.get('jobid'), account)
+            metrics.begin(result.get('jobid'))
+            item = { 'status': response.status_code, 'jobid': result.get('jobid'), 'job_status': result.get('status'), 'ind': ind, 'prompt': prompt }
+        elif response.status_code == 429:  # Channel at capacity or rate limited — retry once the rate controller's backoff is over
+            print(f"{dateAsString()} ⁝ #{ind} attempt #{attempt} channel busy")
+            midjourneyChannels.release(account)
+            continue
+        elif response.status_code == 596:  # Pending moderation / CAPTCHA — resolve in Discord, then POST /accounts/{channel}/reset
+            print(f"{dateAsString()} ⁝ #{ind} channel pending moderation/CAPTCHA — resolve in Discord, then POST /accounts/{{channel}}/reset: {result}")
+            midjourneyChannels.disable(account)
+            item = { 'status': response.status_code, 'jobid': None, 'job_status': 'moderated', 'ind': ind, 'prompt': prompt }
+        else:  # 400 / 401 / 402 / ...
+            print(f"Unexpected response.status: {response.status_code}, result: {result}")
+            midjourneyChannels.release(account)
+            return None
+
+        addResult(item)
+        return item
+
+# Status lookups of the poller thread: listed() learns the status of every running job from a single GET /jobs,
+# so only jobs missing from that list (most likely finished) need a GET /jobs/{jobid} of their own, see get().
+class JobStatuses:
+    def __init__(self):
+        self.running = {}  # jobid → status, as listed by the last GET /jobs
+        self.listedAt = 0
+        self.listing = True  # cleared when GET /jobs isn't available, every job is then looked up on its own
+        self.calls = 0  # requests sent, GET /jobs and GET /jobs/{jobid}
+
+    # GET url under the rate controller of status lookups, so a 429 backs them off like it does submissions
+    def request(self, url, stage):
+        self.calls += 1
+        controller = rateController('midjourney status')
+        controller.acquire()
+        try:
+            with metrics.timer(stage, 'midjourney'):
+                response = session.get(url, headers=authHeaders)
+        except Exception:
+            controller.release(None)
+            raise
+        controller.release(response.status_code, response.headers.get('Retry-After'))
+        return response
+
+    # (HTTP status, job) of jobid from GET /jobs/{jobid}, the job being {'error': body} unless the status is 200.
+    # A 429 or 5xx answer raises, so the poller checks the job again after pollRetrySecs.
+    def get(self, jobid):
+        response = self.request(f"{rootUrl}/jobs/{jobid}", 'poll')
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code != 200:
+            return response.status_code, {'error': response.text}
+        return response.status_code, response.json()
+
+    # Status of a running job from the list of running jobs, refreshed with GET /jobs when older than listSecs.
+    # None when the job isn't on the list (it most likely finished) or jobs can't be listed: look it up with get().
+    def listed(self, jobid):
+        if not self.listing:
+            return None
+        if time.time() - self.listedAt >= listSecs:
+            # Until the list is read again, a failed one leaves every job to get()
+            self.listedAt = time.time()
+            self.running = {}
+            try:
+                response = self.request(f"{rootUrl}/jobs", 'list')
+                jobs = response.json() if response.status_code == 200 else None
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ GET /jobs failed, listing again in {listSecs} secs: {error}")
+                return None
+            if response.status_code in (404, 405):
+                print(f"{dateAsString()} ⁝ GET /jobs HTTP {response.status_code}, looking up every job on its own")
+                self.listing = False
+                return None
+            if not isinstance(jobs, list):
+                print(f"{dateAsString()} ⁝ GET /jobs HTTP {response.status_code}, listing again in {listSecs} secs")
+                return None
+            self.running = {job.get('jobid'): job.get('status') for job in jobs}
+        return self.running.get(jobid)
+
+statuses = JobStatuses()
+
+# Check the status of a submitted job once and download the generated image when it completed.
+# Returns the job status while the job is still running, None once there is nothing left to poll.
+def check(item):
+    ind = item.get('ind')
+    jobid = item.get('jobid')
+
+    # A job on the list of running jobs needs no lookup of its own
+    job_status = statuses.listed(jobid)
+    if job_status in pollIntervals:
+        print(f"{dateAsString()} ⁝ #{ind} {job_status} (listed), next check in {pollIntervals[job_status]} secs")
+        return job_status
+
+    status_code, result = statuses.get(jobid)
+
+    print(f"{dateAsString()} ⁝ #{ind} response: {{ status: {status_code}, jobid: {result.get('jobid')}, job_status: {result.get('status')} }}")
 
-    for prompt in prompts:
-        ind += 1
-        # Detailed documentation at https://useapi.net/docs/api-midjourney-v3/post-midjourney-jobs-imagine
-        body = {
-            'prompt': prompt,
-            'stream': False  # stream defaults to true (SSE); set false to get the JSON job state we poll below
-        }
-        # channel is optional — API auto-selects a channel with capacity when omitted
-        if channel:
-            body['channel'] = channel
-        if replyUrl is not None:
-            body['replyUrl'] = f"{replyUrl}?ind={ind}"
-
-        print(f"{dateAsString()} ⁝ #{ind} prompt: {prompt}")
-
-        attempt = 0
-        retry = True
-
-        while retry:
-            attempt += 1
-            response = requests.post(f"{rootUrl}/jobs/imagine", headers=headers, data=json.dumps(body))
-            result = response.json()
-
-            print(f"{dateAsString()} ⁝ attempt #{attempt}, response: {{ status: {response.status_code}, jobid: {result.get('jobid')}, job_status: {result.get('status')} }}")
-
-            if response.status_code == 201:  # Created — job accepted
-                results.append({ 'status': response.status_code, 'jobid': result.get('jobid'), 'job_status': result.get('status'), 'ind': ind, 'prompt': prompt })
-                retry = False
-            elif response.status_code == 429:  # Channel at capacity or rate limited — wait and retry
-                print(f"{dateAsString()} ⁝ #{ind} attempt #{attempt} channel busy, sleeping for {sleepSecs} secs...")
-                time.sleep(sleepSecs)
-            elif response.status_code == 596:  # Pending moderation / CAPTCHA — resolve in Discord, then POST /accounts/{channel}/reset
-                print(f"{dateAsString()} ⁝ #{ind} channel pending moderation/CAPTCHA — resolve in Discord, then POST /accounts/{{channel}}/reset: {result}")
-                results.append({ 'status': response.status_code, 'jobid': None, 'job_status': 'moderated', 'ind': ind, 'prompt': prompt })
-                retry = False
-            else:  # 400 / 401 / 402 / ...
-                print(f"Unexpected response.status: {response.status_code}, result: {result}")
-                retry = False
-
-        saveToFile('./result.json', results)
-
-    print(f"{dateAsString()} ⁝ downloading generated images")
-
-    ind = 0
-
-    for item in results:
-        ind += 1
-        jobid = item.get('jobid')
-        status = item.get('status')
-
-        print(f"{dateAsString()} ⁝ #{ind} jobid: {{ jobid: {jobid}, status: {status} }}")
-
-        if status == 596:
-            print(f"channel moderation pending, skipping prompt: {item.get('prompt')}")
-        elif status == 201 and jobid:
-            attempt = 0
-            retry = True
-
-            while retry:
-                attempt += 1
-                response = requests.get(f"{rootUrl}/jobs/{jobid}", headers={"Authorization": f"Bearer {token}"})
-                result = response.json()
-
-                print(f"{dateAsString()} ⁝ attempt #{attempt}, response: {{ status: {response.status_code}, jobid: {result.get('jobid')}, job_status: {result.get('status')} }}")
-
-                if response.status_code == 200:
-                    job_status = result.get('status')
-                    if job_status == 'completed':
-                        # In v3 generated media is nested under result['response']
-                        attachments = (result.get('response') or {}).get('attachments', [])
-                        if len(attachments):
-                            download_file(attachments[0]['url'], ind)
-                        else:
-                            print(f"#{ind} completed jobid has no attachments")
-                        retry = False
-                    elif job_status in ['created', 'started', 'progress']:
-                        print(f"{dateAsString()} ⁝ #{ind} attempt #{attempt} sleeping for {sleepSecs} secs... status: {job_status}")
-                        time.sleep(sleepSecs)
-                    elif job_status in ['moderated', 'failed']:
-                        print(f"#{ind} job {job_status}: {result.get('error', result)}")
-                        retry = False
-                    else:
-                        print(f"Unexpected job status: {result}")
-                        retry = False
+    if status_code != 200:
+        print(f"Unexpected response.status: {status_code}, result: {result}")
+        return None
+
+    job_status = result.get('status')
+    if job_status == 'completed':
+        # In v3 generated media is nested under result['response']
+        attachments = (result.get('response') or {}).get('attachments', [])
+        if len(attachments):
+            url = attachments[0]['url']
+            downloader.submit(url, f"./{ind}-{getFilenameFromUrl(url)}", downloaded, item)
+        else:
+            print(f"#{ind} completed jobid has no attachments")
+            updateResult(item, job_status=job_status)
+    elif job_status in pollIntervals:
+        print(f"{dateAsString()} ⁝ #{ind} {job_status}, next check in {pollIntervals[job_status]} secs")
+        return job_status
+    elif job_status in ['moderated', 'failed']:
+        print(f"#{ind} job {job_status}: {result.get('error', result)}")
+        updateResult(item, job_status=job_status)
+    else:
+        print(f"Unexpected job status: {result}")
+        updateResult(item, job_status=job_status)
+    return None
+
+# Polls every outstanding job from one thread. Jobs wait in a heap ordered by the time their next status check
+# is due, so a job that finishes is noticed without waiting behind the others, and checks are spaced to stay
+# under maxPollsPerSec however many jobs are running.
+class Poller:
+    def __init__(self, maxPerSec):
+        self.gap = 1 / maxPerSec
+        self.heap = []  # (due time, ind, item)
+        self.pending = {}  # ind → threading.Event, set once the job is done
+        self.changed = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Start polling a job; the returned event is set once it reached a terminal state
+    def add(self, item):
+        done = threading.Event()
+        with self.changed:
+            self.pending[item['ind']] = done
+            heapq.heappush(self.heap, (time.time() + pollIntervals[item['job_status']], item['ind'], item))
+            self.changed.notify_all()
+        return done
+
+    # Block until every job added so far is done
+    def wait(self):
+        with self.changed:
+            while self.pending:
+                self.changed.wait()
+
+    def run(self):
+        while True:
+            with self.changed:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.changed.wait(timeout=self.heap[0][0] - time.time() if self.heap else None)
+                due, ind, item = heapq.heappop(self.heap)
+
+            checkedAt = time.time()
+            calls = statuses.calls
+            # How long the check waited behind others for its turn under maxPollsPerSec
+            metrics.observe('queue', checkedAt - due, 'poll')
+            try:
+                job_status = check(item)
+                delay = pollIntervals[job_status] if job_status else None
+            except Exception as error:
+                # A failed check says nothing about the job, which keeps its channel slot and is checked again
+                print(f"#{ind} an error occurred, next check in {pollRetrySecs} secs: {error}")
+                delay = pollRetrySecs
+
+            with self.changed:
+                if delay is not None:
+                    heapq.heappush(self.heap, (checkedAt + delay, ind, item))
                 else:
-                    print(f"Unexpected response.status: {response.status_code}, result: {result}")
-                    retry = False
+                    # The job no longer runs (or we stopped watching it), so its channel takes another one
+                    midjourneyChannels.finished(item.get('jobid'))
+                    metrics.end(item.get('jobid'), 'midjourney')
+                    self.pending.pop(ind).set()
+                    self.changed.notify_all()
+
+            # Checks answered from the list of running jobs send no request of their own and aren't spaced out
+            if statuses.calls != calls:
+                time.sleep(max(0, checkedAt + self.gap - time.time()))
+
+poller = Poller(maxPollsPerSec)
+
+# Hand the submitted job to the poller. Returns an event set once the job is done, or None when there is nothing to poll.
+def poll(item):
+    ind = item.get('ind')
+    jobid = item.get('jobid')
+    status = item.get('status')
+
+    print(f"{dateAsString()} ⁝ #{ind} jobid: {{ jobid: {jobid}, status: {status} }}")
+
+    if status == 596:
+        print(f"channel moderation pending, skipping prompt: {item.get('prompt')}")
+    elif item.get('job_status') not in ['created', 'started', 'progress']:
+        print(f"#{ind} job already {item.get('job_status')}, skipping")
+    elif status == 201 and jobid:
+        return poller.add(item)
+    # Nothing left to poll, so the job is final
+    updateResult(item)
+    return None
+
+# Concurrent mode: workers free to take the next prompt
+slots = threading.Semaphore(maxJobs)
+
+# Concurrent mode: one worker owns a prompt from submission to download
+def process(ind, prompt):
+    item = None
+    try:
+        item = results.get(ind) or submit(ind, prompt)
+        done = item and poll(item)
+        if done:
+            done.wait()
+    except Exception as error:
+        print(f"#{ind} an error occurred: {error}")
+    finally:
+        # The job no longer runs (or we stopped watching it), so its channel takes another one
+        if item:
+            midjourneyChannels.finished(item.get('jobid'))
+        slots.release()
+
+def main():
+    global journal
+
+    # python3 ./example.py --compact rebuilds result.json from result.json + result.jsonl + result.done.jsonl and exits;
+    # with --sqlite it exports result.db to result.json instead
+    if '--compact' in sys.argv:
+        Journal('./result.json', loadJobStore('./result.db') if useJobStore else loadJournal('./result.json')).compact()
+        sys.exit(0)
+
+    if '--progress' in sys.argv:
+        printProgress('./result.db')
+        sys.exit(0)
+
+    prompts = readPrompts(promptsFile)
+
+    if '--resume' in sys.argv:
+        # Continue the previous run: prompts already submitted are polled instead of submitted again
+        results.update(loadJobStore('./result.db') if useJobStore else loadJournal('./result.json'))
+        print(f"{dateAsString()} ⁝ resuming, prompts already submitted: {len(results)}")
+
+    journal = JobStore('./result.db', results, '--resume' in sys.argv) if useJobStore else Journal('./result.json', results)
+    journal.compact()
+
+    print(f"{dateAsString()} ⁝ max jobs: {maxJobs}")
+
+    threading.Thread(target=watchChannels, daemon=True).start()
+
+    if maxJobs > 1:
+        # At most maxJobs prompts are submitted, polled and downloaded in parallel
+        with ThreadPoolExecutor(max_workers=maxJobs) as executor:
+            for ind, prompt in enumerate(prompts, start=1):
+                # The next prompt is read once a worker is free for it, so the executor never queues the whole file
+                slots.acquire()
+                executor.submit(process, ind, prompt)
+    else:
+        # Every job is polled from the moment it is submitted, while the next prompts are still being submitted
+        for ind, prompt in enumerate(prompts, start=1):
+            item = results.get(ind) or submit(ind, prompt)
+            if item:
+                poll(item)
+
+        print(f"{dateAsString()} ⁝ waiting for the remaining jobs")
+
+        poller.wait()
+
+    downloader.wait()
+    print(f"{dateAsString()} ⁝ {downloader}")
+    for controller in rateControllers.values():
+        print(f"{dateAsString()} ⁝ {controller}")
+    if midjourneyChannels.capacity:
+        print(f"{dateAsString()} ⁝ {midjourneyChannels}")
+
+    journal.finish()
 
-    execution_time = time.time() - start_time
+    for line in metrics.summary():
+        print(f"{dateAsString()} ⁝ {line}")
 
-    print(f"{dateAsString()}  ⁝  total elapsed time {datetime.datetime.utcfromtimestamp(execution_time).strftime('%H:%M:%S')}")
+journal = None  # result.json / result.jsonl, or result.db with --sqlite, see main()
+downloader = Downloader(maxDownloads)
+manifest = Manifest('./downloads.jsonl')
 
 main()
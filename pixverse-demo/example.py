@@ -1,5 +1,6 @@
 #
 # pip install requests
+# pip install aiohttp
 # pip install ngrok
 #
 # Create an example.sh file with the following content and execute it from the command line using ./example.sh:
@@ -8,25 +9,51 @@
 # Optional environment variables:
 #   PIXVERSE_EMAIL  - pin PixVerse requests to a specific configured account.
 #                     When omitted the API randomly selects an available account.
+#   PIXVERSE_EMAILS - spread PixVerse requests over several configured accounts, least loaded first:
+#                     email[:jobs],… where jobs defaults to accountCapacity.
+#   USEAPI_URL      - API host to call instead of https://api.useapi.net, e.g. the local mock server in ../benchmark.
+#   WEBHOOK_URL     - url that already reaches port 8081, used as replyUrl instead of an ngrok tunnel.
+#   PROMPTS_FILE    - prompts to read instead of ./prompts.json: a .jsonl file with one prompt object per line,
+#                     or a .csv file with prompt, model, duration, quality and use_source_image columns.
 #
 # Supports both text-to-video (t2v) and image-to-video (i2v).
 # Set use_source_image: true in a prompts.json entry to upload ./source.jpg as the first frame.
 #
+# python3 ./example.py --sqlite keeps the job state in a SQLite database, result.db, instead of result.json and
+# result.jsonl; python3 ./example.py --progress reports on it from another terminal while the run goes on.
+#
+# python3 ./example.py --resume continues a run that stopped midway: finished videos are skipped, videos that
+# were still generating are polled until they finish, and only prompts that never started are submitted.
+#
 
 import requests
 import ngrok
 
 import datetime
 import os
+import hashlib
+import shutil
 import time
+import random
+import email.utils
 import json
+import sqlite3
 import sys
+import threading
 import asyncio
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import bisect
+import contextlib
+import csv
+from collections import deque
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # Global variables
-prompts = []
 data = {}
+jobs = {}  # jobid → data node, see indexJob()
+resumed = {}  # replyRef → (status url, known fields) of jobs resumed with --resume, see pollResumed()
+webhooks = asyncio.Queue()  # webhook payloads acknowledged by handle_post(), see processWebhooks()
 submitted = 0
 
 # Load all required parameters from the environment variables
@@ -37,61 +64,372 @@ submitted = 0
 
 token = os.getenv("USEAPI_TOKEN")
 pixverse_email = os.getenv("PIXVERSE_EMAIL")  # optional
+pixverse_emails = os.getenv("PIXVERSE_EMAILS") or pixverse_email or ""  # optional, email[:jobs],…
+apiUrl = os.getenv("USEAPI_URL") or "https://api.useapi.net"  # optional
+webhookUrl = os.getenv("WEBHOOK_URL")  # optional
+promptsFile = os.getenv("PROMPTS_FILE") or "./prompts.json"  # optional
 
 # API root url
-rootPixVerseUrl = "https://api.useapi.net/v2/pixverse"
+rootPixVerseUrl = f"{apiUrl}/v2/pixverse"
+
+# Maximum number of pooled keep-alive connections per host (api.useapi.net, CDN)
+maxConnectionsPerHost = 10
+# Number of journal records written between result.json snapshots
+compactEvery = 1000
+# Keep the job state in the SQLite database result.db instead of result.json / result.jsonl, see JobStore
+useJobStore = "--sqlite" in sys.argv
+# Number of prompts in memory at a time; the next prompt is read from promptsFile once an earlier one finished
+maxActivePrompts = 1000
+# Time between status checks of jobs resumed with --resume, in seconds
+pollSecs = 10
+# Number of webhooks processed concurrently
+webhookWorkers = 4
+# Number of PixVerse requests (upload + create) submitted concurrently
+pixverseConcurrency = 2
+# Number of image uploads streamed at the same time; each keeps its file open only while it is sent
+maxUploads = 4
+# Number of generated files downloaded in parallel, and the chunk size they are streamed to disk in
+maxDownloads = 4
+downloadChunkSize = 1024 * 1024
+# Time a source image uploaded to PixVerse is reused for new videos before it is uploaded again, in seconds, see UploadCache
+uploadTtlSecs = 24 * 60 * 60
+# Videos a PixVerse account generates at the same time, unless set per account in PIXVERSE_EMAILS
+accountCapacity = 3
+# Initial pause after a 429 without Retry-After, doubled on every consecutive 429 up to maxBackoffSecs
+backoffSecs = 10
+maxBackoffSecs = 120
+# Upper bound of requests in flight per API that the rate controllers may learn
+maxConcurrency = {"pixverse": pixverseConcurrency}
+
+authHeaders = {"Authorization": f"Bearer {token}"}
+jsonHeaders = {**authHeaders, "Content-Type": "application/json"}
+
+# One pooled session is shared by every API call and download, so connections are kept alive
+# and reused instead of paying a TLS handshake per request.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxConnectionsPerHost, pool_block=True)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+# Time spent in every stage of the pipeline (submit round trip, queue wait, job until its terminal state, download,
+# upload, journal / result.json writes) as Prometheus-style histograms, see render() and summary()
+class StageMetrics:
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
 
-# https://github.com/ngrok/ngrok-python
-listener = ngrok.forward(8081, authtoken_from_env=True)
+    def __init__(self):
+        self.histograms = {}  # (stage, api) → {"counts": per bucket and +Inf, "sum": seconds, "max": seconds}
+        self.begun = {}  # jobid / video_id → time the job was accepted, see begin()
+        self.lock = threading.Lock()  # downloads and result.json writes are timed on worker threads
+        self.started = time.time()
+
+    def observe(self, stage, secs, api=""):
+        with self.lock:
+            histogram = self.histograms.get((stage, api))
+            if histogram is None:
+                histogram = self.histograms[(stage, api)] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "max": 0.0}
+            histogram["counts"][bisect.bisect_left(self.buckets, secs)] += 1
+            histogram["sum"] += secs
+            histogram["max"] = max(histogram["max"], secs)
+
+    # with metrics.timer("upload", "pixverse"): …
+    @contextlib.contextmanager
+    def timer(self, stage, api=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, api)
+
+    # The job was accepted: end() records how long it took until its terminal state was reported
+    def begin(self, ref):
+        self.begun[ref] = time.time()
+
+    def end(self, ref, api):
+        start = self.begun.pop(ref, None)
+        if start is not None:
+            self.observe("job", time.time() - start, api)
+
+    # Upper bound of the bucket holding the share-th observation, capped by the longest one
+    def quantile(self, histogram, share):
+        rank = share * sum(histogram["counts"])
+        seen = 0
+        for bound, count in zip(self.buckets, histogram["counts"]):
+            seen += count
+            if seen >= rank:
+                return min(bound, histogram["max"])
+        return histogram["max"]
+
+    # Prometheus text exposition format, served on GET /metrics
+    def render(self):
+        lines = ["# HELP useapi_stage_seconds Time spent in each pipeline stage", "# TYPE useapi_stage_seconds histogram"]
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",api="{api}"'
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram["counts"]):
+                    total += count
+                    lines.append(f'useapi_stage_seconds_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f"useapi_stage_seconds_sum{{{labels}}} {histogram['sum']:.6f}")
+                lines.append(f"useapi_stage_seconds_count{{{labels}}} {total}")
+        lines.append("# HELP useapi_elapsed_seconds Time since the run started")
+        lines.append("# TYPE useapi_elapsed_seconds gauge")
+        lines.append(f"useapi_elapsed_seconds {time.time() - self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    # End-of-run summary: per stage how often it ran, the time it took in total, p50 / p99 / max
+    def summary(self):
+        lines = [f"{'stage':<10} {'api':<12} {'count':>8} {'total':>10} {'p50':>8} {'p99':>8} {'max':>8}"]
+        with self.lock:
+            for (stage, api), histogram in sorted(self.histograms.items()):
+                lines.append(
+                    f"{stage:<10} {api:<12} {sum(histogram['counts']):>8} {histogram['sum']:>9.1f}s"
+                    f" {self.quantile(histogram, 0.5):>7.2f}s {self.quantile(histogram, 0.99):>7.2f}s {histogram['max']:>7.2f}s"
+                )
+        elapsed = datetime.datetime.utcfromtimestamp(time.time() - self.started).strftime("%H:%M:%S")
+        lines.append(f"total elapsed time {elapsed}")
+        return lines
 
-print(f"Webhook {listener.url()}")
 
+metrics = StageMetrics()
 
-# Simple async query management
+
+# Long-lived scheduler on the event loop: up to concurrency queued functions run at the same time.
+# Waiting functions are kept in one deque per priority (lower runs first), and enqueue() waits while
+# maxPending functions are already waiting, so producers slow down instead of piling up work.
 class AsyncFunctionQueue:
-    def __init__(self):
-        self.queue = []
-        self.is_function_running = False
+    def __init__(self, name, concurrency=1, maxPending=1000):
+        self.name = name
+        self.concurrency = concurrency
+        self.queues = {}  # priority → deque of (fn, args, time queued)
+        self.items = asyncio.Semaphore(0)
+        self.space = asyncio.Semaphore(maxPending)
+        self.workers = []
+
+    async def enqueue(self, fn, *args, priority=0):
+        await self.space.acquire()
+        self.queues.setdefault(priority, deque()).append((fn, args, time.time()))
+        self.items.release()
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    async def work(self):
+        while True:
+            await self.items.acquire()
+            priority = min(priority for priority, queue in self.queues.items() if queue)
+            item = self.queues[priority].popleft()
+            self.space.release()
+
+            fn, args, queued = item
+            metrics.observe("queue", time.time() - queued, self.name)
+            try:
+                if await fn(*args) != "retry":
+                    continue
+                print("Will retry:", fn, args)
+            except Exception as error:
+                print("An error occurred:", error)
 
-    def enqueue(self, fn, *args):
-        self.queue.append((fn, args))
-        asyncio.run(self.process_queue())
+            # A function asking for a retry, or raising, stays at the head of its queue and runs again
+            self.queues[priority].appendleft((fn, args, time.time()))
+            self.items.release()
 
-    async def process_queue(self):
-        if self.is_function_running or len(self.queue) == 0:
-            return
 
-        self.is_function_running = True
+# Create async queue
+queuePixVerse = AsyncFunctionQueue("pixverse", concurrency=pixverseConcurrency)
+# Bounds the open files and upload bandwidth of concurrent uploads, see maxUploads
+uploadSlots = asyncio.Semaphore(maxUploads)
+
+
+# Spreads videos over the configured PixVerse accounts: every video goes to the least loaded account with free
+# capacity and holds a slot there until its terminal webhook. With no account configured the API selects one.
+class ChannelPool:
+    def __init__(self, kind, spec, capacity):
+        self.kind = kind
+        self.capacity = {}  # name → jobs it runs at the same time, from "name:jobs,…"
+        for entry in spec.split(","):
+            name, _, size = entry.strip().partition(":")
+            if name:
+                self.capacity[name] = int(size or capacity)
+        self.inFlight = dict.fromkeys(self.capacity, 0)
+        self.jobs = {}  # video_id → name, see started()
+        self.changed = asyncio.Condition()
+
+    # Wait for a slot on the least loaded account. Returns None when no account is configured: the API selects one.
+    async def acquire(self):
+        if not self.capacity:
+            return None
+        async with self.changed:
+            while True:
+                best = min(self.capacity, key=lambda n: self.inFlight[n] / self.capacity[n])
+                if self.inFlight[best] < self.capacity[best]:
+                    self.inFlight[best] += 1
+                    return best
+                await self.changed.wait()
+
+    # Give the slot back: the video was not accepted, or it reached a terminal state
+    async def release(self, name):
+        if name in self.inFlight:
+            async with self.changed:
+                self.inFlight[name] -= 1
+                self.changed.notify_all()
+
+    # The video was accepted: it holds its slot until finished() sees its terminal state
+    def started(self, ref, name):
+        if name in self.inFlight:
+            self.jobs[ref] = name
+
+    async def finished(self, ref):
+        await self.release(self.jobs.pop(ref, None))
+
+    def __str__(self):
+        return f"{self.kind} " + ", ".join(f"{n} {self.inFlight[n]}/{self.capacity[n]}" for n in self.capacity)
+
+
+pixverseAccounts = ChannelPool("pixverse", pixverse_emails, accountCapacity)
+
+
+# AIMD rate controller for one API (per channel / account when one is pinned). It learns how many requests
+# can be in flight: every accepted request raises limit by 1/limit, every 429 halves it and pauses new requests
+# for Retry-After, or a jittered exponential backoff when the header is missing.
+class RateController:
+    def __init__(self, name, maxLimit):
+        self.name = name
+        self.limit = 1.0
+        self.maxLimit = maxLimit
+        self.inFlight = 0
+        self.failures = 0  # consecutive 429s
+        self.resumeAt = 0  # no request starts before this time while backing off
+        self.changed = asyncio.Condition()
+
+    # Wait for a free slot, then count the request in flight
+    async def acquire(self):
+        async with self.changed:
+            while True:
+                wait = self.resumeAt - time.time()
+                if wait <= 0 and self.inFlight < int(self.limit):
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout=wait if wait > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+            self.inFlight += 1
+
+    # Learn from the outcome of a request: statusCode is None when it never got a response
+    async def release(self, statusCode, retryAfter=None):
+        async with self.changed:
+            self.inFlight -= 1
+            if statusCode == 429:
+                self.failures += 1
+                self.limit = max(1.0, self.limit / 2)
+                delay = retryAfterSecs(retryAfter) or min(backoffSecs * 2 ** (self.failures - 1), maxBackoffSecs)
+                delay *= random.uniform(1, 1.5)  # spread out workers that hit 429 together
+                self.resumeAt = max(self.resumeAt, time.time() + delay)
+                print(f"{dateAsString()} ⁝ {self}, backing off {delay:.1f}s")
+            elif statusCode is not None and statusCode < 400:
+                self.failures = 0
+                self.limit = min(float(self.maxLimit), self.limit + 1 / self.limit)
+            self.changed.notify_all()
+
+    def __str__(self):
+        return f"{self.name} limit {self.limit:.1f}, in flight {self.inFlight}"
+
+
+# Retry-After is either seconds or an HTTP date
+def retryAfterSecs(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
         try:
-            item = self.queue[0]
-            fn, args = item
-            result = await fn(*args)
-            if result == "retry":
-                print("Will retry:", fn, args)
-            else:
-                self.queue.remove(item)
-        except Exception as error:
-            print("An error occurred:", error)
-        finally:
-            self.is_function_running = False
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
 
-        await self.process_queue()
 
+rateControllers = {}  # (api, channel / account) → RateController
 
-# Create async queue
-queuePixVerse = AsyncFunctionQueue()
+
+# The rate controller shared by every request to api, per channel / account when one is pinned
+def rateController(api, account=None):
+    key = (api, account)
+    if key not in rateControllers:
+        rateControllers[key] = RateController(f"{api} {account}" if account else api, maxConcurrency[api])
+    return rateControllers[key]
+
+
+# Counts pending jobs per pipeline stage. Updated on every state transition, so checking
+# progress or completion is O(1); done is set as soon as the last job completes after close().
+class JobTracker:
+    def __init__(self):
+        self.pending = 0
+        self.stages = {}
+        self.entries = {}  # data key → pending job of that entry
+        self.finished = deque()  # keys of entries whose last pending job completed, see retireFinished()
+        self.freed = asyncio.Event()  # set whenever an entry finishes
+        self.closed = False
+        self.done = asyncio.Event()
+
+    # Register a new pending job at its first stage
+    def add(self, node, stage):
+        node["stage"] = stage
+        self.stages[stage] = self.stages.get(stage, 0) + 1
+        self.entries[node["jobid"]] = self.entries.get(node["jobid"], 0) + 1
+        self.pending += 1
+        self.done.clear()
+
+    # Move a pending job on to the next stage
+    def advance(self, node, stage):
+        if node.get("completed") is not False:
+            return
+        self.stages[node["stage"]] -= 1
+        node["stage"] = stage
+        self.stages[stage] = self.stages.get(stage, 0) + 1
+
+    # Mark a pending job completed, whatever stage it reached
+    def complete(self, node):
+        if node.get("completed") is not False:
+            return
+        node["completed"] = True
+        self.stages[node["stage"]] -= 1
+        self.entries[node["jobid"]] -= 1
+        if not self.entries[node["jobid"]]:
+            del self.entries[node["jobid"]]
+            self.finished.append(node["jobid"])
+            self.freed.set()
+        self.pending -= 1
+        print(f"{dateAsString()} ⁝ {self}")
+        if self.pending == 0 and self.closed:
+            self.done.set()
+
+    # No more jobs will be added: every prompt was read
+    def close(self):
+        self.closed = True
+        if self.pending == 0:
+            self.done.set()
+
+    def __str__(self):
+        stages = ", ".join(f"{stage}: {count}" for stage, count in self.stages.items())
+        return f"pending {self.pending} ({stages})"
+
+
+tracker = JobTracker()
 
 
 def dateAsString():
     return datetime.datetime.now().isoformat()
 
 
+# Write JSON to a temp file and atomically rename it, so filePath is never left half-written
 def saveToFile(filePath, data):
     try:
-        with open(filePath, "w") as file:
+        tmpPath = f"{filePath}.tmp"
+        with metrics.timer("save"), open(tmpPath, "w") as file:
             json.dump(data, file, indent=2)
+        os.replace(tmpPath, filePath)
+        return True
     except Exception as error:
         print(f"Error writing to file: {error}")
+        return False
 
 
 def loadFromFile(filePath):
@@ -104,6 +442,206 @@ def loadFromFile(filePath):
     sys.exit(1)
 
 
+# Append-only journal of state changes. Each change appends the changed entry as one JSON line
+# to result.jsonl instead of rewriting the whole result.json. Every compactEvery records the
+# journal is compacted into a fresh result.json snapshot (temp file + atomic rename) and truncated.
+# Finished entries are retired to result.done.jsonl, so snapshots only hold the entries still in memory.
+class Journal:
+    def __init__(self, filePath, data):
+        self.filePath = filePath
+        self.journalPath = journalPathFor(filePath)
+        self.donePath = donePathFor(filePath)
+        self.data = data
+        self.records = 0
+        self.retired = 0
+        self.file = open(self.journalPath, "a")
+        self.doneFile = open(self.donePath, "a")
+
+    # Journal the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer("journal"):
+            self.file.write(json.dumps({"key": key, "value": self.data[key]}) + "\n")
+            self.file.flush()
+        self.records += 1
+        if self.records >= compactEvery:
+            self.compact()
+
+    # Move the finished data[key] out of memory: its final state is appended to result.done.jsonl
+    def retire(self, key):
+        with metrics.timer("journal"):
+            self.doneFile.write(json.dumps({"key": key, "value": self.data.pop(key)}) + "\n")
+            self.doneFile.flush()
+        self.retired += 1
+
+    # Snapshot data to result.json, then start a fresh journal
+    def compact(self):
+        if saveToFile(self.filePath, self.data):
+            self.file.close()
+            self.file = open(self.journalPath, "w")
+            self.records = 0
+            # Until the first retire() the snapshot holds every entry, result.done.jsonl ones included
+            if not self.retired:
+                self.doneFile.close()
+                self.doneFile = open(self.donePath, "w")
+
+    # Final result.json of the run: every entry, the ones retired to result.done.jsonl included, like --compact
+    def finish(self):
+        self.data.update({**loadJournal(self.filePath), **self.data})
+        self.retired = 0  # the snapshot holds the retired entries again
+        self.compact()
+
+
+def journalPathFor(filePath):
+    return os.path.splitext(filePath)[0] + ".jsonl"
+
+
+def donePathFor(filePath):
+    return os.path.splitext(filePath)[0] + ".done.jsonl"
+
+
+# Rebuild state from the last result.json snapshot replayed with every change journaled after it,
+# then with the final state of every entry retired since
+def loadJournal(filePath):
+    data = {}
+    if os.path.exists(filePath):
+        data = loadFromFile(filePath)
+    for path in (journalPathFor(filePath), donePathFor(filePath)):
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+                    data[record["key"]] = record["value"]
+    return data
+
+
+# SQLite job store in WAL mode, kept in result.db instead of result.json / result.jsonl with --sqlite. It has the
+# interface of Journal: save() upserts the entry into the jobs table and its nodes into stages / artefacts, indexed
+# by jobid, replyRef and status, so another process can query a run while it goes on, see printProgress().
+# retire() marks a finished entry done and drops it from memory. Nothing is ever rewritten whole.
+class JobStore:
+    def __init__(self, filePath, data, resume):
+        self.data = data
+        self.db = openJobStore(filePath)
+        if resume:
+            # Entries finished in an earlier run are already stored with their final state
+            self.done = {key for key, in self.db.execute("SELECT key FROM jobs WHERE done = 1")}
+        else:
+            self.done = set()
+            with self.db:
+                for table in ("jobs", "stages", "artefacts"):
+                    self.db.execute(f"DELETE FROM {table}")
+
+    # Store the current state of data[key]
+    def save(self, key):
+        if key not in self.data:
+            return  # already retired with its final state, see retire()
+        with metrics.timer("journal"):
+            self.write(key, self.data[key], False)
+
+    # Move the finished data[key] out of memory: it stays in the store, marked done
+    def retire(self, key):
+        value = self.data.pop(key)
+        if key in self.done:
+            return
+        with metrics.timer("journal"):
+            self.write(key, value, True)
+
+    # One transaction per entry: the entry itself, then every node of it (stage, status, files)
+    def write(self, key, value, done):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO jobs (key, value, done, updated) VALUES (?, ?, ?, ?)", (key, json.dumps(value), int(done), time.time()))
+            for node, jobid, replyRef, stage, status, files in nodesOf(value):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO stages (key, node, jobid, replyRef, stage, status) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, node, jobid, replyRef, stage, status),
+                )
+                for kind, path in files.items():
+                    if path:
+                        self.db.execute("INSERT OR REPLACE INTO artefacts (path, key, node, kind) VALUES (?, ?, ?, ?)", (path, key, node, kind))
+
+    # The store is never snapshotted, only the WAL is folded back into result.db
+    def compact(self):
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # result.db already holds every entry, finished ones included
+    def finish(self):
+        self.compact()
+
+
+def openJobStore(filePath):
+    db = sqlite3.connect(filePath, check_same_thread=False)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")  # a commit is durable once the WAL is checkpointed, never corrupt
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (key PRIMARY KEY, value TEXT NOT NULL, done INTEGER NOT NULL, updated REAL);
+        CREATE TABLE IF NOT EXISTS stages (key, node TEXT, jobid TEXT, replyRef TEXT, stage TEXT, status TEXT, PRIMARY KEY (key, node));
+        CREATE TABLE IF NOT EXISTS artefacts (path TEXT PRIMARY KEY, key, node TEXT, kind TEXT);
+        CREATE INDEX IF NOT EXISTS jobs_done ON jobs (done);
+        CREATE INDEX IF NOT EXISTS stages_jobid ON stages (jobid);
+        CREATE INDEX IF NOT EXISTS stages_replyRef ON stages (replyRef);
+        CREATE INDEX IF NOT EXISTS stages_status ON stages (stage, status);
+        CREATE INDEX IF NOT EXISTS artefacts_key ON artefacts (key);
+        """
+    )
+    return db
+
+
+# Every entry in result.db, like loadJournal()
+def loadJobStore(filePath):
+    return {key: json.loads(value) for key, value in openJobStore(filePath).execute("SELECT key, value FROM jobs")}
+
+
+# python3 ./example.py --progress prints how far the run stored in result.db got, also while it is still running
+def printProgress(filePath):
+    if not os.path.exists(filePath):
+        print(f"{dateAsString()} ⁝ {filePath} not found, start the run with --sqlite")
+        return
+    db = sqlite3.connect(f"file:{filePath}?mode=ro", uri=True)
+    total, done = db.execute("SELECT COUNT(*), COALESCE(SUM(done), 0) FROM jobs").fetchone()
+    print(f"{dateAsString()} ⁝ prompts: {total}, finished: {done}")
+    for stage, status, count in db.execute("SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status ORDER BY stage, status"):
+        print(f"{dateAsString()} ⁝ {stage} {status}: {count}")
+    for kind, count in db.execute("SELECT kind, COUNT(*) FROM artefacts GROUP BY kind ORDER BY kind"):
+        print(f"{dateAsString()} ⁝ {kind} files: {count}")
+
+
+# Read prompts one at a time instead of loading the whole file: .jsonl holds one prompt object (or string) per
+# line, .csv one prompt per row; a .json array is still loaded at once
+def readPrompts(filePath):
+    if filePath.endswith(".json"):
+        return iter(loadFromFile(filePath))
+    try:
+        file = open(filePath, "r", newline="")
+    except OSError as error:
+        print(f"Unable to load file: {filePath}. Error: {error}")
+        sys.exit(1)
+
+    def lines():
+        with file:
+            if filePath.endswith(".csv"):
+                for row in csv.DictReader(file):
+                    # CSV cells are strings, empty ones fall back to the defaults in newEntry()
+                    entry = {name: value for name, value in row.items() if value}
+                    if "duration" in entry:
+                        entry["duration"] = int(entry["duration"])
+                    if "use_source_image" in entry:
+                        entry["use_source_image"] = entry["use_source_image"].lower() in ("true", "yes", "1")
+                    yield entry
+            else:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        yield entry if isinstance(entry, dict) else {"prompt": entry}
+
+    return lines()
+
+
 # Extract filename from https://…/filename.mp4?…
 def getFilenameFromUrl(url):
     return url.split("/")[-1].split("?")[0]
@@ -114,63 +652,251 @@ def contentTypeForFile(fileName):
     return {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "gif": "image/gif", "webp": "image/webp"}.get(ext, "image/png")
 
 
-def downloadFile(url, prefix):
-    localPath = f"./{prefix}-{getFilenameFromUrl(url)}"
-    response = requests.get(url)
-    with open(localPath, "wb") as file:
-        file.write(response.content)
-    return localPath
+# Stream url to localPath in chunks through a temp file and atomic rename. Returns bytes fetched and seconds taken.
+# Files already downloaded are skipped, an interrupted download resumes from its .part file with a Range request,
+# and content identical to a file already on disk is stored once, see Manifest.
+def downloadFile(url, localPath):
+    key = url.split("?")[0]  # CDN urls carry expiring signatures in the query string
+
+    # The same url downloaded before, possibly under another name
+    existingPath = manifest.findUrl(key)
+    if existingPath:
+        linkFile(existingPath, localPath)
+        print(f"{dateAsString()} ⁝ {localPath} already downloaded, skipping")
+        return 0, 0
+
+    started = time.time()
+    tmpPath = f"{localPath}.part"
+    offset = os.path.getsize(tmpPath) if os.path.exists(tmpPath) else 0
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    record = manifest.get(localPath)
+    if record and record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+
+    sha256 = hashlib.sha256()
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:  # Not Modified — localPath matches the ETag we recorded for it
+            print(f"{dateAsString()} ⁝ {localPath} not modified, skipping")
+            return 0, 0
+        if response.status_code == 416:  # Range Not Satisfiable — the partial file is stale, start over
+            os.remove(tmpPath)
+            return downloadFile(url, localPath)
+        response.raise_for_status()
+
+        if response.status_code == 206 and response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            # Resume the partial file of an interrupted download; hash what is already on disk first
+            with open(tmpPath, "rb") as file:
+                for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+                    sha256.update(chunk)
+            mode = "ab"
+        else:
+            offset = 0
+            mode = "wb"
+
+        size = offset
+        with open(tmpPath, mode) as file:
+            for chunk in response.iter_content(chunk_size=downloadChunkSize):
+                file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        etag = response.headers.get("ETag")
+
+    digest = sha256.hexdigest()
+    existingPath = manifest.findHash(digest)
+    if existingPath and existingPath != localPath:
+        # Identical media is already on disk under another name
+        os.remove(tmpPath)
+        linkFile(existingPath, localPath)
+    else:
+        os.replace(tmpPath, localPath)
+    manifest.add({"path": localPath, "url": key, "size": size, "etag": etag, "sha256": digest})
+
+    fetched = size - offset
+    secs = max(time.time() - started, 0.001)
+    resumedFrom = f", resumed at {offset / 1048576:.1f} MB" if offset else ""
+    print(f"{dateAsString()} ⁝ downloaded {localPath} {fetched / 1048576:.1f} MB in {secs:.1f}s, {fetched / secs / 1048576:.1f} MB/s{resumedFrom}")
+    return fetched, secs
+
+
+# Store identical media once: localPath becomes a hard link to the copy already on disk
+def linkFile(existingPath, localPath):
+    if os.path.exists(localPath):
+        if os.path.samefile(existingPath, localPath):
+            return
+        os.remove(localPath)
+    try:
+        os.link(existingPath, localPath)
+    except OSError:
+        shutil.copyfile(existingPath, localPath)  # file system without hard links
+
+
+# Content-hash manifest of downloaded media, appended to downloads.jsonl as one JSON line per file.
+# Lets reruns skip files already on disk and finds identical media by url or sha256.
+class Manifest:
+    def __init__(self, filePath):
+        self.paths = {}  # localPath → record
+        self.urls = {}  # url without query string → localPath
+        self.hashes = {}  # sha256 → localPath
+        self.lock = threading.Lock()
+        if os.path.exists(filePath):
+            with open(filePath, "r") as file:
+                for line in file:
+                    try:
+                        self.index(json.loads(line))
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+        self.file = open(filePath, "a")
+
+    def index(self, record):
+        self.paths[record["path"]] = record
+        self.urls[record["url"]] = record["path"]
+        self.hashes[record["sha256"]] = record["path"]
+
+    # Path of the file downloaded from url, if still intact on disk
+    def findUrl(self, url):
+        return self.intact(self.urls.get(url))
+
+    # Path of a file with this content, if still intact on disk
+    def findHash(self, sha256):
+        return self.intact(self.hashes.get(sha256))
+
+    # Record of localPath, if the file on disk still matches it
+    def get(self, localPath):
+        return self.paths[localPath] if self.intact(localPath) else None
+
+    def intact(self, path):
+        record = self.paths.get(path)
+        if record and os.path.exists(path) and os.path.getsize(path) == record["size"]:
+            return path
+        return None
+
+    def add(self, record):
+        with self.lock:
+            self.index(record)
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+
+# Paths of images already uploaded with PixVerse POST /files, by account and sha256 of their content, so identical
+# source images are uploaded once and the path is reused by every videos/create until it expires. Persisted to uploads.jsonl.
+class UploadCache:
+    def __init__(self, filePath):
+        self.paths = {}  # (account, sha256) → record
+        self.uploading = {}  # (account, sha256) → event set once the upload in progress finished
+        self.hashes = {}  # (localPath, size, mtime) → sha256 of files not in the downloads manifest
+        if os.path.exists(filePath):
+            with open(filePath, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a run that died mid-write
+                    self.paths[(record["account"], record["sha256"])] = record
+        self.file = open(filePath, "a")
+
+    # Path of this content uploaded to account, unless it expired
+    def get(self, account, sha256):
+        record = self.paths.get((account, sha256))
+        if record and record["expires"] > time.time():
+            return record["path"]
+        return None
+
+    def add(self, account, sha256, path):
+        record = {"account": account, "sha256": sha256, "path": path, "expires": time.time() + uploadTtlSecs}
+        self.paths[(account, sha256)] = record
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    # sha256 of a local file: taken from the downloads manifest when it was downloaded, otherwise hashed once
+    def hash(self, localPath):
+        record = manifest.get(localPath)
+        if record:
+            return record["sha256"]
+        stat = os.stat(localPath)
+        key = (localPath, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            sha256 = hashlib.sha256()
+            with open(localPath, "rb") as file:
+                for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+                    sha256.update(chunk)
+            self.hashes[key] = sha256.hexdigest()
+        return self.hashes[key]
+
+
+# Bounded pool of download threads, so webhook handling never waits on a large file. Once a file is in place
+# fn(localPath, *args) is awaited on the event loop, which owns data and the journal (localPath is None on failure).
+class Downloader:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.active = {}  # localPath → download task
+        self.files = 0
+        self.bytes = 0
+        self.secs = 0
+
+    def submit(self, url, localPath, fn, *args):
+        # A duplicate webhook for a file that is already downloading is ignored
+        if localPath in self.active:
+            return
+        self.active[localPath] = asyncio.create_task(self.fetch(url, localPath, fn, args))
 
+    async def fetch(self, url, localPath, fn, args):
+        try:
+            size, secs = await asyncio.get_running_loop().run_in_executor(self.pool, downloadFile, url, localPath)
+        except Exception as error:
+            print(f"{dateAsString()} ⁝ download {url} failed: {error}")
+            size, secs = None, 0
+        del self.active[localPath]
+        if size is not None:
+            self.files += 1
+            self.bytes += size
+            self.secs += secs
+            metrics.observe("download", secs)
+        try:
+            await fn(localPath if size is not None else None, *args)
+        except Exception as error:
+            print("An error occurred:", error)
 
-# Find a data node by its jobid field.
-def findByJobid(jobid, json_object):
-    if isinstance(json_object, dict):
-        for key, value in json_object.items():
-            if key == "jobid" and value == jobid:
-                return json_object
-            elif isinstance(value, dict):
-                result = findByJobid(jobid, value)
-                if result is not None:
-                    return result
-    return None
+    def __str__(self):
+        rate = self.bytes / max(self.secs, 0.001) / 1048576
+        return f"downloaded {self.files} files, {self.bytes / 1048576:.1f} MB, {rate:.1f} MB/s per download"
 
 
-# Checks whether there are more jobs to run by looking for a job with completed = False.
-def hasMoreJobsToRun(json_object):
-    if isinstance(json_object, dict):
-        for key, value in json_object.items():
-            if key == "completed" and not value:
-                return True
-            elif isinstance(value, dict):
-                if hasMoreJobsToRun(value):
-                    return True
-    return False
+# Register a data node under its jobid so webhook callbacks (Midjourney jobid, FaceSwap / PixVerse replyRef)
+# can be dispatched to it in constant time.
+def indexJob(jobid, node):
+    if jobid:
+        jobs[jobid] = node
 
 
 # POST a JSON payload to PixVerse v2. Retries on 429 (at capacity).
-async def submit_payload(url, params, body):
+async def submit_payload(url, params, body, account=None):
     global submitted
 
     while True:
         response = None
         retry_count = 0
-        # On a slow connection the POST may fail, so retry up to 3 times
-        while retry_count < 3:
-            try:
-                response = requests.post(
-                    url,
-                    headers={
-                        "Authorization": f"Bearer {token}",
-                        "Content-Type": "application/json",
-                    },
-                    json=body,
-                )
-                break
-            except requests.RequestException as ex:
-                print(f"fetch {url} failed #{retry_count}", ex)
-                if retry_count > 1:
-                    raise
-                retry_count += 1
+        controller = rateController("pixverse", account)
+        await controller.acquire()
+        try:
+            # On a slow connection the POST may fail, so retry up to 3 times
+            while retry_count < 3:
+                try:
+                    # requests is blocking, so the call runs on a thread to keep the webhook receiver responsive
+                    with metrics.timer("submit", "pixverse"):
+                        response = await asyncio.to_thread(session.post, url, headers=jsonHeaders, json=body)
+                    break
+                except requests.RequestException as ex:
+                    print(f"fetch {url} failed #{retry_count}", ex)
+                    if retry_count > 1:
+                        raise
+                    retry_count += 1
+        except Exception:
+            await controller.release(None)
+            await pixverseAccounts.release(account)
+            raise
+        await controller.release(response.status_code, response.headers.get("Retry-After"))
 
         job = response.json()
 
@@ -186,7 +912,7 @@ async def submit_payload(url, params, body):
 
         # 429 — all PixVerse accounts at capacity: wait and retry
         if response.status_code == 429:
-            await asyncio.sleep(10)
+            # the rate controller already backs off before the retry
             continue
 
         params["pixverse"] = {
@@ -197,14 +923,61 @@ async def submit_payload(url, params, body):
             "error": error or errorDetails,
         }
         # If PixVerse failed to accept the job, no webhook will arrive
-        if response.status_code != 200 and params.get("completed") is False:
-            params["completed"] = True
-
-        saveToFile("./result.json", data)
+        if response.status_code != 200:
+            tracker.complete(params)
+            await pixverseAccounts.release(account)
+        else:
+            pixverseAccounts.started(video_id, account)
+            metrics.begin(video_id)
+
+        journal.save(params["jobid"])
         submitted += 1
         return job
 
 
+# Upload a local image with PixVerse POST /files, or reuse the path of the same content already uploaded to account,
+# see UploadCache. Returns (path, response, HTTP status); path is None when the upload failed.
+async def uploadImage(fileName, account):
+    sha256 = await asyncio.to_thread(uploads.hash, fileName)
+    key = (account, sha256)
+
+    # Concurrent uploads of the same content wait for the first one and reuse its path
+    while key in uploads.uploading:
+        await uploads.uploading[key].wait()
+
+    path = uploads.get(account, sha256)
+    if path:
+        print(f"{dateAsString()} ⁝ pixverse upload cached", {path})
+        return path, {"result": [{"path": path}]}, 200
+
+    uploads.uploading[key] = asyncio.Event()
+    try:
+        upload_url = f"{rootPixVerseUrl}/files"
+        if account:
+            upload_url += f"?email={account}"
+
+        # The file object is streamed in chunks as it is sent, never read into memory whole
+        async with uploadSlots:
+            with open(fileName, "rb") as image_file, metrics.timer("upload", "pixverse"):
+                upload_response = await asyncio.to_thread(
+                    session.post,
+                    upload_url,
+                    headers={**authHeaders, "Content-Type": contentTypeForFile(fileName)},
+                    data=image_file,
+                )
+        uploaded = upload_response.json()
+        result = uploaded.get("result") or []
+        path = result[0].get("path") if result else None
+
+        print(f"{dateAsString()} ⁝ pixverse upload HTTP {upload_response.status_code}", {path})
+
+        if path:
+            uploads.add(account, sha256, path)
+        return path, uploaded, upload_response.status_code
+    finally:
+        uploads.uploading.pop(key).set()
+
+
 # Upload source.jpg and create a PixVerse v2 video.
 # If the prompt entry has use_source_image: true, uploads ./source.jpg first → i2v.
 # Otherwise submits text-to-video (t2v) without first_frame_path.
@@ -219,32 +992,23 @@ async def post_pixverse(params):
 
     first_frame_path = None
 
-    if use_source_image:
-        # 1. Upload the source image (raw bytes)
-        upload_url = f"{rootPixVerseUrl}/files"
-        if pixverse_email:
-            upload_url += f"?email={pixverse_email}"
-
-        with open("./source.jpg", "rb") as image_file:
-            upload_response = requests.post(
-                upload_url,
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Content-Type": contentTypeForFile("./source.jpg"),
-                },
-                data=image_file.read(),
-            )
-        uploaded = upload_response.json()
-        result = uploaded.get("result") or []
-        first_frame_path = result[0].get("path") if result else None
+    # The upload and the video it starts have to use the same account
+    account = await pixverseAccounts.acquire()
 
-        print(f"{dateAsString()} ⁝ pixverse upload HTTP {upload_response.status_code}", {first_frame_path})
+    if use_source_image:
+        # 1. Upload the source image (raw bytes) once per account, every later prompt reuses its path
+        try:
+            first_frame_path, uploaded, upload_status = await uploadImage("./source.jpg", account)
+        except Exception:
+            await pixverseAccounts.release(account)
+            raise
 
         if not first_frame_path:
             print("pixverse upload failed", uploaded)
-            params["completed"] = True
-            params["pixverse"] = {**params.get("pixverse", {}), "upload": uploaded, "code": upload_response.status_code}
-            saveToFile("./result.json", data)
+            await pixverseAccounts.release(account)
+            tracker.complete(params)
+            params["pixverse"] = {**params.get("pixverse", {}), "upload": uploaded, "code": upload_status}
+            journal.save(params["jobid"])
             return
 
     # 2. Create the video (t2v or i2v)
@@ -253,77 +1017,123 @@ async def post_pixverse(params):
         "prompt": prompt,
         "duration": duration,
         "quality": quality,
-        "replyUrl": listener.url(),
+        "replyUrl": webhookUrl,
         "replyRef": jobid,  # map the PixVerse callback back to this node
     }
 
     if first_frame_path:
         body["first_frame_path"] = first_frame_path
 
-    if pixverse_email:
-        body["email"] = pixverse_email
+    if account:
+        body["email"] = account
 
-    return await submit_payload(f"{rootPixVerseUrl}/videos/create", params, body)
+    return await submit_payload(f"{rootPixVerseUrl}/videos/create", params, body, account)
 
 
-# Webhook callback
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Hello from ngrok server")
+async def handle_get(request):
+    return web.Response(text="Hello from ngrok server")
 
-    def do_POST(self):
-        global data
 
-        content_length = int(self.headers["Content-Length"])
-        post_data = self.rfile.read(content_length)
+# Prometheus scrape target: GET /metrics on the webhook server
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
 
-        job = json.loads(post_data.decode("utf-8"))
 
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write(b"ok")
+# Webhook callback: acknowledged right away, so a slow download never delays the response, and queued
+async def handle_post(request):
+    webhooks.put_nowait(await request.json())
+    return web.Response(text="ok")
 
-        # PixVerse v2 callbacks carry a video_id
-        if not job.get("video_id"):
-            return
 
-        replyRef = job.get("replyRef") or (job.get("response") or {}).get("replyRef")
-        completed = job.get("video_status_final") is True or job.get("video_status_name") == "COMPLETED"
-        failed = job.get("video_status_name") == "FAILED" or job.get("errCode")
-        url = job.get("url")
+# Webhook worker, webhookWorkers of them process queued webhooks concurrently
+async def processWebhooks():
+    while True:
+        job = await webhooks.get()
+        try:
+            await processJob(job)
+        except Exception as error:
+            print("An error occurred:", error)
 
-        print(f"{dateAsString()} ⁝ webhook pixverse {job.get('video_id')} {job.get('video_status_name')}")
 
-        node = findByJobid(jobid=replyRef, json_object=data)
-        if node:
-            node["pixverse"] = {
-                **node.get("pixverse", {}),
-                "video_id": job.get("video_id"),
-                "status": job.get("video_status_name"),
-                "url": url,
-            }
-            if completed and url:
-                node["pixverse"]["videoFileName"] = downloadFile(url, f"{replyRef}-pixverse")
-            if completed or failed:
-                node["completed"] = True
-            saveToFile("./result.json", data)
+# Handle a PixVerse video state, delivered by webhook or polled with GET /videos/{video_id}
+async def processJob(job):
+    # PixVerse v2 callbacks carry a video_id
+    if not job.get("video_id"):
+        return
 
+    replyRef = job.get("replyRef") or (job.get("response") or {}).get("replyRef")
+    completed = job.get("video_status_final") is True or job.get("video_status_name") == "COMPLETED"
+    failed = job.get("video_status_name") == "FAILED" or job.get("errCode")
+    url = job.get("url")
 
-start_time = time.time()
+    print(f"{dateAsString()} ⁝ webhook pixverse {job.get('video_id')} {job.get('video_status_name')}")
 
-prompts = loadFromFile("./prompts.json")
+    if completed or failed:
+        await pixverseAccounts.finished(job.get("video_id"))
+        metrics.end(job.get("video_id"), "pixverse")
 
-print(f"{dateAsString()} ⁝ prompts to process: {len(prompts)}")
+    node = jobs.get(replyRef)
+    # Skip duplicate deliveries for a node that already completed
+    if node and not node["completed"]:
+        node["pixverse"] = {
+            **node.get("pixverse", {}),
+            "video_id": job.get("video_id"),
+            "status": job.get("video_status_name"),
+            "url": url,
+        }
+        if completed or failed:
+            resumed.pop(replyRef, None)
+        if completed and url:
+            # Completed once the video is on disk, see videoDownloaded()
+            downloader.submit(url, f"./{replyRef}-pixverse-{getFilenameFromUrl(url)}", videoDownloaded, node)
+        elif completed or failed:
+            tracker.complete(node)
+        journal.save(node["jobid"])
 
-httpd = HTTPServer(("", 8081), SimpleHTTPRequestHandler)
 
-# Build data entries from prompts; each entry tracks its own completed state.
-for ind, entry in enumerate(prompts):
-    key = f"video-{ind}"
-    data[key] = {
+# A PixVerse video finished downloading
+async def videoDownloaded(localPath, node):
+    node["pixverse"]["videoFileName"] = localPath
+    tracker.complete(node)
+    journal.save(node["jobid"])
+
+
+# Jobs still running when a previous run stopped report to its webhook url, so they are polled instead
+async def pollResumed():
+    while True:
+        await asyncio.sleep(pollSecs)
+
+        for replyRef, (url, fields) in list(resumed.items()):
+            # A network error, a 429 or a 5xx answer is logged and the video polled again on the next pass
+            try:
+                response = await asyncio.to_thread(session.get, url, headers=authHeaders)
+
+                if response.status_code == 429 or response.status_code >= 500:
+                    print(f"{dateAsString()} ⁝ resumed {replyRef} HTTP {response.status_code}, polling again")
+                    continue
+                if response.status_code != 200:
+                    print(f"{dateAsString()} ⁝ resumed {replyRef} HTTP {response.status_code}, giving up", response.text)
+                    job = {**fields, "status": "failed", "video_status_name": "FAILED"}
+                else:
+                    job = {**response.json(), **fields}
+
+                await processJob(job)
+            except Exception as error:
+                print(f"{dateAsString()} ⁝ resumed {replyRef} poll failed, polling again: {error}")
+
+
+# Row of the stages / artefacts tables for a data entry, see JobStore: (node, jobid, replyRef, stage, status, files)
+# of its video, looked up by video_id
+def nodesOf(entry):
+    pixverse = entry.get("pixverse") or {}
+    status = (pixverse.get("status") or "pending").lower()
+    video_id = pixverse.get("video_id")
+    yield "video", video_id and str(video_id), entry["jobid"], entry.get("stage", "pixverse"), status, {"video": pixverse.get("videoFileName")}
+
+
+# data entry of a prompt; it tracks its own completed state
+def newEntry(key, entry):
+    return {
         "jobid": key,
         "prompt": entry["prompt"],
         "model": entry.get("model", "v6"),
@@ -333,16 +1143,124 @@ for ind, entry in enumerate(prompts):
         "completed": False,
     }
 
-saveToFile("./result.json", data)
 
-for key in data:
-    queuePixVerse.enqueue(post_pixverse, data[key])
+# Drop completed entries from memory, see Journal.retire(); late webhooks for their videos are ignored
+def retireFinished():
+    while tracker.finished:
+        key = tracker.finished.popleft()
+        if key in data:
+            jobs.pop(key, None)
+            journal.retire(key)
+
+
+# Continue a data node: skip it once completed, poll it while its video is generating, otherwise submit it
+async def scheduleNode(node):
+    video_id = (node.get("pixverse") or {}).get("video_id")
+
+    if node["completed"]:
+        return
+    elif video_id:
+        resumed[node["jobid"]] = (f"{rootPixVerseUrl}/videos/{video_id}", {"video_id": video_id, "replyRef": node["jobid"]})
+    else:
+        await queuePixVerse.enqueue(post_pixverse, node)
+
+
+# python3 ./example.py --compact rebuilds result.json from result.json + result.jsonl + result.done.jsonl and exits;
+# with --sqlite it exports result.db to result.json instead
+if "--compact" in sys.argv:
+    Journal("./result.json", loadJobStore("./result.db") if useJobStore else loadJournal("./result.json")).compact()
+    sys.exit(0)
+
+if "--progress" in sys.argv:
+    printProgress("./result.db")
+    sys.exit(0)
+
+# https://github.com/ngrok/ngrok-python
+listener = None
+if not webhookUrl:
+    listener = ngrok.forward(8081, authtoken_from_env=True)
+    webhookUrl = listener.url()
+
+print(f"Webhook {webhookUrl}")
+
+prompts = readPrompts(promptsFile)
+
+if "--resume" in sys.argv:
+    # Continue the previous run instead of submitting every prompt again
+    data.update(loadJobStore("./result.db") if useJobStore else loadJournal("./result.json"))
+
+# data holds the entries of the prompts in flight
+journal = JobStore("./result.db", data, "--resume" in sys.argv) if useJobStore else Journal("./result.json", data)
+journal.compact()
+
+# Entries completed in the previous run are retired right away, their prompts are skipped
+finished = [key for key in data if data[key]["completed"]]
+for key in finished:
+    journal.retire(key)
+finished = set(finished)
+
+downloader = Downloader(maxDownloads)
+manifest = Manifest("./downloads.jsonl")
+uploads = UploadCache("./uploads.jsonl")
+
+
+# Feed prompts to the pipeline as they are read, keeping at most maxActivePrompts of them in memory
+async def run():
+    count = 0
+    for ind, entry in enumerate(prompts):
+        count = ind + 1
+        key = f"video-{ind}"
+        if key in finished:
+            continue
+
+        while len(tracker.entries) >= maxActivePrompts:
+            tracker.freed.clear()
+            await tracker.freed.wait()
+        retireFinished()
+
+        data.setdefault(key, newEntry(key, entry))
+        indexJob(key, data[key])
+        if not data[key]["completed"]:
+            tracker.add(data[key], "pixverse")
+        await scheduleNode(data[key])
+
+    print(f"{dateAsString()} ⁝ prompts read: {count}")
+    tracker.close()
+
+
+async def main():
+    app = web.Application()
+    app.router.add_get("/", handle_get)
+    app.router.add_post("/", handle_post)
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=8081).start()
+
+    tasks = [asyncio.create_task(processWebhooks()) for _ in range(webhookWorkers)]
+    tasks.append(asyncio.create_task(run()))
+    tasks.append(asyncio.create_task(pollResumed()))
+
+    # Shut down the moment the last job completes
+    await tracker.done.wait()
+
+    for task in tasks:
+        task.cancel()
+    await runner.cleanup()
+
+    print(f"{dateAsString()} ⁝ {downloader}")
+    for controller in rateControllers.values():
+        print(f"{dateAsString()} ⁝ {controller}")
+    if pixverseAccounts.capacity:
+        print(f"{dateAsString()} ⁝ {pixverseAccounts}")
+
+    # Entries that finished with the last jobs are stored as finished too
+    retireFinished()
+    journal.finish()
 
-while hasMoreJobsToRun(data):
-    httpd.handle_request()
 
-execution_time = time.time() - start_time
+asyncio.run(main())
 
-print(
-    f"{dateAsString()} ⁝ total elapsed time {datetime.datetime.utcfromtimestamp(execution_time).strftime('%H:%M:%S')}"
-)
+for line in metrics.summary():
+    print(f"{dateAsString()} ⁝ {line}")